@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Times wVote's hot paths against a synthetic week, and writes the results as
+JSON so they can be compared across commits.
+
+Run it from the repository root:
+
+    python -m bench.run --entries 30 --voters 500 --output before.json
+
+Everything it saves goes into a temporary directory; weeks/ is left alone.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable
+
+# http_server reads its templates relative to the repository root on import
+import compo
+import http_server
+import keys
+from config import config
+
+from bench.synthetic import synthetic_week
+
+
+def time_call(function: Callable,
+              repeat: int,
+              number: int = 1,
+              setup: Callable = None) -> dict:
+    """
+    Times `function` over `repeat` samples of `number` calls each, running
+    `setup` (untimed) before every sample.
+
+    Returns
+    -------
+    dict
+        The minimum, median and mean seconds per call, and the sample count
+    """
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        samples.append((time.perf_counter() - start) / number)
+
+    return {
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "mean": statistics.mean(samples),
+        "repeat": repeat,
+        "number": number,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"],
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(args: argparse.Namespace) -> dict:
+    week = synthetic_week(entries=args.entries,
+                          voters=args.voters,
+                          ratings_per_voter=args.ratings,
+                          mp3_size=args.mp3_size,
+                          pdf_size=args.pdf_size,
+                          seed=args.seed)
+    next_week = compo.blank_week()
+
+    compo.current_week = week
+    compo.next_week = next_week
+
+    db = compo.get_database()
+    if db is not None:
+        # Ballots only reach the database one at a time, not through saves
+        db.import_week("current", week)
+        db.import_week("next", next_week)
+
+    results = {}
+    repeat = args.repeat
+
+    results["get_ranked_entrant_list"] = time_call(
+        lambda: compo.get_ranked_entrant_list(week),
+        repeat,
+        setup=compo.invalidate_live_results)
+    results["get_ranked_entrant_list (cached)"] = time_call(
+        lambda: compo.get_ranked_entrant_list(week), repeat)
+    results["normalize_votes"] = time_call(
+        lambda: compo.normalize_votes(week["votes"].values()), repeat)
+    results["format_week"] = time_call(
+        lambda: http_server.format_week(week, False), repeat)
+    results["format_week (admin)"] = time_call(
+        lambda: http_server.format_week(week, True), repeat)
+    results["get_week_votes"] = time_call(
+        lambda: http_server.get_week_votes(week), repeat)
+
+    results["save_weeks"] = time_call(compo.save_weeks, repeat)
+
+    def forget_weeks():
+        compo.current_week = None
+        compo.next_week = None
+        compo.invalidate_live_results()
+
+    results["get_week (load)"] = time_call(lambda: compo.get_week(False),
+                                           repeat,
+                                           setup=forget_weeks)
+
+    key_list = [
+        keys.create_vote_key(user_id, vote["userName"])
+        for user_id, vote in week["votes"].items()
+    ]
+    results["key_valid"] = time_call(
+        lambda: [keys.key_valid(key, keys.vote_keys) for key in key_list],
+        repeat)
+    results["key_valid"]["keys"] = len(key_list)
+
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--entries", type=int, default=30)
+    parser.add_argument("--voters", type=int, default=200)
+    parser.add_argument("--ratings",
+                        type=int,
+                        default=60,
+                        help="ratings per ballot")
+    parser.add_argument("--mp3-size",
+                        type=int,
+                        default=0,
+                        help="bytes per mp3 file (0 skips writing blobs)")
+    parser.add_argument("--pdf-size",
+                        type=int,
+                        default=0,
+                        help="bytes per pdf file (0 skips writing blobs)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=10,
+                        help="samples per benchmark")
+    parser.add_argument("--backend",
+                        choices=["pickle", "sqlite"],
+                        default="pickle")
+    parser.add_argument("--output",
+                        help="file to write JSON results to (default: stdout)")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    output = None if args.output is None else os.path.abspath(args.output)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        os.makedirs("weeks/archive")
+
+        config.storage_backend = args.backend
+        config.sqlite_path = os.path.join(scratch, "wvote.sqlite3")
+
+        results = run_benchmarks(args)
+
+        if compo.database is not None:
+            compo.database.close()
+            compo.database = None
+
+    report = {
+        "commit": commit,
+        "date": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "parameters": vars(args),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+
+    if output is None:
+        print(text)
+    else:
+        with open(output, "w") as output_file:
+            output_file.write(text + "\n")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
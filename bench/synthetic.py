@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Generates synthetic weeks for benchmarking, with made-up entries, files and
+ballots in the same shape compo keeps real ones in.
+"""
+
+import random
+
+import compo
+
+
+def synthetic_week(entries: int = 30,
+                   voters: int = 200,
+                   ratings_per_voter: int = 60,
+                   mp3_size: int = 0,
+                   pdf_size: int = 0,
+                   seed: int = 0) -> dict:
+    """
+    Builds a week full of valid entries and ballots.
+
+    Parameters
+    ----------
+    entries : int
+        How many entries to submit
+    voters : int
+        How many ballots to cast
+    ratings_per_voter : int
+        How many ratings each ballot holds, at most one per entry and
+        parameter (so it's capped at entries x parameters)
+    mp3_size, pdf_size : int
+        How many bytes of random data to store as each entry's files. With
+        0, entries get placeholder digests instead, and nothing is written
+        to the blob store.
+    seed : int
+        Seeds the random generator, so the same arguments give the same week
+
+    Returns
+    -------
+    dict
+        The week, with ballots mapped by voter like `compo.index_votes`
+        leaves them.
+    """
+    rng = random.Random(seed)
+    week = compo.blank_week()
+
+    for n in range(entries):
+        entry = compo.create_blank_entry("Entrant %d" % n, 1000 + n)
+        entry["uuid"] = "%032x" % rng.getrandbits(128)
+        entry["entryName"] = "Entry %d" % n
+        entry["pdfFilename"] = "score-%d.pdf" % n
+        entry["mp3Format"] = "mp3"
+        entry["mp3Filename"] = "song-%d.mp3" % n
+
+        for field, size in [("mp3", mp3_size), ("pdf", pdf_size)]:
+            if size:
+                compo.set_entry_file(entry, field, random_bytes(rng, size))
+            else:
+                entry[field] = "%064x" % rng.getrandbits(256)
+                entry[field + "Size"] = 0
+
+        week["entries"].append(entry)
+
+    choices = [(e["uuid"], param) for e in week["entries"]
+               for param in week["voteParams"]]
+    ratings_per_voter = min(ratings_per_voter, len(choices))
+
+    for voter in range(voters):
+        user_id = 10**17 + voter
+        week["votes"][user_id] = {
+            "userID": user_id,
+            "userName": "Voter %d" % voter,
+            "ratings": [{
+                "entryUUID": uuid,
+                "voteParam": param,
+                "rating": rng.randint(0, 5),
+            } for uuid, param in rng.sample(choices, ratings_per_voter)],
+        }
+
+    return week
+
+
+def random_bytes(rng: random.Random, size: int) -> bytes:
+    return rng.getrandbits(size * 8).to_bytes(size, "little")
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import hashlib
+import logging
+import os
+import string
+import tempfile
+
+# Uploaded files live here, named by the SHA-256 of their contents, so the
+# week pickles only need to carry the digest.
+blob_dir = "weeks/blobs"
+
+
+def is_digest(value) -> bool:
+    """Returns True if `value` looks like a SHA-256 hex digest."""
+    return (isinstance(value, str) and len(value) == 64
+            and all(c in string.hexdigits for c in value))
+
+
+def blob_path(digest: str) -> str:
+    """
+    Returns the path a blob is stored at. Blobs are fanned out into
+    subdirectories by the first two characters of their digest.
+    """
+    if not is_digest(digest):
+        raise ValueError("Not a blob digest: %r" % (digest, ))
+
+    return os.path.join(blob_dir, digest[:2], digest)
+
+
+def put(data: bytes) -> str:
+    """
+    Stores `data` in the blob store.
+
+    Parameters
+    ----------
+    data : bytes
+        The contents to store
+
+    Returns
+    -------
+    str
+        The SHA-256 hex digest that addresses the stored contents
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest)
+
+    if os.path.exists(path):
+        # Same contents, same name; nothing to do
+        return digest
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+
+    # Write to a temporary file first so a crash never leaves a truncated
+    # blob under its final name
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+    fsync_directory(directory)
+
+    logging.info("BLOBS: Stored %s (%d bytes)" % (digest, len(data)))
+
+    return digest
+
+
+def fsync_directory(directory: str) -> None:
+    """
+    Makes sure a file renamed into `directory` is still there after a power
+    loss. Its contents must have been synced before the rename; a blob that
+    came back empty would never be rewritten, since its name says it exists.
+    """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class BlobWriter:
+    """
+    Streams data into the blob store a chunk at a time, hashing as it goes,
+    so a large upload never has to be held in memory.
+
+    Nothing shows up in the store until `commit()`; leaving the `with` block
+    without committing throws the partial file away.
+
+        with blobs.BlobWriter() as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+            digest = writer.commit()
+    """
+
+    def __init__(self):
+        os.makedirs(blob_dir, exist_ok=True)
+
+        # Kept in blob_dir itself, so the final rename doesn't cross devices
+        fd, self.temp_path = tempfile.mkstemp(dir=blob_dir, suffix=".tmp")
+        self.temp_file = os.fdopen(fd, "wb")
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def __enter__(self) -> "BlobWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.abort()
+
+    def write(self, chunk: bytes) -> None:
+        self.temp_file.write(chunk)
+        self.hash.update(chunk)
+        self.size += len(chunk)
+
+    def commit(self) -> str:
+        """
+        Moves the finished file into the store.
+
+        Returns
+        -------
+        str
+            The SHA-256 hex digest of everything written
+        """
+        self.temp_file.flush()
+        os.fsync(self.temp_file.fileno())
+        self.temp_file.close()
+
+        digest = self.hash.hexdigest()
+        path = blob_path(digest)
+
+        if os.path.exists(path):
+            # Same contents, same name; nothing to do
+            os.unlink(self.temp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.temp_path, path)
+            fsync_directory(os.path.dirname(path))
+            logging.info("BLOBS: Stored %s (%d bytes)" % (digest, self.size))
+
+        self.temp_path = None
+
+        return digest
+
+    def abort(self) -> None:
+        """Throws away what was written, unless it's been committed."""
+        if self.temp_path is None:
+            return
+
+        self.temp_file.close()
+        os.unlink(self.temp_path)
+        self.temp_path = None
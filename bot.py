@@ -1,21 +1,43 @@
 #!/usr/bin/env python3
 
-import io
+import asyncio
 import urllib.parse
 import logging
 import statistics
 import datetime
 import random
+import io
+import time
 
 import discord
 from discord.ext import commands
 
 import compo
 import keys
+import profiling
 from config import config
 
 dm_reminder = "_Ahem._ DM me to use this command."
 
+# When posting entries: how many entrants to look up at once, how many
+# entries to have files ready for ahead of the one being posted, and how
+# often to update the progress message
+publish_fetch_limit = 8
+publish_prepare_ahead = 2
+publish_progress_every = 5
+
+# Admin notifications waiting to go out, keyed by the entry they're about:
+# {"message": str, "due": loop time, "attempts": int}
+outbox = {}
+outbox_task = None
+outbox_changed = None
+
+# How long a submission notification waits for more edits to the same entry
+# before going out, and how failed sends are retried, in seconds
+outbox_coalesce_delay = 10.0
+outbox_retry_delay = 2.0
+outbox_max_attempts = 5
+
 intents = discord.Intents.default()
 intents.messages = True
 intents.emojis = True
@@ -68,7 +90,7 @@ def entry_info_message(entry: dict) -> str:
                 % (config.url_prefix,
                    entry["uuid"],
                    urllib.parse.quote(entry["mp3Filename"]),
-                   len(entry["mp3"]) / 1000)
+                   (entry.get("mp3Size") or 0) / 1000)
         elif entry["mp3Format"] == "external":
             entry_message += "MP3: %s\n" % entry["mp3"]
 
@@ -78,7 +100,7 @@ def entry_info_message(entry: dict) -> str:
             % (config.url_prefix,
                entry["uuid"],
                urllib.parse.quote(entry["pdfFilename"]),
-               len(entry["pdf"]) / 1000)
+               (entry.get("pdfSize") or 0) / 1000)
 
     # Mention whether the entry is valid
     if compo.entry_valid(entry):
@@ -89,10 +111,12 @@ def entry_info_message(entry: dict) -> str:
     return entry_message
 
 
-async def submission_message(entry: dict, user_was_admin: bool) -> None:
+def submission_message(entry: dict, user_was_admin: bool) -> None:
     """
     Prepares a message to be sent to the admin channel based on an entry that
-    was submitted to the website.
+    was submitted to the website, and puts it in the outbox. It goes out
+    after `outbox_coalesce_delay` seconds, so that if the entry is edited
+    again in the meantime, only one message (about the latest edit) is sent.
 
     Parameters
     ----------
@@ -107,7 +131,68 @@ async def submission_message(entry: dict, user_was_admin: bool) -> None:
     if user_was_admin:
         notification_message += "(This edit was performed by an admin)"
 
-    await notify_admins(notification_message)
+    loop = asyncio.get_running_loop()
+
+    pending = outbox.get(entry["uuid"])
+    outbox[entry["uuid"]] = {
+        "message": notification_message,
+        "due": (pending["due"] if pending is not None else loop.time() +
+                outbox_coalesce_delay),
+        "attempts": 0,
+    }
+
+    start_outbox_worker(loop)
+    outbox_changed.set()
+
+
+def start_outbox_worker(loop: asyncio.AbstractEventLoop) -> None:
+    global outbox_task, outbox_changed
+
+    if outbox_changed is None:
+        outbox_changed = asyncio.Event()
+
+    if outbox_task is None or outbox_task.done():
+        outbox_task = loop.create_task(outbox_worker())
+
+
+async def outbox_worker() -> None:
+    """
+    Sends admin notifications from the outbox as they come due. A message
+    that fails to send is retried with exponential backoff, unless a newer
+    one about the same entry has come in by then.
+    """
+    loop = asyncio.get_running_loop()
+
+    while outbox:
+        key, item = min(outbox.items(), key=lambda pair: pair[1]["due"])
+
+        delay = item["due"] - loop.time()
+        if delay > 0:
+            outbox_changed.clear()
+            try:
+                await asyncio.wait_for(outbox_changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        del outbox[key]
+
+        try:
+            await notify_admins(item["message"])
+        except Exception as e:
+            attempts = item["attempts"] + 1
+            if attempts >= outbox_max_attempts:
+                logging.error("DISCORD: Giving up on notification: %s" %
+                              str(e))
+                continue
+
+            logging.warning("DISCORD: Failed to send notification "
+                            "(attempt %d): %s" % (attempts, str(e)))
+            if key not in outbox:
+                outbox[key] = dict(item,
+                                   attempts=attempts,
+                                   due=loop.time() +
+                                   outbox_retry_delay * 2**(attempts - 1))
 
 
 def help_message(full: bool = False, is_admin: bool = False) -> str:
@@ -125,7 +210,8 @@ def help_message(full: bool = False, is_admin: bool = False) -> str:
 
     commands = ["howmany", "submit", "vote", "status", "myresults"]
     admin_commands = [
-        "results", "postentries", "postentriespreview", "manage"
+        "results", "postentries", "postentriespreview", "manage", "revoke",
+        "profile", "heap"
     ]
 
     msg = ("Hey there! I'm 8Bot-- My job is to help you participate in "
@@ -298,82 +384,224 @@ def is_postentries_channel():
 @client.command()
 @commands.check(is_admin)
 @commands.check_any(is_postentries_channel(), commands.dm_only())
-async def postentries(context: commands.Context) -> None:
+async def postentries(context: commands.Context, start: int = 1) -> None:
     """
     Post the entries of the week to the current channel.
     Works in the postentries channel or in DMs.
+
+    Give an entry number to pick up from there, if posting got interrupted.
     """
     week = compo.get_week(False)
-    await publish_entries(context, week)
+    await publish_entries(context, week, start)
 
 
 @client.command()
 @commands.check(is_admin)
 @commands.dm_only()
-async def postentriespreview(context: commands.Context) -> None:
+async def postentriespreview(context: commands.Context,
+                             start: int = 1) -> None:
     """
     Post the entries of the next week. Only works in DMs.
     """
     week = compo.get_week(True)
-    await publish_entries(context, week)
+    await publish_entries(context, week, start)
 
 
-async def publish_entries(context: commands.Context, week: dict) -> None:
+async def publish_entries(context: commands.Context,
+                          week: dict,
+                          start: int = 1) -> None:
     """
     Actually posts the entries of the chosen week into the proper channel.
+
+    Entrants are looked up all at once, and each entry's files are read
+    while the ones before it are being sent. The posts themselves go out one
+    at a time, in order; discord.py waits out Discord's rate limits between
+    them. Progress is reported to whoever ran the command, along with how to
+    continue from entry `start` onwards if it's interrupted.
     """
-    async with context.channel.typing():
-        for entry in week["entries"]:
-            try:
-                if not compo.entry_valid(entry):
-                    continue
+    entries = [e for e in week["entries"] if compo.entry_valid(e)]
+
+    if not 1 <= start <= len(entries):
+        await context.send("There are %d entries to post, so start from "
+                           "somewhere between 1 and %d." %
+                           (len(entries), len(entries)))
+        return
+
+    entries = entries[start - 1:]
+    mentions = await fetch_entrant_mentions(entries)
 
+    # Files are read a few entries ahead, but not all at once
+    prepared = asyncio.Queue(maxsize=publish_prepare_ahead)
 
-                discord_user = client.get_user(entry["discordID"])
-                # get_user relies on cache, so if it's not cached, let's try to
-                # get it from the API (which should also cache it afaik)
-                if discord_user is None:
+    async def prepare_posts() -> None:
+        loop = asyncio.get_running_loop()
+        for entry in entries:
+            try:
+                posts = await loop.run_in_executor(
+                    None, prepare_entry_posts, entry,
+                    mentions[entry["discordID"]])
+            except Exception as e:
+                posts = e
+            await prepared.put(posts)
+
+    preparer = asyncio.ensure_future(prepare_posts())
+    progress = PublishProgress(context, start, start + len(entries) - 1)
+
+    try:
+        async with context.channel.typing():
+            for number in range(start, start + len(entries)):
+                posts = await prepared.get()
+                try:
+                    if isinstance(posts, Exception):
+                        raise posts
+
+                    for message, files in posts:
+                        await context.send(message, files=files)
+                except Exception as e:
+                    logging.error("DISCORD: Failed to upload entry %d: %s" %
+                                  (number, str(e)))
+                    await context.send("(Failed to upload this entry!)")
+                    progress.failed.append(number)
+
+                await progress.posted(number)
+    finally:
+        preparer.cancel()
+
+        # Close files that were opened for posts that never went out
+        while not prepared.empty():
+            posts = prepared.get_nowait()
+            if not isinstance(posts, Exception):
+                for _, files in posts:
+                    for upload_file in files:
+                        upload_file.close()
+
+    await progress.done()
+
+
+async def fetch_entrant_mentions(entries: list) -> dict:
+    """
+    Works out how to ping each entrant, fetching users that aren't cached
+    from the API a few at a time.
+
+    Returns
+    -------
+    dict
+        {Discord ID: mention}
+    """
+    semaphore = asyncio.Semaphore(publish_fetch_limit)
+
+    async def mention(entry: dict) -> tuple:
+        discord_user = client.get_user(entry["discordID"])
+        # get_user relies on cache, so if it's not cached, let's try to
+        # get it from the API (which should also cache it afaik)
+        if discord_user is None:
+            async with semaphore:
+                try:
                     discord_user = await client.fetch_user(entry["discordID"])
+                except discord.HTTPException:
+                    discord_user = None
+
+        if discord_user is None:
+            return entry["discordID"], "@" + entry["entrantName"]
+        return entry["discordID"], discord_user.mention
 
-                if discord_user is None:
-                    entrant_ping = "@" + entry["entrantName"]
-                else:
-                    entrant_ping = discord_user.mention
+    return dict(await asyncio.gather(*[mention(e) for e in entries]))
 
-                upload_files = []
-                upload_message = "%s - %s" % (entrant_ping, entry["entryName"])
 
-                if "entryNotes" in entry:
-                    upload_message += "\n" + entry["entryNotes"]
+def prepare_entry_posts(entry: dict, entrant_ping: str) -> list:
+    """
+    Lays out the message(s) to post an entry in. Files are attached straight
+    from the blob store, so they're streamed from disk rather than copied
+    into memory.
 
-                if entry["mp3Format"] == "mp3":
-                    upload_files.append(
-                        discord.File(io.BytesIO(bytes(entry["mp3"])),
-                                     filename=entry["mp3Filename"]))
-                elif entry["mp3Format"] == "external":
-                    upload_message += "\n" + entry["mp3"]
+    Returns
+    -------
+    list
+        (message, files) for each message to send, in order
+    """
+    upload_message = "%s - %s" % (entrant_ping, entry["entryName"])
 
-                upload_files.append(
-                    discord.File(io.BytesIO(bytes(entry["pdf"])),
-                                 filename=entry["pdfFilename"]))
+    if "entryNotes" in entry:
+        upload_message += "\n" + entry["entryNotes"]
 
-                total_len = len(bytes(entry["pdf"]))
+    attachments = []
 
-                if entry["mp3Format"] == "mp3":
-                    total_len += len(bytes(entry["mp3"]))
+    if entry["mp3Format"] == "mp3":
+        attachments.append(("mp3", entry["mp3Filename"]))
+    elif entry["mp3Format"] == "external":
+        upload_message += "\n" + entry["mp3"]
 
-                # 8MB limit
-                if total_len < 8000 * 1000 or entry["mp3Format"] != "mp3":
-                    await context.send(upload_message, files=upload_files)
-                else:
-                    # Upload mp3 and pdf separately if they're too big together
-                    await context.send(upload_message, files=[upload_files[0]])
-                    await context.send("", files=[upload_files[1]])
+    attachments.append(("pdf", entry["pdfFilename"]))
 
-            except Exception as e:
-                logging.error("DISCORD: Failed to upload entry: %s" % str(e))
-                await context.send("(Failed to upload this entry!)")
-                continue
+    # Make sure every file is there before opening any of them
+    paths = [
+        compo.get_entry_file_path(entry, field) for field, _ in attachments
+    ]
+    for (field, _), path in zip(attachments, paths):
+        if path is None:
+            raise FileNotFoundError("The %s file is missing" % field)
+
+    total_len = sum(
+        compo.get_entry_file_size(entry, field) for field, _ in attachments)
+
+    upload_files = [
+        discord.File(path, filename=filename)
+        for path, (_, filename) in zip(paths, attachments)
+    ]
+
+    # 8MB limit
+    if total_len < 8000 * 1000 or entry["mp3Format"] != "mp3":
+        return [(upload_message, upload_files)]
+
+    # Upload mp3 and pdf separately if they're too big together
+    return [(upload_message, [upload_files[0]]), ("", [upload_files[1]])]
+
+
+class PublishProgress:
+    """
+    Keeps whoever is posting entries up to date, in a DM that's edited as
+    entries go out.
+    """
+
+    def __init__(self, context: commands.Context, first: int, last: int):
+        self.context = context
+        self.first = first
+        self.last = last
+        self.failed = []
+        self.message = None
+        self.reported = None
+
+    def text(self, number: int) -> str:
+        text = "Posted entries %d-%d of %d" % (self.first, number, self.last)
+        if self.failed:
+            text += " (failed: %s)" % ", ".join(map(str, self.failed))
+        return text
+
+    async def posted(self, number: int) -> None:
+        logging.info("DISCORD: Posted entry %d of %d" % (number, self.last))
+
+        if (self.reported is not None and number != self.last
+                and number - self.reported < publish_progress_every):
+            return
+        self.reported = number
+
+        try:
+            if self.message is None:
+                self.message = await self.context.author.send(
+                    self.text(number))
+            else:
+                await self.message.edit(content=self.text(number))
+        except discord.HTTPException as e:
+            logging.warning("DISCORD: Couldn't report progress: %s" % str(e))
+
+    async def done(self) -> None:
+        if not self.failed:
+            return
+
+        await self.context.author.send(
+            "Some entries failed to post. To try again from the first one, "
+            "use `%s%s %d`." % (self.context.prefix,
+                                self.context.invoked_with, self.failed[0]))
 
 
 @client.command()
@@ -388,6 +616,64 @@ async def manage(context: commands.Context) -> None:
     url = "%s/admin/%s" % (config.url_prefix, key)
     await context.send("Admin interface: " + url + expiry_message())
 
+@client.command()
+@commands.check(is_admin)
+@commands.dm_only()
+async def revoke(context: commands.Context, key: str) -> None:
+    """Invalidates a link or key before it expires"""
+    # Accept whole links too
+    key = key.rstrip("/").split("/")[-1]
+
+    if keys.revoke_key(key):
+        await context.send("Revoked.")
+    else:
+        await context.send("That isn't a key I can revoke.")
+
+
+@client.command()
+@commands.check(is_admin)
+@commands.dm_only()
+async def profile(context: commands.Context, seconds: float = 30) -> None:
+    """Profiles the server for a while and sends the results"""
+    await context.send("Profiling for %g seconds..." %
+                       min(seconds, profiling.max_profile_seconds))
+
+    try:
+        profiler = await profiling.profile_for(seconds)
+    except profiling.ProfilerBusyError:
+        await context.send("A profile is already running.")
+        return
+
+    name = "wvote-%s" % time.strftime("%Y%m%d-%H%M%S")
+    await context.send(
+        "Done. Open the .pstats file with `python -m pstats` or snakeviz.",
+        files=[
+            discord.File(io.BytesIO(profiling.pstats_bytes(profiler)),
+                         filename=name + ".pstats"),
+            discord.File(io.BytesIO(
+                profiling.pstats_text(profiler).encode()),
+                         filename=name + ".txt"),
+        ])
+
+
+@client.command()
+@commands.check(is_admin)
+@commands.dm_only()
+async def heap(context: commands.Context, action: str = None) -> None:
+    """Sends the lines holding the most memory (`stop` to stop tracing)"""
+    if action == "stop":
+        if profiling.stop_heap_tracing():
+            await context.send("Stopped tracing allocations.")
+        else:
+            await context.send("Allocations weren't being traced.")
+        return
+
+    name = "wvote-heap-%s.txt" % time.strftime("%Y%m%d-%H%M%S")
+    await context.send(file=discord.File(io.BytesIO(
+        profiling.heap_snapshot().encode()),
+                                         filename=name))
+
+
 @client.command()
 async def howareyou(context: commands.Context) -> None:
     """important for spinda's silly joke"""
@@ -415,18 +701,21 @@ async def submit(context: commands.Context) -> None:
         await context.send(closed_info)
         return
 
-    for entry in week["entries"]:
-        if entry["discordID"] == context.author.id:
-            key = keys.create_edit_key(entry["uuid"])
-            url = "%s/edit/%s" % (config.url_prefix, key)
-            edit_info = ("Link to edit your existing "
-                         "submission: " + url + expiry_message())
-            await context.send(edit_info)
-            return
+    entry = compo.find_entry_by_discord_id(week, context.author.id)
+    if entry is not None:
+        key = keys.create_edit_key(entry["uuid"])
+        url = "%s/edit/%s" % (config.url_prefix, key)
+        edit_info = ("Link to edit your existing "
+                     "submission: " + url + expiry_message())
+        await context.send(edit_info)
+        return
 
     new_entry = compo.create_blank_entry(context.author.name,
                                          context.author.id)
-    week["entries"].append(new_entry)
+    compo.add_entry(week, new_entry)
+    compo.schedule_save()
+    # The link has to work on the HTTP server straight away
+    await compo.wait_for_save()
     key = keys.create_edit_key(new_entry["uuid"])
     url = "%s/edit/%s" % (config.url_prefix, key)
 
@@ -588,10 +877,10 @@ async def status(context: commands.Context) -> None:
 
     week = compo.get_week(True)
 
-    for entry in week["entries"]:
-        if entry["discordID"] == context.author.id:
-            await context.send(entry_info_message(entry))
-            return
+    entry = compo.find_entry_by_discord_id(week, context.author.id)
+    if entry is not None:
+        await context.send(entry_info_message(entry))
+        return
 
     await context.send("You haven't submitted anything yet! "
                        "But if you want to you can with %ssubmit !" %
@@ -611,24 +900,18 @@ async def myresults(context: commands.Context) -> None:
         )
         return
 
-    user_entry = None
-
     if context.author.id in config.results_blacklist:
         await context.send("Sorry but I'm too sleeby to calculate results")
         return
 
-
-    for entry in week["entries"]:
-        if entry["discordID"] == context.author.id:
-            user_entry = entry
-            break
+    user_entry = compo.find_entry_by_discord_id(week, context.author.id)
 
     if not user_entry:
         await context.send("You didn't submit anything for this week!")
         return
 
-    compo.verify_votes(week)
-    scores = compo.fetch_votes_for_entry(week["votes"], entry["uuid"])
+    scores = compo.fetch_votes_for_entry(week["votes"].values(),
+                                        user_entry["uuid"])
 
     if len(scores) == 0:
         await context.send(
@@ -665,9 +948,10 @@ async def myresults(context: commands.Context) -> None:
 async def closevoting(context: commands.Context) -> None:
     week = compo.get_week(False)
     week["votingOpen"] = False
+    compo.schedule_save()
+    await compo.wait_for_save()
 
     await context.send("Voting for the current week is now closed.")
-    compo.save_weeks()
 
 
 @client.command()
@@ -675,9 +959,10 @@ async def closevoting(context: commands.Context) -> None:
 async def openvoting(context: commands.Context) -> None:
     week = compo.get_week(False)
     week["votingOpen"] = True
+    compo.schedule_save()
+    await compo.wait_for_save()
 
     await context.send("Voting for the current week is now open.")
-    compo.save_weeks()
 
 
 @client.command()
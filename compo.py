@@ -3,13 +3,81 @@
 import datetime
 import uuid
 import logging
-import statistics
-from typing import Optional
+from typing import Iterable, Optional
 import pickle
+import json
+import os
+import asyncio
+import tempfile
+
+import blobs
+import ipc
+import metrics
+import tally
+import sqlite_store
+from config import config
 
 current_week = None
 next_week = None
 
+# The SQLiteStore in use when config.storage_backend is "sqlite"
+database = None
+
+# Lookup tables over the entries of the weeks in use, most recently built
+# last; see entry_index(). They're matched to their week by identity rather
+# than id(), which a new week could reuse once an old one is gone.
+entry_indexes = []
+
+# How many weeks' lookup tables are kept before the oldest are dropped, so
+# weeks that were never explicitly forgotten don't stay in memory for good
+max_entry_indexes = 4
+
+# Results for the week they were tallied for, kept up to date as ballots
+# come and go: {"week": week, "pool": [uuid, ...], "tally": LiveTally}
+live_results = None
+
+# Ballots cast since the last full save of the current week are appended
+# here, one JSON record per line, so that a vote doesn't rewrite the week.
+journal_filename = "weeks/current-week.journal"
+journal_records = 0
+
+# Once this many records pile up in the journal, it's folded back into
+# current-week.pickle by a full save.
+journal_compact_threshold = 500
+
+# How long schedule_save() waits for more changes before writing, so that a
+# burst of edits turns into a single write.
+save_delay = 1.0
+
+saves_requested = 0
+saves_completed = 0
+
+# Goes up whenever an entry or week setting changes (that is, on every
+# `schedule_save()`), so responses built from a week can be cached until then.
+# Ballots don't count.
+week_version = 0
+save_task = None
+flush_requested = None
+
+# Set when other processes share the database (see main.py): changes are
+# then saved as soon as they're made, instead of after `save_delay`, so that
+# there's never anything unsaved to lose when they reload the weeks.
+write_through = False
+
+# In `write_through` mode, the weeks as `schedule_save()` last found them,
+# waiting for the save worker to write them. They're snapshotted right away,
+# since the weeks may be reloaded from the database before the write.
+write_through_snapshot = None
+
+# The database's data_version when the weeks were last loaded from it. With
+# `write_through` set, the weeks are reloaded once it's moved on, meaning
+# another process has written to the database since.
+loaded_data_version = None
+
+# The database's versions (see SQLiteStore.versions) the loaded weeks are up
+# to date with. When only "ballots" moved on, just the ballots are reloaded.
+loaded_versions = None
+
 
 def blank_week() -> dict:
     return {
@@ -18,7 +86,7 @@ def blank_week() -> dict:
         "submissionsOpen": True,
         "votingOpen": True,
         "entries": [],
-        "votes": [],
+        "votes": {},
         "voteParams": ["prompt", "score", "overall"],
         "helpTipDefs": {
             "prompt": {
@@ -69,32 +137,560 @@ def get_week(get_next_week: bool) -> dict:
     """
     global current_week, next_week
 
+    db = get_database()
+    if db is not None:
+        if (write_through and current_week is not None
+                and db.data_version() != loaded_data_version):
+            catch_up_with_database(db)
+
+        if current_week is None or next_week is None:
+            with metrics.week_load_seconds.time(backend="sqlite"):
+                load_weeks_from_database(db)
+        return next_week if get_next_week else current_week
+
+    if current_week is None or next_week is None:
+        with metrics.week_load_seconds.time(backend="pickle"):
+            load_weeks_from_pickles()
+
+    return next_week if get_next_week else current_week
+
+
+def load_weeks_from_pickles() -> None:
+    global current_week, next_week
+
     if current_week is None:
         try:
             current_week = pickle.load(open("weeks/current-week.pickle", "rb"))
         except FileNotFoundError:
             current_week = blank_week()
             current_week["submissions_open"] = False
+        externalize_files(current_week)
+        index_votes(current_week)
+        verify_votes(current_week)
+        # Journaled ballots were already validated when they came in
+        replay_journal(current_week)
 
     if next_week is None:
         try:
             next_week = pickle.load(open("weeks/next-week.pickle", "rb"))
         except FileNotFoundError:
             next_week = blank_week()
+        externalize_files(next_week)
+        index_votes(next_week)
+        verify_votes(next_week)
 
-    return next_week if get_next_week else current_week
+
+def get_database() -> Optional[sqlite_store.SQLiteStore]:
+    """
+    Returns the SQLite store if the config selects the "sqlite" backend,
+    opening it on first use, or None when using pickles.
+    """
+    global database
+
+    if config.storage_backend != "sqlite":
+        return None
+
+    if database is None:
+        database = sqlite_store.SQLiteStore(config.sqlite_path)
+        logging.info("COMPO: Using SQLite database %s" % config.sqlite_path)
+
+    return database
+
+
+def load_weeks_from_database(db: sqlite_store.SQLiteStore) -> None:
+    global current_week, next_week, loaded_data_version, loaded_versions
+
+    # Taken first, so a change made while reading still gets noticed
+    loaded_data_version = db.data_version()
+    loaded_versions = db.versions()
+
+    current_week = db.load_week("current")
+    next_week = db.load_week("next")
+
+    created = current_week is None or next_week is None
+
+    if current_week is None:
+        current_week = blank_week()
+        current_week["submissions_open"] = False
+    if next_week is None:
+        next_week = blank_week()
+
+    verify_votes(current_week)
+    verify_votes(next_week)
+
+    if created:
+        # Make sure both weeks have rows before any ballots come in. That
+        # counts as a change to the weeks, but not one to reload them for.
+        write_snapshot(snapshot_weeks())
+        loaded_versions = db.versions()
+
+
+def catch_up_with_database(db: sqlite_store.SQLiteStore) -> None:
+    """
+    Picks up what other processes wrote since the weeks were loaded. Both
+    weeks are reloaded if their entries or settings changed, but if only
+    ballots did, just the current week's ballots are.
+    """
+    global loaded_data_version
+
+    data_version = db.data_version()
+    versions = db.versions()
+
+    if versions["weeks"] != loaded_versions["weeks"]:
+        reload_weeks()
+        return
+
+    if versions["ballots"] != loaded_versions["ballots"]:
+        current_week["votes"] = db.load_ballots("current")
+        invalidate_live_results()
+        loaded_versions["ballots"] = versions["ballots"]
+
+    loaded_data_version = data_version
 
 
 def save_weeks() -> None:
     """
     Saves `current_week` and `next_week` into pickle objects so that they can
     later be read again.
+
+    This blocks until the data is on disk; code running on the event loop
+    should use `schedule_save()` instead.
+
+    Changes must be saved before anything awaits: `reload_weeks()` may run
+    in the meantime and drop them, in which case nothing is saved and a
+    warning is logged.
     """
-    if current_week is not None and next_week is not None:
-        pickle.dump(current_week, open("weeks/current-week.pickle", "wb"))
-        pickle.dump(next_week, open("weeks/next-week.pickle", "wb"))
+    if not weeks_loaded_for_save():
+        return
+
+    write_snapshot(snapshot_weeks())
+    log_save()
+    notify_peers()
+
+    # Everything in the journal is part of the snapshot now
+    if get_database() is None:
+        truncate_journal()
+
+
+def weeks_loaded_for_save() -> bool:
+    if current_week is None or next_week is None:
+        logging.warning("COMPO: Weeks were reloaded before they could be "
+                        "saved; any changes made to them were lost")
+        return False
+    return True
+
+
+def log_save() -> None:
+    if get_database() is None:
         logging.info(
             "COMPO: current-week.pickle and next-week.pickle overwritten")
+    else:
+        logging.info("COMPO: Current and next week saved to SQLite")
+
+
+def notify_peers() -> None:
+    """Tells other processes sharing the database to reload the weeks."""
+    if get_database() is not None:
+        ipc.send({"type": "weeks_changed"})
+
+
+def ballot_saved(record: dict, version: int) -> None:
+    """
+    Tells other processes sharing the database about a ballot record (see
+    `apply_vote_record`) this one just saved as the "ballots" `version`,
+    which is much cheaper for them than reloading.
+    """
+    # If another process's ballot came in between, it hasn't been seen, so
+    # the ballots will be reloaded after all
+    if loaded_versions is not None and \
+            loaded_versions["ballots"] == version - 1:
+        loaded_versions["ballots"] = version
+
+    ipc.send({"type": "ballot", "record": record, "version": version})
+
+
+def apply_peer_ballot(record: dict, version: int) -> None:
+    """
+    Applies a ballot record another process saved as the "ballots" `version`
+    to the current week.
+
+    It's skipped if the week isn't loaded (it'll be read with the ballot),
+    already has it, or is missing an earlier one; in that last case the
+    ballots are reloaded the next time the week is needed.
+    """
+    if current_week is None or loaded_versions is None:
+        return
+    if loaded_versions["ballots"] != version - 1:
+        return
+
+    apply_vote_record(current_week, record)
+    loaded_versions["ballots"] = version
+
+
+def reload_weeks() -> None:
+    """
+    Forgets the weeks held in memory, so they're read back from the database
+    the next time they're needed. For when another process changed them.
+    """
+    global current_week, next_week, week_version
+
+    for week in [current_week, next_week]:
+        if week is not None:
+            forget_entry_index(week)
+    invalidate_live_results()
+
+    current_week = None
+    next_week = None
+
+    # Cached responses were built from the old weeks
+    week_version += 1
+
+
+def snapshot_weeks() -> dict:
+    """
+    Serializes both weeks, so that they can be written out while the event
+    loop carries on changing them.
+    """
+    db = get_database()
+    if db is not None:
+        return db.snapshot({"current": current_week, "next": next_week})
+
+    return {
+        "weeks/current-week.pickle": pickle.dumps(week_for_disk(current_week)),
+        "weeks/next-week.pickle": pickle.dumps(week_for_disk(next_week)),
+    }
+
+
+def index_votes(week: dict) -> None:
+    """
+    Turns the list of ballots a week is saved with into the mapping it's
+    kept in while running: {voter's user ID (as an int): ballot}, in the
+    order the ballots were cast.
+    """
+    if not isinstance(week["votes"], list):
+        return
+
+    votes = {}
+    for vote in week["votes"]:
+        user_id = int(vote["userID"])
+        # If a voter somehow shows up twice, their last ballot wins
+        votes.pop(user_id, None)
+        votes[user_id] = vote
+
+    week["votes"] = votes
+
+
+def week_for_disk(week: dict) -> dict:
+    """
+    Returns a shallow copy of a week with its ballots as a list, which is
+    how they've always been pickled.
+    """
+    return dict(week, votes=list(week["votes"].values()))
+
+
+def write_file_atomic(filename: str, data: bytes) -> None:
+    """
+    Writes `data` to a temporary file next to `filename`, then renames it
+    into place, so that a crash never leaves a half-written file behind.
+    """
+    fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                         suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.unlink(temp_filename)
+        raise
+
+
+def write_snapshot(snapshot: dict) -> None:
+    with metrics.save_seconds.time():
+        db = get_database()
+        if db is not None:
+            db.write_snapshot(snapshot)
+            metrics.save_bytes.inc(
+                sum(
+                    len(data) + sum(len(entry[3]) for entry in entries)
+                    for data, entries in snapshot.values()))
+            return
+
+        for filename, data in snapshot.items():
+            write_file_atomic(filename, data)
+        metrics.save_bytes.inc(sum(len(data) for data in snapshot.values()))
+
+
+def schedule_save() -> None:
+    """
+    Marks the weeks as changed. They'll be saved by a background worker
+    after `save_delay` seconds, together with any other changes made in the
+    meantime. The actual disk write happens in a thread, off the event loop.
+
+    In `write_through` mode they're written straight away instead; await
+    `wait_for_save()` before telling anyone about the change.
+
+    If there's no event loop running, saves right away instead.
+    """
+    global week_version, write_through_snapshot, saves_requested
+
+    week_version += 1
+
+    if not write_through:
+        request_save()
+        return
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        save_weeks()
+        return
+
+    if not weeks_loaded_for_save():
+        return
+
+    write_through_snapshot = snapshot_weeks()
+    saves_requested += 1
+    start_save_worker(loop)
+    flush_requested.set()
+
+
+def request_save() -> None:
+    """
+    Gets the weeks saved like `schedule_save()`, without marking them as
+    changed. For when only the ballots, which are saved separately, have.
+    """
+    global saves_requested
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        save_weeks()
+        return
+
+    saves_requested += 1
+    start_save_worker(loop)
+
+
+async def wait_for_save() -> None:
+    """
+    In `write_through` mode, waits until the changes marked so far are in
+    the database, where other processes can see them. Otherwise returns
+    right away, leaving them to be saved after `save_delay`.
+    """
+    if write_through:
+        await flush()
+
+
+async def flush() -> None:
+    """
+    Waits until every change marked by `schedule_save()` so far is on disk.
+    Raises whatever error the write failed with, if it did.
+    """
+    target = saves_requested
+
+    while saves_completed < target:
+        start_save_worker(asyncio.get_running_loop())
+        flush_requested.set()
+        await asyncio.shield(save_task)
+
+
+def start_save_worker(loop: asyncio.AbstractEventLoop) -> None:
+    global save_task, flush_requested
+
+    if save_task is None:
+        flush_requested = asyncio.Event()
+        save_task = loop.create_task(save_worker())
+
+
+async def save_worker() -> None:
+    global saves_completed, journal_records, save_task, write_through_snapshot
+
+    loop = asyncio.get_running_loop()
+
+    try:
+        while saves_completed < saves_requested:
+            try:
+                await asyncio.wait_for(flush_requested.wait(), save_delay)
+            except asyncio.TimeoutError:
+                pass
+            flush_requested.clear()
+
+            generation = saves_requested
+
+            if write_through_snapshot is not None:
+                snapshot = write_through_snapshot
+                write_through_snapshot = None
+            elif current_week is None or next_week is None:
+                saves_completed = saves_requested
+                break
+            else:
+                # Snapshot on the loop, so nothing changes halfway through
+                # pickling
+                snapshot = snapshot_weeks()
+
+            # Note how much of the journal the snapshot covers
+            journal_offset = journal_size()
+            snapshot_records = journal_records
+
+            await loop.run_in_executor(None, write_snapshot, snapshot)
+            log_save()
+            notify_peers()
+
+            # Ballots journaled while the snapshot was being written aren't
+            # part of it, so only drop the part of the journal that is
+            trim_journal(journal_offset)
+            journal_records -= snapshot_records
+
+            saves_completed = generation
+    except Exception:
+        logging.exception("COMPO: Failed to save weeks")
+        raise
+    finally:
+        save_task = None
+
+
+def apply_vote_record(week: dict, record: dict) -> None:
+    """
+    Applies a single ballot upsert or deletion to a week.
+
+    Parameters
+    ----------
+    week : dict
+        The week the ballot belongs to
+    record : dict
+        Either {"op": "upsert", "vote": {...}} to add or replace a user's
+        ballot, or {"op": "delete", "userID": ...} to remove it.
+    """
+    if record["op"] == "upsert":
+        user_id = int(record["vote"]["userID"])
+    else:
+        user_id = int(record["userID"])
+
+    # Replacing a ballot moves it to the end, same as casting a new one
+    week["votes"].pop(user_id, None)
+
+    if record["op"] == "upsert":
+        week["votes"][user_id] = record["vote"]
+
+    if live_results is not None and live_results["week"] is week:
+        if record["op"] == "upsert":
+            live_results["tally"].add(user_id, record["vote"])
+        else:
+            live_results["tally"].remove(user_id)
+
+
+def append_to_journal(record: dict) -> None:
+    """
+    Appends a ballot record to the journal, and compacts the journal into
+    a full save once it grows past `journal_compact_threshold` records.
+    """
+    global journal_records
+
+    with open(journal_filename, "a") as journal:
+        journal.write(json.dumps(record) + "\n")
+
+    journal_records += 1
+
+    if journal_records >= journal_compact_threshold:
+        logging.info("COMPO: Compacting vote journal")
+        request_save()
+
+
+def replay_journal(week: dict) -> None:
+    """
+    Re-applies every ballot record in the journal to a freshly loaded
+    current week. A torn final line (from a crash mid-append) is cut off the
+    journal, so that records appended after it aren't joined onto it.
+    """
+    global journal_records
+
+    journal_records = 0
+
+    try:
+        journal = open(journal_filename, "rb")
+    except FileNotFoundError:
+        return
+
+    # The end of the last whole record
+    good_size = 0
+
+    with journal:
+        for line in journal:
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("Unterminated record")
+                record = json.loads(line)
+            except ValueError:
+                logging.warning("COMPO: Dropping torn journal record")
+                break
+
+            apply_vote_record(week, record)
+            journal_records += 1
+            good_size += len(line)
+
+    if good_size < journal_size():
+        os.truncate(journal_filename, good_size)
+
+    if journal_records:
+        logging.info("COMPO: Replayed %d journaled ballots" % journal_records)
+
+
+def truncate_journal() -> None:
+    global journal_records
+
+    open(journal_filename, "w").close()
+    journal_records = 0
+
+
+def journal_size() -> int:
+    try:
+        return os.path.getsize(journal_filename)
+    except FileNotFoundError:
+        return 0
+
+
+def trim_journal(offset: int) -> None:
+    """Drops the first `offset` bytes of the journal."""
+    try:
+        with open(journal_filename, "rb") as journal:
+            journal.seek(offset)
+            remainder = journal.read()
+    except FileNotFoundError:
+        return
+
+    if remainder:
+        write_file_atomic(journal_filename, remainder)
+    else:
+        open(journal_filename, "w").close()
+
+
+def upsert_vote(vote: dict) -> None:
+    """
+    Adds a ballot to the current week, replacing any earlier ballot by the
+    same user, and journals it.
+    """
+    record = {"op": "upsert", "vote": vote}
+    apply_vote_record(get_week(False), record)
+
+    db = get_database()
+    if db is not None:
+        ballot_saved(record, db.upsert_ballot("current", vote))
+    else:
+        append_to_journal(record)
+
+
+def delete_vote(user_id) -> None:
+    """Removes a user's ballot from the current week, and journals it."""
+    record = {"op": "delete", "userID": int(user_id)}
+    apply_vote_record(get_week(False), record)
+
+    db = get_database()
+    if db is not None:
+        ballot_saved(record, db.delete_ballot("current", int(user_id)))
+    else:
+        append_to_journal(record)
 
 
 def move_to_next_week() -> None:
@@ -102,18 +698,30 @@ def move_to_next_week() -> None:
     Replaces `current_week` with `next_week`, freeing up `next_week` to be
     replaced with new information.
 
-    Calls `save_weeks()` to serialize the data after modification.
+    Calls `schedule_save()` to serialize the data after modification; await
+    `flush()` afterwards to make sure it's on disk.
     """
     global current_week, next_week
 
-    archive_filename = "weeks/archive/" + \
-        datetime.datetime.now().strftime("%m-%d-%y") + ".pickle"
-    pickle.dump(current_week, open(archive_filename, "wb"))
+    archive_name = datetime.datetime.now().strftime("%m-%d-%y")
+
+    db = get_database()
+    if db is not None:
+        # Save first, so the archived week's row holds its final state
+        save_weeks()
+        db.archive_week(archive_name)
+    else:
+        archive_filename = "weeks/archive/" + archive_name + ".pickle"
+        with open(archive_filename, "wb") as archive_file:
+            pickle.dump(week_for_disk(current_week), archive_file)
+
+    forget_entry_index(current_week)
+    invalidate_live_results()
 
     current_week = next_week
     next_week = blank_week()
 
-    save_weeks()
+    schedule_save()
 
 
 def create_blank_entry(entrant_name: str, discord_id: int) -> dict:
@@ -140,12 +748,99 @@ def create_blank_entry(entrant_name: str, discord_id: int) -> dict:
     }
 
 
-def find_entry_by_uuid(uuid: str) -> Optional[dict]:
+def entry_index(week: dict) -> dict:
+    """
+    Returns the lookup tables over a week's entries, building them if needed.
+
+    They're kept up to date by `add_entry` and `remove_entry`. Code that
+    adds entries to or removes them from the list any other way must call
+    `forget_entry_index` afterwards.
+
+    Returns
+    -------
+    dict
+        {"week": week, "uuid": {uuid: entry}, "discordID": {id: entry}}.
+        When several entries share a UUID or Discord ID, the first one is
+        indexed.
+    """
+    for index in entry_indexes:
+        if index["week"] is week:
+            return index
+
+    index = {"week": week, "uuid": {}, "discordID": {}}
+    for entry in week["entries"]:
+        index["uuid"].setdefault(entry["uuid"], entry)
+        index["discordID"].setdefault(entry["discordID"], entry)
+
+    entry_indexes.append(index)
+    del entry_indexes[:-max_entry_indexes]
+
+    return index
+
+
+def forget_entry_index(week: dict) -> None:
+    """Drops the lookup tables of a week that's going away or was changed."""
+    entry_indexes[:] = [
+        index for index in entry_indexes if index["week"] is not week
+    ]
+
+
+def add_entry(week: dict, entry: dict) -> None:
+    """Adds an entry to the end of a week, and to its lookup tables."""
+    index = entry_index(week)
+
+    week["entries"].append(entry)
+    index["uuid"][entry["uuid"]] = entry
+    index["discordID"].setdefault(entry["discordID"], entry)
+
+
+def remove_entry(week: dict, entry: dict) -> None:
+    """Removes an entry from a week, and from its lookup tables."""
+    index = entry_index(week)
+
+    week["entries"].remove(entry)
+
+    if index["uuid"].get(entry["uuid"]) is entry:
+        del index["uuid"][entry["uuid"]]
+        # A duplicate UUID (from an old pickle) takes over, if there is one
+        for other in week["entries"]:
+            if other["uuid"] == entry["uuid"]:
+                index["uuid"][entry["uuid"]] = other
+                break
+
+    if index["discordID"].get(entry["discordID"]) is entry:
+        del index["discordID"][entry["discordID"]]
+        # Fall back to another entry by the same person, if there is one
+        for other in week["entries"]:
+            if other["discordID"] == entry["discordID"]:
+                index["discordID"][entry["discordID"]] = other
+                break
+
+
+def find_entry_and_week(uuid: str) -> tuple:
+    """
+    Finds an entry in either week.
+
+    Returns
+    -------
+    tuple
+        (week, entry), or (None, None) if there's no such entry.
+    """
     for which_week in [True, False]:
-        for entry in get_week(which_week)["entries"]:
-            if entry["uuid"] == uuid:
-                return entry
-    return None
+        week = get_week(which_week)
+        entry = entry_index(week)["uuid"].get(uuid)
+        if entry is not None:
+            return week, entry
+    return None, None
+
+
+def find_entry_by_uuid(uuid: str) -> Optional[dict]:
+    return find_entry_and_week(uuid)[1]
+
+
+def find_entry_by_discord_id(week: dict, discord_id: int) -> Optional[dict]:
+    """Returns the entry a Discord user submitted to a week, if any."""
+    return entry_index(week)["discordID"].get(discord_id)
 
 
 def entry_valid(entry: dict) -> bool:
@@ -170,39 +865,170 @@ def count_valid_entries(week: dict) -> int:
     return len([e for e in week["entries"] if entry_valid(e)])
 
 
+def set_entry_file(entry: dict, field: str, data: bytes) -> None:
+    """
+    Stores an uploaded file in the blob store and points the entry at it.
+
+    Parameters
+    ----------
+    entry : dict
+        The entry the file belongs to
+    field : str
+        Either "mp3" or "pdf"
+    data : bytes
+        The contents of the file
+    """
+    set_entry_blob(entry, field, blobs.put(data), len(data))
+
+
+def set_entry_blob(entry: dict, field: str, digest: str, size: int) -> None:
+    """Points an entry's "mp3" or "pdf" at a file already in the blob store.
+    """
+    entry[field] = digest
+    entry[field + "Size"] = size
+
+
+def get_entry_file_path(entry: dict, field: str) -> Optional[str]:
+    """Returns where an entry's "mp3" or "pdf" file is in the blob store, or
+       None if the entry doesn't have that file.
+    """
+    if field == "mp3" and entry.get("mp3Format") != "mp3":
+        return None
+
+    digest = entry.get(field)
+    if not blobs.is_digest(digest):
+        return None
+
+    path = blobs.blob_path(digest)
+    if not os.path.exists(path):
+        return None
+
+    return path
+
+
+def get_entry_file_size(entry: dict, field: str) -> Optional[int]:
+    """Returns the size of an entry's "mp3" or "pdf" file, from what was
+       noted when it was stored if possible.
+    """
+    size = entry.get(field + "Size")
+    if size:
+        return size
+
+    path = get_entry_file_path(entry, field)
+    return None if path is None else os.path.getsize(path)
+
+
+def externalize_files(week: dict) -> bool:
+    """
+    Moves file contents that are still stored inline in a week's entries
+    (as weeks saved before the blob store existed do) into the blob store.
+
+    Returns
+    -------
+    bool
+        True if any entry was changed.
+    """
+    changed = False
+
+    for entry in week["entries"]:
+        for field in ["mp3", "pdf"]:
+            data = entry.get(field)
+            if isinstance(data, (bytes, bytearray)):
+                set_entry_file(entry, field, bytes(data))
+                changed = True
+
+    if changed:
+        logging.info("COMPO: Moved inline entry files into the blob store")
+
+    return changed
+
+
 def get_entry_file(uuid: str, filename: str) -> tuple:
+    """
+    Looks up one of an entry's files by the name it was uploaded with.
+
+    Returns
+    -------
+    tuple
+        (blob digest, content type), or (None, None) if there's no such file
+    """
     entry = find_entry_by_uuid(uuid)
     if entry is None:
         return None, None
 
-    if "mp3Filename" in entry and entry["mp3Filename"] == filename:
+    if ("mp3Filename" in entry and entry["mp3Filename"] == filename
+            and entry.get("mp3Format") == "mp3" and entry.get("mp3")):
         return entry["mp3"], "audio/mpeg"
 
-    if "pdfFilename" in entry and entry["pdfFilename"] == filename:
+    if ("pdfFilename" in entry and entry["pdfFilename"] == filename
+            and entry.get("pdf")):
         return entry["pdf"], "application/pdf"
 
     return None, None
 
 
-def verify_votes(week: dict) -> None:
+def validate_ratings(ratings: list,
+                     vote_params: list,
+                     entry_uuids: Optional[Iterable[str]] = None) -> list:
+    """
+    Checks a single ballot's ratings in one pass, keeping the valid ones.
+
+    Parameters
+    ----------
+    ratings : list
+        The ratings as submitted
+    vote_params : list
+        The parameters that can be voted on this week
+    entry_uuids : Optional[Iterable[str]]
+        The entries that can be voted on, or None to allow any entry
+
+    Returns
+    -------
+    list
+        The ratings that are whole numbers from 0 to 5, on a known parameter
+        and entry, and not a repeat of an earlier rating of the same
+        parameter of the same entry. The rest are logged and dropped.
+    """
     # Makes sure a single user can only vote on the same parameter
     # for the same entry a single time
-    userVotes = set({})
-
-    # Validate data, and throw away sus ratings
-    for v in week["votes"]:
-        for r in v["ratings"]:
-            if (0 <= r["rating"] <= 5 and r["voteParam"] in week["voteParams"]
-                    and (v["userID"], r["entryUUID"], r["voteParam"])
-                    not in userVotes):
-                userVotes.add((v["userID"], r["entryUUID"], r["voteParam"]))
-            else:
-                logging.warning("COMPO: FRAUD DETECTED (CHECK VOTES)")
-                logging.warning(f"Sus rating: {str(r)}")
-                v["ratings"].remove(r)
+    seen = set()
+    valid_ratings = []
+
+    for r in ratings:
+        if (isinstance(r, dict) and type(r.get("rating")) is int
+                and 0 <= r["rating"] <= 5
+                and r.get("voteParam") in vote_params
+                and isinstance(r.get("entryUUID"), str)
+                and (entry_uuids is None or r["entryUUID"] in entry_uuids)
+                and (r["entryUUID"], r["voteParam"]) not in seen):
+            seen.add((r["entryUUID"], r["voteParam"]))
+            valid_ratings.append(r)
+        else:
+            logging.warning("COMPO: FRAUD DETECTED (CHECK VOTES)")
+            logging.warning(f"Sus rating: {str(r)}")
+
+    return valid_ratings
+
 
+def verify_votes(week: dict) -> bool:
+    """Throws away invalid and duplicate ratings. Returns True if any were
+       found.
 
-def normalize_votes(votes: list) -> dict:
+       New ballots are checked by `validate_ratings` as they come in, so this
+       only needs to run once over the ballots of a freshly loaded week.
+    """
+    changed = False
+
+    for v in week["votes"].values():
+        valid_ratings = validate_ratings(v["ratings"], week["voteParams"])
+        if len(valid_ratings) != len(v["ratings"]):
+            v["ratings"] = valid_ratings
+            changed = True
+
+    return changed
+
+
+def normalize_votes(votes: Iterable[dict]) -> dict:
     """Trim away 0-votes and normalize each user's scores
        into the 1-5 range.
     """
@@ -234,70 +1060,49 @@ def normalize_votes(votes: list) -> dict:
 
 
 def get_ranked_entrant_list(week: dict) -> list:
-    """Bloc STAR Voting wooooo"""
-
-    param_weights = {"prompt": 0.33, "score": 0.33, "overall": 0.33}
+    """Bloc STAR Voting wooooo
 
+       The tallying itself lives in tally.py.
+    """
     if len(week["entries"]) < 1:  # lol no one submitted
         return []
 
-    verify_votes(week)
-
-    scores = normalize_votes(week["votes"])
-
-    entry_pool = []
-    ranked_entries = []
-
-    # Write final scores to entry data, and put 'em all in entry_pool
-    for e in week["entries"]:
-        if entry_valid(e):
-            e["voteScore"] = statistics.mean(
-                score[0] for score in scores.get(e["uuid"], [(0, None)]))
-            entry_pool.append(e)
-
-    # Now that we have scores calculated, run the actual STAR algorithm
-    while len(entry_pool) > 1:
-        entry_pool = sorted(entry_pool,
-                            key=lambda e: e["voteScore"],
-                            reverse=True)
-
-        entryA = entry_pool[0]
-        entryB = entry_pool[1]
-
-        preferEntryA = 0
-        preferEntryB = 0
-
-        for v in week["votes"]:
-            # note that normalization doesn't matter for comparing preference
-            scoreA = sum(r["rating"] * param_weights[r["voteParam"]]
-                         for r in v["ratings"]
-                         if r["entryUUID"] == entryA["uuid"])
-            scoreB = sum(r["rating"] * param_weights[r["voteParam"]]
-                         for r in v["ratings"]
-                         if r["entryUUID"] == entryB["uuid"])
-
-            if scoreA > scoreB:
-                preferEntryA += 1
-            elif scoreB > scoreA:
-                preferEntryB += 1
-
-        # greater than or equal to, as entryA is the entry with a higher score,
-        # to settle things in the case of a tie
-        if preferEntryA >= preferEntryB:
-            ranked_entries.append(entry_pool.pop(0))
-        else:
-            ranked_entries.append(entry_pool.pop(1))
+    with metrics.tally_seconds.time():
+        return get_live_tally(week).ranking()
+
+
+def get_live_tally(week: dict) -> tally.LiveTally:
+    """
+    Returns the live tally for a week, counting every ballot from scratch
+    if there isn't one yet or the set of valid entries has changed since.
+    Afterwards, `apply_vote_record` keeps it up to date.
+    """
+    global live_results
+
+    entry_pool = [e for e in week["entries"] if entry_valid(e)]
+    pool_uuids = [e["uuid"] for e in entry_pool]
+
+    if (live_results is None or live_results["week"] is not week
+            or live_results["pool"] != pool_uuids):
+        live_tally = tally.LiveTally(entry_pool)
+        for user_id, vote in week["votes"].items():
+            live_tally.add(user_id, vote)
+
+        live_results = {"week": week, "pool": pool_uuids, "tally": live_tally}
+
+    # Scores get written onto whichever entry dicts the week holds now
+    live_results["tally"].pool = entry_pool
+
+    return live_results["tally"]
 
-    # Add the one remaining entry
-    ranked_entries.append(entry_pool.pop(0))
 
-    for place, e in enumerate(ranked_entries):
-        e["votePlacement"] = place + 1
+def invalidate_live_results() -> None:
+    global live_results
 
-    return list(reversed(ranked_entries))
+    live_results = None
 
 
-def fetch_votes_for_entry(votes: list, entry_uuid: str) -> list:
+def fetch_votes_for_entry(votes: Iterable[dict], entry_uuid: str) -> list:
     """List all non-zero votes for an entry"""
 
     return [
@@ -36,6 +36,13 @@ class DefaultConfig:
     http_port: int = 8251
     """The port to use for the HTTP server"""
 
+    http_workers: int = 1
+    """
+    How many HTTP server processes `main.py http` starts, all sharing
+    `http_port`. More than one needs the same setup as running the HTTP
+    server and bot separately.
+    """
+
     timezone_offset: float = 0
     """I can't remember what's up with this lmao"""
 
@@ -51,6 +58,53 @@ class DefaultConfig:
     allowed_hosts: Sequence[str] = ("https://soundcloud.com/", "https://clyp.it/")
     """Links for embedding playback, I'm pretty sure"""
 
+    storage_backend: str = "pickle"
+    """
+    Where weeks are stored: "pickle" for weeks/*.pickle, or "sqlite" for the
+    database at `sqlite_path` (see migrate_to_sqlite.py to move over)
+    """
+
+    sqlite_path: str = "weeks/wvote.sqlite3"
+    """The database file used by the "sqlite" storage backend"""
+
+    key_mode: str = "memory"
+    """
+    How links and vote keys work: "memory" keeps every key in the process,
+    so they're lost on restart; "signed" makes keys that carry their own
+    data and expiry, signed with `key_secret`, so any process can check them
+    """
+
+    key_secret: str = ""
+    """
+    The secret "signed" keys are signed with. Keep it long, random and
+    private. If empty, a random one is made on each start.
+    """
+
+    key_journal: str = ""
+    """
+    A file to keep handed out keys in, such as "weeks/keys.journal", so that
+    links and vote keys survive a restart. Empty keeps them in memory only.
+    """
+
+    ipc_path: str = "weeks/wvote.sock"
+    """
+    The Unix socket the HTTP and bot processes talk over, when they're run
+    separately (`main.py http` and `main.py bot`)
+    """
+
+    metrics_public: bool = False
+    """
+    Whether /metrics answers anyone. Otherwise it only answers requests made
+    directly to `http_port` from the same machine.
+    """
+
+    accel_redirect_prefix: str = ""
+    """
+    If set, entry files are left for nginx to send: /files/ responds with an
+    X-Accel-Redirect to this internal location plus the file's path in the
+    blob store (see wvote_nginx). Empty serves files from Python.
+    """
+
 
 try:
     from botconfig import Config
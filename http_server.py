@@ -1,24 +1,40 @@
 #!/usr/bin/env python3
 
+import asyncio
 import logging
 import json
+import os
+import time
 import urllib.parse
 from typing import Dict
 
 from aiohttp import web, web_request
 
+import blobs
 import compo
+import http_cache
+import ipc
 import keys
+import metrics
+import profiling
 import bot
 
 from config import config
 
-# TODO: replace [VUE-URL] ASAP?
-vote_template = open("templates/vote.html", "r").read()
-submit_template = open("templates/submit.html", "r").read()
-admin_template = open("templates/admin.html", "r").read()
+template_dir = "templates"
 
-favicon = open("static/favicon.ico", "rb").read()
+# Rendered pages, by template filename:
+# {"mtime": ..., "urls": get_urls(), "body": http_cache.CachedBody}
+template_cache = {}
+
+with open("static/favicon.ico", "rb") as favicon_file:
+    favicon = favicon_file.read()
+
+# How many characters of a file's digest go in its URL
+file_version_length = 16
+
+# The /entry_data response, built once per version of the current week
+entry_data_cache = None
 
 too_big_text = """
 File too big! We can only upload to discord files 8MB or less.
@@ -50,25 +66,40 @@ async def favicon_handler(request: web_request.Request) -> web.Response:
     return web.Response(body=favicon)
 
 
-async def week_files_handler(request: web_request.Request) -> web.Response:
-    """Download the requested file for an entry"""
-    data, content_type = compo.get_entry_file(request.match_info["uuid"],
-                                              request.match_info["filename"])
+async def week_files_handler(
+        request: web_request.Request) -> web.StreamResponse:
+    """Download the requested file for an entry
 
-    if not data:
+       Served straight from the blob store, with support for ranges,
+       conditional requests and HEAD, or handed off to nginx if
+       `accel_redirect_prefix` is set.
+    """
+    digest, content_type = compo.get_entry_file(request.match_info["uuid"],
+                                                request.match_info["filename"])
+
+    if digest is None or not os.path.exists(blobs.blob_path(digest)):
         return web.Response(status=404, text="File not found")
 
-    return web.Response(status=200, body=data, content_type=content_type)
+    if request.query.get("v") == digest[:file_version_length]:
+        # The URL names these exact contents, so it can be cached forever
+        cache_control = "public, max-age=31536000, immutable"
+    else:
+        cache_control = "no-cache"
+
+    headers = {"Content-Type": content_type, "Cache-Control": cache_control}
+
+    if config.accel_redirect_prefix:
+        # nginx sends the file itself, keeping these headers
+        headers["X-Accel-Redirect"] = config.accel_redirect_prefix + \
+            os.path.relpath(blobs.blob_path(digest), blobs.blob_dir)
+        return web.Response(status=200, headers=headers)
+
+    return web.FileResponse(blobs.blob_path(digest), headers=headers)
 
 
 async def vote_handler(request: web_request.Request) -> web.Response:
     """Display the vote form (No data; will be fetched by Vue)"""
-    urls = get_urls()
-    html = vote_template.replace("[VUE-URL]", urls["vue"])
-    html = html.replace("[POPPER-URL]", urls["popper"])
-    html = html.replace("[TOOLTIP-URL]", urls["v-tooltip"])
-
-    return web.Response(text=html, content_type="text/html")
+    return render_template("vote.html").respond(request)
 
 
 async def admin_handler(request: web_request.Request) -> web.Response:
@@ -78,29 +109,33 @@ async def admin_handler(request: web_request.Request) -> web.Response:
     if not keys.key_valid(auth_key, keys.admin_keys):
         return web.Response(status=401, text="Invalid or expired admin link")
 
-    urls = get_urls()
-    html = admin_template.replace("[VUE-URL]", urls["vue"])
-    html = html.replace("[POPPER-URL]", urls["popper"])
-    html = html.replace("[TOOLTIP-URL]", urls["v-tooltip"])
-
-    return web.Response(status=200, body=html, content_type="text/html")
+    return render_template("admin.html").respond(request)
 
 
 async def edit_handler(request: web_request.Request) -> web.Response:
     """Display edit forms (No data; will be fetched by Vue)"""
-
-    urls = get_urls()
-    html = submit_template.replace("[VUE-URL]", urls["vue"])
-    html = html.replace("[POPPER-URL]", urls["popper"])
-    html = html.replace("[TOOLTIP-URL]", urls["v-tooltip"])
-
-    return web.Response(status=200, body=html, content_type="text/html")
+    return render_template("submit.html").respond(request)
 
 
 # API handlers
 async def get_entries_handler(request: web_request.Request) -> web.Response:
     """Display this weeks votable entries"""
-    return web.json_response(format_week(compo.get_week(False), False))
+    global entry_data_cache
+
+    week = compo.get_week(False)
+
+    # A different week object (after archiving, say) always misses
+    if (entry_data_cache is None or entry_data_cache["week"] is not week
+            or entry_data_cache["version"] != compo.week_version):
+        entry_data_cache = {
+            "week": week,
+            "version": compo.week_version,
+            "body": http_cache.CachedBody(
+                json.dumps(format_week(week, False)).encode(),
+                "application/json"),
+        }
+
+    return entry_data_cache["body"].respond(request)
 
 
 async def get_entry_handler(request: web_request.Request) -> web.Response:
@@ -111,11 +146,10 @@ async def get_entry_handler(request: web_request.Request) -> web.Response:
         return web.Response(status=400,
                             text="Submissions are currently closed!")
 
-    if not keys.key_valid(auth_key, keys.edit_keys):
+    key = keys.key_data(auth_key, keys.edit_keys)
+    if key is None:
         return web.Response(status=401, text="Invalid or expired link")
 
-    key = keys.edit_keys[auth_key]
-
     entry = compo.find_entry_by_uuid(key["entryUUID"])
 
     return web.json_response(get_editable_entry(entry))
@@ -127,6 +161,7 @@ async def admin_get_data_handler(request: web_request.Request) -> web.Response:
        - Week information
        - Submissions
        - Votes
+       - How many links are live
     """
     auth_key = request.match_info["authKey"]
 
@@ -139,7 +174,7 @@ async def admin_get_data_handler(request: web_request.Request) -> web.Response:
     weeks = [format_week(this_week, True), format_week(next_week, True)]
     votes = get_week_votes(this_week)
 
-    data = {"weeks": weeks, "votes": votes}
+    data = {"weeks": weeks, "votes": votes, "keyStats": keys.key_stats()}
 
     return web.json_response(data)
 
@@ -164,13 +199,17 @@ async def admin_viewvote_handler(request: web_request.Request) -> web.Response:
 
     week = compo.get_week(False)
 
-    for v in week["votes"]:
-        if int(v["userID"]) == int(user_id):
-            return web.Response(status=200,
-                                body=json.dumps(v),
-                                content_type="application/json")
+    try:
+        vote = week["votes"].get(int(user_id))
+    except ValueError:
+        vote = None
+
+    if vote is None:
+        return web.Response(status=404, text="File not found")
 
-    return web.Response(status=404, text="File not found")
+    return web.Response(status=200,
+                        body=json.dumps(vote),
+                        content_type="application/json")
 
 
 async def admin_deletevote_handler(
@@ -182,12 +221,10 @@ async def admin_deletevote_handler(
     if not keys.key_valid(auth_key, keys.admin_keys):
         return web.Response(status=401, text="Invalid or expired admin link")
 
-    week = compo.get_week(False)
-    week["votes"] = [
-        vote for vote in week["votes"] if vote["userID"] != user_id
-    ]
-
-    compo.save_weeks()
+    try:
+        compo.delete_vote(user_id)
+    except ValueError:
+        return web.Response(status=404, text="File not found")
 
     return web.Response(status=204)
 
@@ -199,11 +236,13 @@ async def admin_control_handler(request: web_request.Request) -> web.Response:
     if not keys.key_valid(auth_key, keys.admin_keys):
         return web.Response(status=401, text="Invalid or expired admin link")
 
+    data = await request.json()
+
+    # Only now, since the weeks may have been reloaded while the request was
+    # being read
     this_week = compo.get_week(False)
     next_week = compo.get_week(True)
 
-    data = await request.json()
-
     next_week["theme"] = data["weeks"][1]["theme"]
     next_week["date"] = data["weeks"][1]["date"]
     next_week["submissionsOpen"] = data["weeks"][1]["submissionsOpen"]
@@ -212,7 +251,8 @@ async def admin_control_handler(request: web_request.Request) -> web.Response:
     this_week["date"] = data["weeks"][0]["date"]
     this_week["votingOpen"] = data["weeks"][0]["votingOpen"]
 
-    compo.save_weeks()
+    compo.schedule_save()
+    await compo.wait_for_save()
     return web.Response(status=204, text="Nice")
 
 
@@ -224,6 +264,7 @@ async def admin_archive_handler(request: web_request.Request) -> web.Response:
         return web.Response(status=401, text="Invalid or expired admin link")
 
     compo.move_to_next_week()
+    await compo.flush()
 
     return web.Response(status=204, text="Nice")
 
@@ -249,11 +290,67 @@ async def admin_spoof_handler(request: web_request.Request) -> web.Response:
     new_entry = compo.create_blank_entry(entry_data["entrantName"],
                                          discord_id)
     week = compo.get_week(entry_data["nextWeek"])
-    week["entries"].append(new_entry)
+    compo.add_entry(week, new_entry)
+    compo.schedule_save()
+    await compo.wait_for_save()
 
     return web.Response(status=204, text="Nice")
 
 
+async def admin_profile_handler(request: web_request.Request) -> web.Response:
+    """Profile the server for ?seconds= (default 30)
+
+       Responds once the profile is done, with a pstats file to download, or
+       with the slowest functions as text if ?format=text.
+    """
+    auth_key = request.match_info["authKey"]
+
+    if not keys.key_valid(auth_key, keys.admin_keys):
+        return web.Response(status=401, text="Invalid or expired admin link")
+
+    try:
+        seconds = float(request.query.get("seconds", 30))
+    except ValueError:
+        return web.Response(status=400, text="Invalid number of seconds")
+
+    try:
+        profiler = await profiling.profile_for(seconds)
+    except profiling.ProfilerBusyError:
+        return web.Response(status=409, text="A profile is already running")
+
+    if request.query.get("format") == "text":
+        return web.Response(status=200, text=profiling.pstats_text(profiler))
+
+    filename = "wvote-%s.pstats" % time.strftime("%Y%m%d-%H%M%S")
+    return web.Response(
+        status=200,
+        body=profiling.pstats_bytes(profiler),
+        content_type="application/octet-stream",
+        headers={"Content-Disposition": "attachment; filename=" + filename})
+
+
+async def admin_heap_handler(request: web_request.Request) -> web.Response:
+    """Show the lines holding the most memory, as text
+
+       The first request starts tracing allocations; ?stop=1 stops it again.
+    """
+    auth_key = request.match_info["authKey"]
+
+    if not keys.key_valid(auth_key, keys.admin_keys):
+        return web.Response(status=401, text="Invalid or expired admin link")
+
+    if request.query.get("stop"):
+        profiling.stop_heap_tracing()
+        return web.Response(status=200, text="Stopped tracing allocations")
+
+    try:
+        limit = int(request.query.get("limit", 25))
+    except ValueError:
+        return web.Response(status=400, text="Invalid limit")
+
+    return web.Response(status=200, text=profiling.heap_snapshot(limit))
+
+
 async def file_post_handler(request: web_request.Request) -> web.Response:
     """Handle user submission.
        If user was an admin, mark entry as meddled with.
@@ -263,8 +360,9 @@ async def file_post_handler(request: web_request.Request) -> web.Response:
     auth_key = request.match_info["authKey"]
     uuid = request.match_info["uuid"]
 
-    is_authorized_user = (keys.key_valid(auth_key, keys.edit_keys)
-                          and keys.edit_keys[auth_key]["entryUUID"] == uuid
+    edit_key = keys.key_data(auth_key, keys.edit_keys)
+    is_authorized_user = (edit_key is not None
+                          and edit_key["entryUUID"] == uuid
                           and compo.get_week(True)["submissionsOpen"])
 
     is_admin = keys.key_valid(auth_key, keys.admin_keys)
@@ -273,44 +371,42 @@ async def file_post_handler(request: web_request.Request) -> web.Response:
         return web.Response(status=401, text="Invalid or expired link")
 
     # Find the entry
-    choice = None
-    for which_week in [True, False]:
-        week = compo.get_week(which_week)
+    week, entry = compo.find_entry_and_week(uuid)
 
-        for entryIndex, entry in enumerate(week["entries"]):
-            if entry["uuid"] == uuid:
-                choice = (week, entryIndex, entry)
-                break
-
-    if choice is None:
+    if entry is None:
         return web.Response(status=404,
                             text="That entry doesn't seem to exist")
 
-    week, entryIndex, entry = choice
-
-    # Process it
+    # Process it. Edits are gathered up and only made once the whole form
+    # is in, since the weeks may be reloaded in the meantime when several
+    # processes share them.
     reader = await request.multipart()
     if reader is None:
         return web.Response(status=400, text="Error uploading data idk")
 
+    edits = {}
+
     async for field in reader:
         if is_admin:
             if field.name == "entrantName":
-                entry["entrantName"] = \
+                edits["entrantName"] = \
                     (await field.read(decode=True)).decode("utf-8")
             elif field.name == "entryNotes":
-                entry["entryNotes"] = \
+                edits["entryNotes"] = \
                     (await field.read(decode=True)).decode("utf-8")
-                if entry["entryNotes"] == "undefined":
-                    entry["entryNotes"] = ""
+                if edits["entryNotes"] == "undefined":
+                    edits["entryNotes"] = ""
             elif field.name == "deleteEntry":
-                week["entries"].remove(entry)
-                compo.save_weeks()
+                week, entry = compo.find_entry_and_week(uuid)
+                if entry is not None:
+                    compo.remove_entry(week, entry)
+                    compo.schedule_save()
+                    await compo.wait_for_save()
                 return web.Response(status=200,
                                     text="Entry successfully deleted.")
 
         if field.name == "entryName":
-            entry["entryName"] = \
+            edits["entryName"] = \
                 (await field.read(decode=True)).decode("utf-8")
         elif field.name == "mp3Link":
             url = (await field.read(decode=True)).decode("utf-8")
@@ -321,9 +417,9 @@ async def file_post_handler(request: web_request.Request) -> web.Response:
                         status=400,
                         text="You entered a link to a website we don't allow.")
 
-                entry["mp3"] = url
-                entry["mp3Format"] = "external"
-                entry["mp3Filename"] = ""
+                edits["mp3"] = url
+                edits["mp3Format"] = "external"
+                edits["mp3Filename"] = ""
         elif field.name == "mp3" or field.name == "pdf":
             if field.filename == "":
                 continue
@@ -331,35 +427,45 @@ async def file_post_handler(request: web_request.Request) -> web.Response:
                 errMsg = "Wrong file format! Expected %s" % field.name
                 return web.Response(status=400, text=errMsg)
 
-            size = 0
-            entry[field.name] = None
-
-            entry[field.name + "Filename"] = field.filename
+            # Streamed to disk, and only attached to the entry once the
+            # whole file is in
+            with blobs.BlobWriter() as writer:
+                while True:
+                    chunk = await field.read_chunk()
+                    if not chunk:
+                        break
+                    if writer.size + len(chunk) > 1000 * 1000 * 10:  # 10MB
+                        return web.Response(status=413, text=too_big_text)
+                    writer.write(chunk)
+
+                # Syncing up to 10MB to disk takes a while, so it's done
+                # off the event loop
+                digest = await asyncio.get_running_loop().run_in_executor(
+                    None, writer.commit)
+
+            compo.set_entry_blob(edits, field.name, digest, writer.size)
+            edits[field.name + "Filename"] = field.filename
 
             if field.name == "mp3":
-                entry["mp3Format"] = "mp3"
-
-            while True:
-                chunk = await field.read_chunk()
-                if not chunk:
-                    break
-                size += len(chunk)
-                if size > 1000 * 1000 * 10:  # 10MB limit
-                    entry[field.name] = None
-                    entry[field.name + "Filename"] = None
-                    return web.Response(status=413, text=too_big_text)
-                if entry[field.name] is None:
-                    entry[field.name] = chunk
-                else:
-                    entry[field.name] += chunk
+                edits["mp3Format"] = "mp3"
+
+    week, entry = compo.find_entry_and_week(uuid)
+    if entry is None:
+        return web.Response(status=404,
+                            text="That entry doesn't seem to exist")
+
+    entry.update(edits)
 
     if not is_admin:
         # Move the entry to the end of the list
-        week["entries"].append(week["entries"].pop(entryIndex))
+        week["entries"].remove(entry)
+        week["entries"].append(entry)
 
-    compo.save_weeks()
+    compo.schedule_save()
+    await compo.wait_for_save()
 
-    await bot.submission_message(entry, is_admin)
+    # Sent in the background, so the upload doesn't wait on Discord
+    notify_submission(entry, is_admin)
 
     return web.Response(status=204)
 
@@ -370,28 +476,25 @@ async def submit_vote_handler(request: web_request.Request) -> web.Response:
 
     auth_key = vote_input["voteKey"]
 
-    if not keys.key_valid(auth_key, keys.vote_keys):
+    vote_key = keys.key_data(auth_key, keys.vote_keys)
+    if vote_key is None:
         return web.Response(status=401, text="Invalid or expired vote token")
 
-    user_id = keys.vote_keys[auth_key]["userID"]
-    user_name = keys.vote_keys[auth_key]["userName"]
+    user_id = vote_key["userID"]
+    user_name = vote_key["userName"]
     user_votes = vote_input["votes"]
 
+    if not isinstance(user_votes, list):
+        return web.Response(status=400, text="Votes must be a list")
+
     week = compo.get_week(False)
 
-    # If user has submitted a vote already, then remove it, so we can
-    # replace it with the new one
-    for v in week["votes"]:
-        if int(v["userID"]) == int(user_id):
-            week["votes"].remove(v)
+    # Drop bad, unknown and repeated ratings before anything is stored
+    user_votes = compo.validate_ratings(user_votes, week["voteParams"],
+                                        compo.entry_index(week)["uuid"])
 
     # Find the user's entry
-    user_entry = None
-
-    for entry in week["entries"]:
-        if entry["discordID"] == user_id:
-            user_entry = entry
-            break
+    user_entry = compo.find_entry_by_discord_id(week, user_id)
 
     # Remove the user's vote on their own entry (Search by UUID to prevent name spoofing).
     if user_entry is not None:
@@ -401,7 +504,7 @@ async def submit_vote_handler(request: web_request.Request) -> web.Response:
         ]
 
         # Find the user's highest rating
-        max_vote = max(vote["rating"] for vote in user_votes)
+        max_vote = max((vote["rating"] for vote in user_votes), default=0)
 
         # Grant the user rating equal to their highest vote on each category
         for param in week["voteParams"]:
@@ -418,13 +521,27 @@ async def submit_vote_handler(request: web_request.Request) -> web.Response:
         "userName": user_name
     }
 
-    week["votes"].append(vote_data)
-
-    compo.save_weeks()
+    # Replaces the user's earlier ballot, if they've voted already
+    compo.upsert_vote(vote_data)
 
     return web.Response(status=200, text="FRICK yeah")
 
 
+async def metrics_handler(request: web_request.Request) -> web.Response:
+    """Report metrics in the Prometheus text format
+
+       Only answers requests made on this machine (not through nginx),
+       unless `metrics_public` is set.
+    """
+    if not config.metrics_public and not is_local_request(request):
+        return web.Response(status=403, text="Metrics are only available "
+                            "from localhost")
+
+    return web.Response(
+        body=metrics.render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
 async def allowed_hosts_handler(request: web_request.Request) -> web.Response:
     """Returns the list of allowed hosts for song links"""
 
@@ -432,6 +549,24 @@ async def allowed_hosts_handler(request: web_request.Request) -> web.Response:
 
 
 # Helpers
+def notify_submission(entry: dict, user_was_admin: bool) -> None:
+    """Has the bot tell the admins about an edit, wherever it's running."""
+    if ipc.role == "http":
+        ipc.send({
+            "type": "submission",
+            "entry": entry,
+            "userWasAdmin": user_was_admin
+        })
+    else:
+        bot.submission_message(entry, user_was_admin)
+
+
+def is_local_request(request: web_request.Request) -> bool:
+    # Requests proxied by nginx come from localhost too, but are marked
+    return (request.remote in ["127.0.0.1", "::1"]
+            and "X-Forwarded-For" not in request.headers)
+
+
 def format_week(week: dict, is_admin: bool) -> dict:
     """
     Massages week data into the format that will be output as JSON.
@@ -452,8 +587,7 @@ def format_week(week: dict, is_admin: bool) -> dict:
         }
         
         if e.get("pdfFilename") != None:
-            prunedEntry["pdfUrl"] = "/files/%s/%s" % (e["uuid"],
-                                                      urllib.parse.quote(e.get("pdfFilename"))),
+            prunedEntry["pdfUrl"] = file_url(e, "pdf")
         else:
         	prunedEntry["pdfUrl"] = None
 
@@ -461,8 +595,7 @@ def format_week(week: dict, is_admin: bool) -> dict:
             prunedEntry["entryNotes"] = e["entryNotes"]
 
         if e.get("mp3Format") == "mp3":
-            prunedEntry["mp3Url"] = "/files/%s/%s" % (e["uuid"],
-                                                      urllib.parse.quote(e["mp3Filename"]))
+            prunedEntry["mp3Url"] = file_url(e, "mp3")
         else:
             prunedEntry["mp3Url"] = e.get("mp3")
 
@@ -498,15 +631,58 @@ def format_week(week: dict, is_admin: bool) -> dict:
     return data
 
 
-def get_week_votes(week: dict) -> str:
-    adaptedData = week["votes"].copy()
+def render_template(filename: str) -> http_cache.CachedBody:
+    """
+    Fills the script URLs into a page template. The result is kept until the
+    URLs or the template file change.
+    """
+    path = os.path.join(template_dir, filename)
+    mtime = os.stat(path).st_mtime_ns
+    urls = get_urls()
+
+    cached = template_cache.get(filename)
+    if cached is None or cached["mtime"] != mtime or cached["urls"] != urls:
+        with open(path, "r") as template_file:
+            html = template_file.read()
+
+        # TODO: replace [VUE-URL] ASAP?
+        html = html.replace("[VUE-URL]", urls["vue"])
+        html = html.replace("[POPPER-URL]", urls["popper"])
+        html = html.replace("[TOOLTIP-URL]", urls["v-tooltip"])
+
+        cached = template_cache[filename] = {
+            "mtime": mtime,
+            "urls": urls,
+            "body": http_cache.CachedBody(html.encode(), "text/html",
+                                          "utf-8"),
+        }
+
+    return cached["body"]
+
 
+def get_week_votes(week: dict) -> list:
     # JavaScript is very silly and won't work if we send these huge
-    # numbers as actual numbers, so we have to stringify them first
-    for v in adaptedData:
-        v["userID"] = str(v["userID"])
+    # numbers as actual numbers, so we have to stringify them first.
+    # Ballots are listed in the order they were cast.
+    return [
+        dict(v, userID=str(v["userID"])) for v in week["votes"].values()
+    ]
+
+
+def file_url(entry: dict, field: str) -> str:
+    """
+    Links to an entry's "mp3" or "pdf" file. The link carries a bit of the
+    file's digest, so it changes whenever the file does, and the file can be
+    cached for good.
+    """
+    url = "/files/%s/%s" % (entry["uuid"],
+                            urllib.parse.quote(entry[field + "Filename"]))
+
+    digest = entry.get(field)
+    if blobs.is_digest(digest):
+        url += "?v=" + digest[:file_version_length]
 
-    return adaptedData
+    return url
 
 
 def get_editable_entry(entry: dict) -> dict:
@@ -519,19 +695,65 @@ def get_editable_entry(entry: dict) -> dict:
     }
 
     if entry.get("mp3Format") == "mp3":
-        entry_data["mp3Url"] = "/files/%s/%s" % (entry["uuid"],
-                                                 entry["mp3Filename"])
+        entry_data["mp3Url"] = file_url(entry, "mp3")
     else:
         entry_data["mp3Url"] = entry.get("mp3")
 
     if entry.get("pdfFilename") is not None:
-        entry_data["pdfUrl"] = "/files/%s/%s" % (entry["uuid"],
-                                                 entry.get("pdfFilename"))
+        entry_data["pdfUrl"] = file_url(entry, "pdf")
 
     return entry_data
 
 
-server = web.Application()
+# Metrics
+request_seconds = metrics.Histogram("wvote_http_request_seconds",
+                                    "Time spent answering HTTP requests")
+requests_total = metrics.Counter("wvote_http_requests_total",
+                                 "HTTP requests answered, by status")
+
+
+def entry_file_bytes() -> dict:
+    """How big the files of each loaded week's entries are, altogether."""
+    weeks = {"current": compo.current_week, "next": compo.next_week}
+    return {
+        name: sum(
+            (e.get("mp3Size") or 0) + (e.get("pdfSize") or 0)
+            for e in week["entries"])
+        for name, week in weeks.items() if week is not None
+    }
+
+
+metrics.Gauge("wvote_live_keys", "Keys that haven't expired yet",
+              keys.key_stats, "store")
+metrics.Gauge("wvote_entry_file_bytes",
+              "Size of the files of each week's entries", entry_file_bytes,
+              "week")
+
+
+@web.middleware
+async def metrics_middleware(request: web_request.Request,
+                             handler) -> web.StreamResponse:
+    """Times every request, by route."""
+    resource = request.match_info.route.resource
+    route = "unmatched" if resource is None else resource.canonical
+
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        request_seconds.observe(time.perf_counter() - start,
+                                route=route,
+                                method=request.method)
+        requests_total.inc(route=route, method=request.method, status=status)
+
+
+server = web.Application(middlewares=[metrics_middleware])
 
 server.add_routes([
     web.get("/", vote_handler),
@@ -551,17 +773,27 @@ server.add_routes([
     web.post("/admin/spoof/{authKey}", admin_spoof_handler),
     web.post("/admin/delete_vote/{authKey}/{userID}",
              admin_deletevote_handler),
+    web.get("/admin/profile/{authKey}", admin_profile_handler),
+    web.get("/admin/heap/{authKey}", admin_heap_handler),
     web.post("/edit/post/{uuid}/{authKey}", file_post_handler),
     web.post("/submit_vote", submit_vote_handler),
+    web.get("/metrics", metrics_handler),
     web.static("/static", "static")
 ])
 
 
-async def start_http() -> None:
-    """Starts the HTTP server"""
+async def start_http(reuse_port: bool = False) -> None:
+    """Starts the HTTP server
+
+       With `reuse_port`, other processes can listen on the same port too,
+       and the kernel spreads connections between them.
+    """
     runner = web.AppRunner(server)
     await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", config.http_port)
+    site = web.TCPSite(runner,
+                       "0.0.0.0",
+                       config.http_port,
+                       reuse_port=reuse_port)
     await site.start()
     logging.info("HTTP: Started server")
 
@@ -5,10 +5,19 @@ cd /opt/wVote/
 rm -rf __pycache__/
 
 cp wvote.service /lib/systemd/system/wvote.service
+cp wvote-http.service /lib/systemd/system/wvote-http.service
+cp wvote-bot.service /lib/systemd/system/wvote-bot.service
 
 date >> upgrade-log.txt
 git rev-parse HEAD >> upgrade-log.txt
 
 systemctl daemon-reload
-systemctl start wvote.service
-systemctl enable wvote.service
+
+# Restart whichever way wVote is being run: as one service, or as separate
+# HTTP and bot services
+if systemctl is-enabled --quiet wvote-http.service; then
+	systemctl restart wvote-http.service wvote-bot.service
+else
+	systemctl start wvote.service
+	systemctl enable wvote.service
+fi
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Messages between wVote's processes, when the HTTP server and the bot run
+separately (see main.py).
+
+The bot listens on a Unix socket at `config.ipc_path`, and each HTTP worker
+connects to it. Either side can then send small JSON messages, one per line,
+which are handed to `handlers` by their "type":
+
+- "weeks_changed": the weeks in the database were changed; reload them
+- "ballot": a ballot was cast or deleted; apply it to the current week
+- "submission": an entry was edited; notify the admins about it
+- "connected": sent to ourselves whenever a connection is (re)made, since
+  anything said while we weren't connected was lost
+
+Messages from the bot go to every HTTP worker. HTTP workers only talk to the
+bot, so they notice each other's changes through the database instead (see
+`compo.get_week`).
+"""
+
+import asyncio
+import collections
+import json
+import logging
+import os
+
+# "http" or "bot" once started; None when everything runs in one process,
+# in which case sending does nothing
+role = None
+
+# {message type: function(message)}
+handlers = {}
+
+# Writers for the open connections to other processes
+peers = set()
+
+# Messages sent while no other process was connected, to deliver once one
+# is. Only the last few are kept.
+pending = collections.deque(maxlen=100)
+
+# How long HTTP workers wait between attempts to connect, in seconds
+reconnect_delay = 1.0
+
+
+def send(message: dict) -> None:
+    """
+    Sends a message to every connected process, or holds on to it until one
+    connects. Doesn't wait for it to be delivered.
+    """
+    if role is None:
+        return
+
+    if not peers:
+        pending.append(message)
+        return
+
+    data = (json.dumps(message) + "\n").encode()
+    for writer in list(peers):
+        if writer.is_closing():
+            peers.discard(writer)
+        else:
+            writer.write(data)
+
+
+def dispatch(message: dict) -> None:
+    handler = handlers.get(message.get("type"))
+    if handler is None:
+        logging.warning("IPC: No handler for %r messages" %
+                        message.get("type"))
+        return
+
+    try:
+        handler(message)
+    except Exception:
+        logging.exception("IPC: Failed to handle %r message" %
+                          message.get("type"))
+
+
+async def handle_connection(reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter) -> None:
+    peers.add(writer)
+    logging.info("IPC: Connected to %s" %
+                 ("the bot" if role == "http" else "an HTTP worker"))
+
+    try:
+        dispatch({"type": "connected"})
+
+        while pending:
+            send(pending.popleft())
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            try:
+                message = json.loads(line)
+            except ValueError:
+                logging.warning("IPC: Ignoring malformed message")
+                continue
+
+            dispatch(message)
+    except ConnectionError:
+        pass
+    finally:
+        peers.discard(writer)
+        writer.close()
+        logging.info("IPC: Disconnected")
+
+
+async def listen(path: str) -> asyncio.AbstractServer:
+    """Accepts connections from HTTP workers. Used by the bot process."""
+    global role
+
+    role = "bot"
+
+    # A socket left behind by an earlier run would make binding fail
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+    server = await asyncio.start_unix_server(handle_connection, path)
+    logging.info("IPC: Listening on %s" % path)
+    return server
+
+
+async def connect(path: str) -> None:
+    """
+    Connects to the bot process, and reconnects whenever the connection is
+    lost, for as long as the event loop runs. Used by HTTP workers.
+    """
+    global role
+
+    role = "http"
+
+    while True:
+        try:
+            reader, writer = await asyncio.open_unix_connection(path)
+        except (FileNotFoundError, ConnectionError):
+            await asyncio.sleep(reconnect_delay)
+            continue
+
+        await handle_connection(reader, writer)
+        await asyncio.sleep(reconnect_delay)
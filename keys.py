@@ -1,6 +1,19 @@
-import random
+import asyncio
+import base64
 import datetime
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import logging
+import os
+import random
+import secrets
 import string
+import tempfile
+import time
+from typing import Optional
 from config import config
 
 edit_keys = {
@@ -8,7 +21,8 @@ edit_keys = {
     # {
     #   "entryUUID": "cf56f9c3-e81f-43b0-b16b-de2144b54b02",
     #   "creationTime": datetime.datetime.now(),
-    #   "timeToLive": 200
+    #   "timeToLive": 200,
+    #   "expires": time.monotonic() + 200 * 60
     # }
 }
 
@@ -16,7 +30,8 @@ admin_keys = {
     # "a1b2c3d4":
     # {
     #   "creationTime": datetime.datetime.now(),
-    #   "timeToLive": 200
+    #   "timeToLive": 200,
+    #   "expires": time.monotonic() + 200 * 60
     # }
 }
 
@@ -26,24 +41,346 @@ vote_keys = {
     #  "userID": 336685325231325184,
     #  "userName": "wilm0x42",
     #  "creationTime": datetime.datetime.now(),
-    #  "timeToLive": 200
+    #  "timeToLive": 200,
+    #  "expires": time.monotonic() + 200 * 60
     # }
 }
 
 
+# Every key that's been handed out, as (expiry, tiebreak, key, keystore), so
+# that the sweeper can drop keys as they expire instead of waiting for
+# someone to try using them
+expiry_heap = []
+expiry_counter = itertools.count()
+
+# The longest the sweeper sleeps for, in seconds, in case a key that expires
+# sooner than the rest turns up while it's asleep
+sweep_interval = 60
+
+# In "signed" key mode, admin keys that were revoked before they expired:
+# {key nonce: expiry (Unix time)}
+revoked_admin_keys = {}
+
+# When processes run separately, a function returning the SQLite store that
+# revocations are shared through (see main.py). Each process only holds the
+# revocations it made or loaded at startup, so this is checked as well.
+get_revocation_store = None
+
+# Signs keys when config.key_secret isn't set, until the next restart
+fallback_secret = None
+
+# If config.key_journal is set, keys are appended to it as they're handed out
+# (and revoked), so links keep working across restarts. Once this many
+# records pile up, it's rewritten with just the live keys.
+key_journal_records = 0
+key_journal_compact_threshold = 1000
+
+
 def key_valid(key: str, keystore: dict) -> bool:
+    if config.key_mode == "signed":
+        return key_data(key, keystore) is not None
+
     if key not in keystore:
         return False
 
-    now = datetime.datetime.now()
-    ttl = datetime.timedelta(minutes=keystore[key]["timeToLive"])
-
-    if now - keystore[key]["creationTime"] < ttl:
+    if time.monotonic() < keystore[key]["expires"]:
         return True
     del keystore[key]
     return False
 
 
+def key_data(key: str, keystore: dict) -> Optional[dict]:
+    """
+    Returns what a valid key was issued for ("entryUUID" for edit keys,
+    "userID" and "userName" for vote keys), or None if it isn't valid.
+    """
+    if config.key_mode == "signed":
+        return read_signed_key(key, keystore_role(keystore))
+
+    if not key_valid(key, keystore):
+        return None
+
+    return keystore[key]
+
+
+def keystores() -> dict:
+    return {"edit": edit_keys, "admin": admin_keys, "vote": vote_keys}
+
+
+def keystore_role(keystore: dict) -> Optional[str]:
+    for role, store in keystores().items():
+        if keystore is store:
+            return role
+
+    return None
+
+
+def add_key(keystore: dict, key: str, data: dict) -> None:
+    """Stores a new key, along with when it expires, and schedules its
+       removal.
+    """
+    data["creationTime"] = datetime.datetime.now()
+    data["timeToLive"] = config.default_ttl
+    data["expires"] = time.monotonic() + config.default_ttl * 60
+
+    track_key(keystore, key, data)
+    journal_key_record(key_record(keystore, key))
+
+
+def track_key(keystore: dict, key: str, data: dict) -> None:
+    keystore[key] = data
+    heapq.heappush(expiry_heap,
+                   (data["expires"], next(expiry_counter), key, keystore))
+
+
+def remove_expired_keys() -> int:
+    """Drops every key that has expired. Returns how many were dropped."""
+    now = time.monotonic()
+    removed = 0
+
+    while expiry_heap and expiry_heap[0][0] <= now:
+        expires, _, key, keystore = heapq.heappop(expiry_heap)
+
+        # It may be gone already, if someone tried to use it
+        if key in keystore and keystore[key]["expires"] <= now:
+            del keystore[key]
+            removed += 1
+
+    return removed
+
+
+def key_record(keystore: dict, key: str) -> dict:
+    """Turns a stored key into a journal record. Its expiry is saved as a
+       Unix time, since monotonic time starts over on restart.
+    """
+    data = dict(keystore[key])
+    data["creationTime"] = data["creationTime"].isoformat()
+    data["expiresAt"] = time.time() + (data.pop("expires") - time.monotonic())
+
+    return {
+        "op": "add",
+        "store": keystore_role(keystore),
+        "key": key,
+        "data": data
+    }
+
+
+def journal_key_record(record: dict) -> None:
+    global key_journal_records
+
+    if not config.key_journal:
+        return
+
+    with open(config.key_journal, "a") as journal:
+        journal.write(json.dumps(record) + "\n")
+
+    key_journal_records += 1
+
+
+def load_keys() -> None:
+    """
+    Reads back the keys in `config.key_journal` that haven't expired yet,
+    then rewrites the journal with just those.
+    """
+    if not config.key_journal:
+        return
+
+    try:
+        journal = open(config.key_journal, "r")
+    except FileNotFoundError:
+        return
+
+    now = time.time()
+
+    with journal:
+        for line in journal:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logging.warning("KEYS: Ignoring torn key journal record")
+                break
+
+            if record["op"] == "add":
+                data = record["data"]
+                expires_at = data.pop("expiresAt")
+                if expires_at <= now:
+                    continue
+
+                data["creationTime"] = datetime.datetime.fromisoformat(
+                    data["creationTime"])
+                data["expires"] = time.monotonic() + (expires_at - now)
+                track_key(keystores()[record["store"]], record["key"], data)
+            elif record["op"] == "remove":
+                keystores()[record["store"]].pop(record["key"], None)
+            elif record["op"] == "revoke":
+                if record["expires"] > now:
+                    revoked_admin_keys[record["nonce"]] = record["expires"]
+
+    remove_expired_keys()
+    compact_key_journal()
+
+    logging.info("KEYS: Loaded %s" % ", ".join("%s: %d" % stat
+                                               for stat in key_stats().items()))
+
+
+def compact_key_journal() -> None:
+    """Rewrites the key journal with only the keys that are still live."""
+    global key_journal_records
+
+    now = time.time()
+    records = [
+        key_record(store, key) for store in keystores().values()
+        for key in store
+    ] + [{
+        "op": "revoke",
+        "nonce": nonce,
+        "expires": expires
+    } for nonce, expires in revoked_admin_keys.items() if expires > now]
+
+    directory = os.path.dirname(config.key_journal) or "."
+    fd, temp_filename = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as temp_file:
+            for record in records:
+                temp_file.write(json.dumps(record) + "\n")
+        os.replace(temp_filename, config.key_journal)
+    except BaseException:
+        os.unlink(temp_filename)
+        raise
+
+    key_journal_records = len(records)
+
+
+async def sweep_expired_keys() -> None:
+    """Removes keys as they expire, for as long as the event loop runs."""
+    while True:
+        if expiry_heap:
+            delay = min(expiry_heap[0][0] - time.monotonic(), sweep_interval)
+        else:
+            delay = sweep_interval
+        await asyncio.sleep(max(delay, 0))
+
+        removed = remove_expired_keys()
+        if removed:
+            logging.info("KEYS: Dropped %d expired keys (%s)" %
+                         (removed, ", ".join("%s: %d" % stat
+                                             for stat in key_stats().items())))
+
+        if (config.key_journal
+                and key_journal_records >= key_journal_compact_threshold):
+            compact_key_journal()
+
+
+def key_stats() -> dict:
+    """How many keys of each kind are live right now."""
+    return {
+        "edit": len(edit_keys),
+        "admin": len(admin_keys),
+        "vote": len(vote_keys),
+    }
+
+
+def signing_secret() -> bytes:
+    global fallback_secret
+
+    if config.key_secret:
+        return config.key_secret.encode()
+
+    if fallback_secret is None:
+        logging.warning("KEYS: No key_secret set; signed keys will stop "
+                        "working on restart")
+        fallback_secret = secrets.token_bytes(32)
+
+    return fallback_secret
+
+
+def sign(body: str) -> str:
+    digest = hmac.new(signing_secret(), body.encode(), hashlib.sha256)
+    return base64.urlsafe_b64encode(digest.digest()).rstrip(b"=").decode()
+
+
+def create_signed_key(role: str, data: dict) -> str:
+    """
+    Creates a key that carries its own data, role and expiry, signed with
+    the server's secret, so that checking it needs no stored state.
+    """
+    payload = dict(data,
+                   role=role,
+                   expires=int(time.time() + config.default_ttl * 60),
+                   nonce=create_key())
+    body = base64.urlsafe_b64encode(
+        json.dumps(payload, separators=(",", ":")).encode()).rstrip(b"=")
+    body = body.decode()
+
+    return body + "." + sign(body)
+
+
+def read_signed_key(key: str, role: Optional[str]) -> Optional[dict]:
+    """Returns a signed key's data, if it's genuine, unexpired, unrevoked
+       and for `role`. Otherwise returns None.
+    """
+    # Keys come straight from request JSON, so they may not even be strings
+    if not isinstance(key, str):
+        return None
+
+    body, _, signature = key.partition(".")
+
+    if not hmac.compare_digest(signature.encode(), sign(body).encode()):
+        return None
+
+    payload = json.loads(base64.urlsafe_b64decode(body + "=" *
+                                                  (-len(body) % 4)))
+
+    if payload["role"] != role or payload["expires"] <= time.time():
+        return None
+
+    if role == "admin" and (payload["nonce"] in revoked_admin_keys or
+                            (get_revocation_store is not None
+                             and get_revocation_store().key_revoked(
+                                 payload["nonce"]))):
+        return None
+
+    return payload
+
+
+def revoke_key(key: str) -> bool:
+    """
+    Makes a key invalid before it expires. In "signed" key mode, only admin
+    keys can be revoked.
+
+    Returns
+    -------
+    bool
+        Whether there was a valid key to revoke
+    """
+    if config.key_mode != "signed":
+        for role, store in keystores().items():
+            if store.pop(key, None) is not None:
+                journal_key_record({"op": "remove", "store": role, "key": key})
+                return True
+        return False
+
+    payload = read_signed_key(key, "admin")
+    if payload is None:
+        return False
+
+    # Revocations are only needed until the key would've expired anyway
+    now = time.time()
+    for nonce, expires in list(revoked_admin_keys.items()):
+        if expires <= now:
+            del revoked_admin_keys[nonce]
+
+    revoked_admin_keys[payload["nonce"]] = payload["expires"]
+    if get_revocation_store is not None:
+        get_revocation_store().revoke_key(payload["nonce"], payload["expires"])
+    journal_key_record({
+        "op": "revoke",
+        "nonce": payload["nonce"],
+        "expires": payload["expires"]
+    })
+    return True
+
+
 def create_key(length: int = 8) -> str:
     key_characters = string.ascii_letters + string.digits
     return ''.join(random.SystemRandom().choice(key_characters)
@@ -51,36 +388,36 @@ def create_key(length: int = 8) -> str:
 
 
 def create_edit_key(entry_uuid: str) -> str:
+    if config.key_mode == "signed":
+        return create_signed_key("edit", {"entryUUID": entry_uuid})
+
     key = create_key()
 
-    edit_keys[key] = {
-        "entryUUID": entry_uuid,
-        "creationTime": datetime.datetime.now(),
-        "timeToLive": config.default_ttl
-    }
+    add_key(edit_keys, key, {"entryUUID": entry_uuid})
 
     return key
 
 
 def create_admin_key() -> str:
+    if config.key_mode == "signed":
+        return create_signed_key("admin", {})
+
     key = create_key()
 
-    admin_keys[key] = {
-        "creationTime": datetime.datetime.now(),
-        "timeToLive": config.default_ttl
-    }
+    add_key(admin_keys, key, {})
 
     return key
 
 
 def create_vote_key(user_id: int, user_name) -> str:
+    if config.key_mode == "signed":
+        return create_signed_key("vote", {
+            "userID": user_id,
+            "userName": user_name
+        })
+
     key = create_key()
 
-    vote_keys[key] = {
-        "userID": user_id,
-        "userName": user_name,
-        "creationTime": datetime.datetime.now(),
-        "timeToLive": config.default_ttl
-    }
+    add_key(vote_keys, key, {"userID": user_id, "userName": user_name})
 
     return key
@@ -1,24 +1,191 @@
 #!/usr/bin/env python3
+"""
+Runs wVote: the bot and the HTTP server together, or either one on its own.
 
+    python3 main.py                  # both, in one process
+    python3 main.py http             # just the HTTP server
+    python3 main.py http --workers 4 # 4 HTTP server processes on one port
+    python3 main.py bot              # just the bot
+
+Run separately, the two share weeks through the SQLite database and keys by
+signing them, and tell each other about changes over a Unix socket (see
+ipc.py), so a slow bot command doesn't hold up anyone's HTTP requests.
+"""
+
+import argparse
 import logging
 import logging.handlers
+import os
+import signal
+import sys
+import time
 
 import asyncio
 
 import http_server
 import bot
+import compo
+import ipc
+import keys
+from config import config
+
+# How long to wait before restarting an HTTP worker that died, in seconds
+restart_delay = 5
+
+
+def split_mode_problems() -> list:
+    """Lists what's wrong with the config for running the processes apart."""
+    problems = []
+
+    if config.storage_backend != "sqlite":
+        problems.append('storage_backend must be "sqlite", so both '
+                        'processes see the same weeks')
+    if config.key_mode != "signed" or not config.key_secret:
+        problems.append('key_mode must be "signed", with a key_secret, so '
+                        'keys the bot hands out work on the HTTP server')
+
+    return problems
+
+
+def use_shared_store(mode: str) -> None:
+    """Sets up this process to share the weeks with the other one."""
+    compo.write_through = True
+
+    def reload_weeks(message: dict) -> None:
+        compo.reload_weeks()
+
+    ipc.handlers["connected"] = reload_weeks
+    ipc.handlers["weeks_changed"] = reload_weeks
+    ipc.handlers["ballot"] = lambda message: compo.apply_peer_ballot(
+        message["record"], message["version"])
+
+    # Looked up when first needed, so each HTTP worker opens its own
+    # connection after it's forked
+    keys.get_revocation_store = compo.get_database
+
+    if mode == "bot":
+        ipc.handlers["submission"] = lambda message: bot.submission_message(
+            message["entry"], message["userWasAdmin"])
+
+
+def setup_logging(name: str) -> None:
+    logging.basicConfig(format="%(asctime)s %(message)s",
+                        level=logging.INFO,
+                        handlers=[
+                            logging.handlers.TimedRotatingFileHandler(
+                                "logs/%s.log" % name,
+                                when="W0",
+                                backupCount=10),
+                            logging.StreamHandler()
+                        ],
+                        force=True)
+
+
+def run(mode: str, reuse_port: bool = False) -> None:
+    """Runs the bot, the HTTP server or both until interrupted."""
+    loop = asyncio.new_event_loop()
+
+    if mode in ["all", "bot"]:
+        loop.create_task(bot.start())
+    if mode in ["all", "http"]:
+        loop.create_task(http_server.start_http(reuse_port))
+    if mode == "bot":
+        loop.run_until_complete(ipc.listen(config.ipc_path))
+    if mode == "http":
+        loop.create_task(ipc.connect(config.ipc_path))
+    loop.create_task(keys.sweep_expired_keys())
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        # A supervising process may pass the interrupt on again
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        # Don't lose edits that are still waiting to be saved
+        loop.run_until_complete(compo.flush())
+
+
+def prefork(workers: int) -> None:
+    """
+    Runs `workers` HTTP server processes, which all listen on `http_port`
+    with SO_REUSEPORT, and restarts any that die. Returns once they've all
+    stopped after an interrupt.
+    """
+    children = {}
+
+    def spawn(number: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                setup_logging("wvote-http-%d" % number)
+                run("http", reuse_port=True)
+                status = 0
+            except BaseException:
+                logging.exception("MAIN: HTTP worker %d crashed" % number)
+            finally:
+                logging.shutdown()
+                os._exit(status)
+
+        children[pid] = number
+        logging.info("MAIN: Started HTTP worker %d (pid %d)" % (number, pid))
+
+    for number in range(workers):
+        spawn(number)
+
+    try:
+        while children:
+            pid, status = os.wait()
+            number = children.pop(pid)
+            logging.warning("MAIN: HTTP worker %d exited with status %d; "
+                            "restarting it" % (number, status))
+            time.sleep(restart_delay)
+            spawn(number)
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            os.waitpid(pid, 0)
+
+
+parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+parser.add_argument("mode",
+                    nargs="?",
+                    choices=["all", "http", "bot"],
+                    default="all",
+                    help="what to run (default: all)")
+parser.add_argument("--workers",
+                    type=int,
+                    help="how many HTTP server processes to start, in http "
+                    "mode (default: http_workers from the config)")
+args = parser.parse_args()
+
+setup_logging("wvote" if args.mode == "all" else "wvote-%s" % args.mode)
+
+workers = 1
+if args.mode == "http":
+    workers = args.workers or config.http_workers
+elif args.workers is not None:
+    logging.error("MAIN: --workers only applies to http mode")
+    sys.exit(1)
 
-logging.basicConfig(format="%(asctime)s %(message)s",
-                    level=logging.INFO,
-                    handlers=[
-                        logging.handlers.TimedRotatingFileHandler(
-                            "logs/wvote.log", when="W0", backupCount=10),
-                        logging.StreamHandler()
-                    ])
+if args.mode != "all":
+    problems = split_mode_problems()
+    if problems:
+        for problem in problems:
+            logging.error("MAIN: Can't run %s on its own: %s" %
+                          (args.mode, problem))
+        sys.exit(1)
 
-loop = asyncio.new_event_loop()
+    use_shared_store(args.mode)
 
-bot_task = loop.create_task(bot.start())
-http_task = loop.create_task(http_server.start_http())
+# Links handed out before a restart keep working, if they're kept on disk
+keys.load_keys()
 
-loop.run_forever()
+if workers > 1:
+    prefork(workers)
+else:
+    run(args.mode)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Counters, histograms and gauges, rendered in the Prometheus text format for
+the /metrics route.
+
+Metrics can be updated from executor threads as well as the event loop.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+# Every metric, in the order they're rendered
+registry = []
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def render(self) -> list:
+        lines = [
+            "# HELP %s %s" % (self.name, self.help_text),
+            "# TYPE %s %s" % (self.name, self.kind),
+        ]
+        with self.lock:
+            lines += self.samples()
+        return lines
+
+    def samples(self) -> list:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A total that only goes up, kept separately for each set of labels."""
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text)
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list:
+        return [
+            "%s%s %s" % (self.name, format_labels(key), format_value(value))
+            for key, value in sorted(self.values.items())
+        ]
+
+
+class Histogram(Metric):
+    """Counts observations (usually durations in seconds) into buckets."""
+    kind = "histogram"
+
+    def __init__(self,
+                 name: str,
+                 help_text: str,
+                 buckets: tuple = default_buckets):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+        # {labels: [count per bucket..., count above the last, sum]}
+        self.values = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = label_key(labels)
+        with self.lock:
+            counts = self.values.setdefault(key,
+                                            [0] * (len(self.buckets) + 1) +
+                                            [0.0])
+            for n, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[n] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes how long the `with` block takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list:
+        lines = []
+        for key, counts in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"), ),
+                                    counts[:-1]):
+                cumulative += count
+                lines.append(
+                    "%s_bucket%s %d" %
+                    (self.name,
+                     format_labels(key + (("le", format_value(bound)), )),
+                     cumulative))
+            lines.append("%s_sum%s %s" %
+                         (self.name, format_labels(key),
+                          format_value(counts[-1])))
+            lines.append("%s_count%s %d" %
+                         (self.name, format_labels(key), cumulative))
+        return lines
+
+
+class Gauge(Metric):
+    """
+    A value that's read when the metrics are rendered. If `label` is given,
+    `read` returns {label value: number}; otherwise, a single number.
+    """
+    kind = "gauge"
+
+    def __init__(self,
+                 name: str,
+                 help_text: str,
+                 read: Callable,
+                 label: Optional[str] = None):
+        super().__init__(name, help_text)
+        self.read = read
+        self.label = label
+
+    def samples(self) -> list:
+        if self.label is None:
+            values = {(): self.read()}
+        else:
+            values = {
+                label_key({self.label: value}): number
+                for value, number in self.read().items()
+            }
+
+        return [
+            "%s%s %s" % (self.name, format_labels(key), format_value(value))
+            for key, value in sorted(values.items())
+        ]
+
+
+def label_key(labels: dict) -> tuple:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(key: tuple) -> str:
+    if not key:
+        return ""
+
+    return "{%s}" % ",".join('%s="%s"' % (name, value.replace(
+        "\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                             for name, value in key)
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+# Metrics recorded outside of the HTTP server
+save_seconds = Histogram("wvote_save_seconds",
+                         "Time spent writing weeks to disk")
+save_bytes = Counter("wvote_save_bytes_total", "Bytes of weeks written")
+week_load_seconds = Histogram("wvote_week_load_seconds",
+                              "Time spent loading weeks from disk")
+tally_seconds = Histogram("wvote_tally_seconds",
+                          "Time spent ranking entries")
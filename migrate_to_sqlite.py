@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+One-shot migration from the pickle backend to the SQLite backend.
+
+Reads weeks/current-week.pickle (plus its vote journal), weeks/next-week.pickle
+and every pickle in weeks/archive/, and writes them into the database at
+config.sqlite_path. Afterwards, set storage_backend = "sqlite" in botconfig.py.
+
+Usage: migrate_to_sqlite.py [--force]
+"""
+
+import glob
+import logging
+import os
+import pickle
+import sys
+
+import compo
+import sqlite_store
+from config import config
+
+
+def load_pickle(filename: str) -> dict:
+    with open(filename, "rb") as pickle_file:
+        week = pickle.load(pickle_file)
+
+    compo.externalize_files(week)
+    compo.index_votes(week)
+
+    return week
+
+
+def main() -> int:
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+    force = "--force" in sys.argv[1:]
+
+    db = sqlite_store.SQLiteStore(config.sqlite_path)
+
+    if db.slots() and not force:
+        print("%s already holds weeks; pass --force to overwrite them" %
+              config.sqlite_path)
+        return 1
+
+    for filename in sorted(glob.glob("weeks/archive/*.pickle")):
+        slot = "archive/" + os.path.splitext(os.path.basename(filename))[0]
+        db.import_week(slot, load_pickle(filename))
+        print("Imported %s as %s" % (filename, slot))
+
+    if os.path.exists("weeks/current-week.pickle"):
+        current_week = load_pickle("weeks/current-week.pickle")
+        compo.replay_journal(current_week)
+        db.import_week("current", current_week)
+        print("Imported the current week (%d entries, %d ballots)" %
+              (len(current_week["entries"]), len(current_week["votes"])))
+
+    if os.path.exists("weeks/next-week.pickle"):
+        next_week = load_pickle("weeks/next-week.pickle")
+        db.import_week("next", next_week)
+        print("Imported next week (%d entries)" % len(next_week["entries"]))
+
+    db.close()
+
+    print("Done! Set storage_backend = \"sqlite\" in botconfig.py to use it.")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
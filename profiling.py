@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+On-demand profiling for a running server, for admins to find out what's
+slow (or what's using memory) without restarting it.
+
+cProfile only sees the thread that started it, which is the event loop's:
+handlers, the tally and entry rendering all run there. Work handed to an
+executor (like writing saves) shows up as time spent waiting on it.
+"""
+
+import asyncio
+import cProfile
+import io
+import logging
+import marshal
+import pstats
+import tracemalloc
+
+# Longest a profile may run for, in seconds
+max_profile_seconds = 300
+
+# How many frames of traceback tracemalloc keeps for each allocation
+trace_frames = 1
+
+# The profile being taken, if any; only one can run at a time
+active_profile = None
+
+# The last heap snapshot, for comparing the next one against
+last_snapshot = None
+
+
+class ProfilerBusyError(Exception):
+    """Raised when starting a profile while another is still running."""
+    pass
+
+
+async def profile_for(seconds: float) -> cProfile.Profile:
+    """
+    Profiles the event loop for `seconds` (capped at `max_profile_seconds`),
+    while it carries on serving as usual.
+
+    Raises
+    ------
+    ProfilerBusyError
+        If another profile is already running
+    """
+    global active_profile
+
+    if active_profile is not None:
+        raise ProfilerBusyError("A profile is already running")
+
+    seconds = max(0.0, min(float(seconds), max_profile_seconds))
+
+    profiler = cProfile.Profile()
+    active_profile = profiler
+    logging.info("PROFILE: Profiling for %g seconds" % seconds)
+
+    try:
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+    finally:
+        active_profile = None
+
+    return profiler
+
+
+def pstats_bytes(profiler: cProfile.Profile) -> bytes:
+    """
+    Returns a profile in the same format as `cProfile.Profile.dump_stats`,
+    for loading with `pstats.Stats` or a viewer like snakeviz.
+    """
+    profiler.create_stats()
+    return marshal.dumps(profiler.stats)
+
+
+def pstats_text(profiler: cProfile.Profile,
+                sort: str = "cumulative",
+                limit: int = 40) -> str:
+    """Returns the top `limit` functions of a profile, as pstats prints them."""
+    output = io.StringIO()
+    stats = pstats.Stats(profiler, stream=output)
+    stats.sort_stats(sort).print_stats(limit)
+    return output.getvalue()
+
+
+def heap_snapshot(limit: int = 25) -> str:
+    """
+    Lists the lines that allocated the most memory still in use.
+
+    Allocations are only seen once tracing has started, so the first call
+    starts it and reports what little has been allocated since. Later calls
+    also list what grew the most since the previous snapshot.
+    """
+    global last_snapshot
+
+    lines = []
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(trace_frames)
+        last_snapshot = None
+        logging.info("PROFILE: Started tracing memory allocations")
+        lines += [
+            "Started tracing allocations just now; take another snapshot "
+            "later to see more.", ""
+        ]
+
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ])
+
+    current, peak = tracemalloc.get_traced_memory()
+    lines += [
+        "Traced memory: %s current, %s peak" %
+        (format_size(current), format_size(peak)), "",
+        "Top %d allocations by line:" % limit
+    ]
+    lines += [str(stat) for stat in snapshot.statistics("lineno")[:limit]]
+
+    if last_snapshot is not None:
+        lines += ["", "Top %d changes since the last snapshot:" % limit]
+        lines += [
+            str(stat)
+            for stat in snapshot.compare_to(last_snapshot, "lineno")[:limit]
+        ]
+
+    last_snapshot = snapshot
+    return "\n".join(lines) + "\n"
+
+
+def stop_heap_tracing() -> bool:
+    """
+    Stops tracing memory allocations, which slows every allocation down.
+
+    Returns
+    -------
+    bool
+        False if allocations weren't being traced
+    """
+    global last_snapshot
+
+    last_snapshot = None
+    if not tracemalloc.is_tracing():
+        return False
+
+    tracemalloc.stop()
+    logging.info("PROFILE: Stopped tracing memory allocations")
+    return True
+
+
+def format_size(size: float) -> str:
+    for unit in ["B", "KiB", "MiB"]:
+        if abs(size) < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024
+    return "%.1f GiB" % size
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+schema = """
+CREATE TABLE IF NOT EXISTS weeks (
+    id INTEGER PRIMARY KEY,
+    -- "current", "next", or "archive/<name>"
+    slot TEXT NOT NULL UNIQUE,
+    -- Every week setting except entries and votes, as JSON
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS entries (
+    week_id INTEGER NOT NULL REFERENCES weeks(id),
+    uuid TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    discord_id INTEGER,
+    -- The entry dict, as JSON. Files are blob digests, not contents.
+    data TEXT NOT NULL,
+    PRIMARY KEY (week_id, uuid)
+);
+-- For loading a week's entries in order
+CREATE INDEX IF NOT EXISTS entries_by_position ON entries(week_id, position);
+
+CREATE TABLE IF NOT EXISTS ballots (
+    week_id INTEGER NOT NULL REFERENCES weeks(id),
+    user_id INTEGER NOT NULL,
+    user_name TEXT,
+    -- Ballots are listed in the order they were (last) cast
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (week_id, user_id)
+);
+-- For loading ballots in order, and numbering the next one
+CREATE INDEX IF NOT EXISTS ballots_by_seq ON ballots(week_id, seq);
+
+CREATE TABLE IF NOT EXISTS ratings (
+    week_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    entry_uuid TEXT NOT NULL,
+    vote_param TEXT NOT NULL,
+    rating INTEGER NOT NULL,
+    vote_for_name TEXT,
+    PRIMARY KEY (week_id, user_id, position)
+);
+
+-- Counts the commits that changed weeks or entries ("weeks") and ballots
+-- ("ballots"), so other processes can tell which they need to reload
+CREATE TABLE IF NOT EXISTS versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+
+-- Signed admin keys revoked before they expired, checked by every process
+CREATE TABLE IF NOT EXISTS revoked_keys (
+    nonce TEXT PRIMARY KEY,
+    -- Unix time the key would have expired at anyway
+    expires REAL NOT NULL
+);
+
+-- Weeks are always read whole, so lookups by entry never reach the database.
+-- Earlier versions indexed for them anyway; those indexes only slowed writes.
+DROP INDEX IF EXISTS entries_by_uuid;
+DROP INDEX IF EXISTS entries_by_discord_id;
+DROP INDEX IF EXISTS ratings_by_entry;
+"""
+
+
+class SQLiteStore:
+    """
+    Keeps weeks, entries, ballots and ratings in an SQLite database, so
+    that a single ballot or entry can be written without rewriting the
+    whole week.
+
+    Methods are safe to call from the event loop and from executor threads
+    at the same time.
+
+    Other processes may write to the same database. Saves only write what
+    changed since this store last read or wrote a week, so they don't undo
+    what the others did in the meantime.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        # What each week's row and entries held when we last read or wrote
+        # them: {week ID: (data, {uuid: (position, discord ID, data)})}
+        self.known = {}
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(schema)
+        self.connection.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+    # Reading
+    def data_version(self) -> int:
+        """
+        A stamp that changes whenever another connection (such as another
+        process) commits a change to the database, but not for our own.
+        """
+        with self.lock:
+            return self.connection.execute(
+                "PRAGMA data_version").fetchone()[0]
+
+    def week_id(self, slot: str) -> Optional[int]:
+        """Looks up a week's row ID. The caller must hold `lock`."""
+        row = self.connection.execute("SELECT id FROM weeks WHERE slot = ?",
+                                      (slot, )).fetchone()
+        return None if row is None else row[0]
+
+    def load_week(self, slot: str) -> Optional[dict]:
+        """
+        Reads a week back into the same layout compo keeps it in, with
+        ballots mapped by voter. Returns None if there is no week in that
+        slot.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT id, data FROM weeks WHERE slot = ?",
+                (slot, )).fetchone()
+            if row is None:
+                return None
+
+            week_id, data = row
+            week = json.loads(data)
+
+            known_entries = {}
+            week["entries"] = []
+            for uuid, *row in self.connection.execute(
+                    "SELECT uuid, position, discord_id, data FROM entries "
+                    "WHERE week_id = ? ORDER BY position", (week_id, )):
+                known_entries[uuid] = tuple(row)
+                week["entries"].append(json.loads(row[2]))
+            self.known[week_id] = (data, known_entries)
+
+            week["votes"] = self.read_ballots(week_id)
+
+        return week
+
+    def load_ballots(self, slot: str) -> dict:
+        """
+        Reads just a week's ballots, mapped by voter as in `load_week`, for
+        when nothing else about it changed.
+        """
+        with self.lock:
+            week_id = self.week_id(slot)
+            return {} if week_id is None else self.read_ballots(week_id)
+
+    def read_ballots(self, week_id: int) -> dict:
+        """The caller must hold `lock`."""
+        ratings = {}
+        for (user_id, entry_uuid, vote_param, rating,
+             vote_for_name) in self.connection.execute(
+                 "SELECT user_id, entry_uuid, vote_param, rating, "
+                 "vote_for_name FROM ratings WHERE week_id = ? "
+                 "ORDER BY user_id, position", (week_id, )):
+            rating_data = {
+                "entryUUID": entry_uuid,
+                "voteParam": vote_param,
+                "rating": rating,
+            }
+            if vote_for_name is not None:
+                rating_data["voteForName"] = vote_for_name
+            ratings.setdefault(user_id, []).append(rating_data)
+
+        return {
+            user_id: {
+                "ratings": ratings.get(user_id, []),
+                "userID": user_id,
+                "userName": user_name,
+            }
+            for user_id, user_name in self.connection.execute(
+                "SELECT user_id, user_name FROM ballots "
+                "WHERE week_id = ? ORDER BY seq", (week_id, ))
+        }
+
+    def versions(self) -> dict:
+        """
+        Returns {"weeks": ..., "ballots": ...}: how many commits have
+        changed weeks and entries, and ballots, so far.
+        """
+        with self.lock:
+            versions = dict(
+                self.connection.execute("SELECT name, version FROM versions"))
+        return {
+            "weeks": versions.get("weeks", 0),
+            "ballots": versions.get("ballots", 0)
+        }
+
+    def bump_version(self, name: str) -> int:
+        """
+        Counts a commit that changes `name` ("weeks" or "ballots"), returning
+        its new version. The caller must hold `lock`, within a transaction.
+        """
+        self.connection.execute(
+            "INSERT INTO versions (name, version) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET version = version + 1", (name, ))
+        return self.connection.execute(
+            "SELECT version FROM versions WHERE name = ?",
+            (name, )).fetchone()[0]
+
+    def key_revoked(self, nonce: str) -> bool:
+        with self.lock:
+            return self.connection.execute(
+                "SELECT 1 FROM revoked_keys WHERE nonce = ? AND expires > ?",
+                (nonce, time.time())).fetchone() is not None
+
+    def slots(self) -> list:
+        with self.lock:
+            return [
+                slot for (slot, ) in self.connection.execute(
+                    "SELECT slot FROM weeks ORDER BY id")
+            ]
+
+    # Writing
+    def snapshot(self, weeks: dict) -> dict:
+        """
+        Serializes the settings and entries of some weeks, keyed by slot, so
+        that `write_snapshot` can store them from another thread. Ballots
+        aren't part of this; they're written one at a time as they come in.
+
+        Slots are resolved to rows right away, so a snapshot taken before
+        `archive_week` still lands on the week it was taken from.
+        """
+        with self.lock, self.connection:
+            return {
+                self.slot_week_id(slot): (json.dumps(week_settings(week)), [
+                    (entry["uuid"], position, entry.get("discordID"),
+                     json.dumps(entry))
+                    for position, entry in enumerate(week["entries"])
+                ])
+                for slot, week in weeks.items()
+            }
+
+    def write_snapshot(self, snapshot: dict) -> None:
+        """
+        Writes the settings and entries that changed since this store last
+        read or wrote each week. Only entries it knew about can be deleted;
+        any others were just added by another process.
+        """
+        written = {}
+
+        with self.lock:
+            with self.connection:
+                for week_id, (data, entries) in snapshot.items():
+                    known_data, known_entries = self.known.get(
+                        week_id, (None, {}))
+
+                    changed_entries = [
+                        (uuid, week_id, position, discord_id, entry_data)
+                        for uuid, position, discord_id, entry_data in entries
+                        if known_entries.get(uuid) != (position, discord_id,
+                                                       entry_data)
+                    ]
+                    uuids = {entry[0] for entry in entries}
+                    deleted = [(week_id, uuid) for uuid in known_entries
+                               if uuid not in uuids]
+
+                    if data != known_data or changed_entries or deleted:
+                        self.bump_version("weeks")
+
+                    if data != known_data:
+                        self.connection.execute(
+                            "UPDATE weeks SET data = ? WHERE id = ?",
+                            (data, week_id))
+
+                    self.connection.executemany(
+                        "INSERT INTO entries "
+                        "(uuid, week_id, position, discord_id, data) "
+                        "VALUES (?, ?, ?, ?, ?) "
+                        "ON CONFLICT(week_id, uuid) DO UPDATE SET "
+                        "position = excluded.position, "
+                        "discord_id = excluded.discord_id, "
+                        "data = excluded.data", changed_entries)
+
+                    # Drop entries that were deleted from the week
+                    self.connection.executemany(
+                        "DELETE FROM entries WHERE week_id = ? AND uuid = ?",
+                        deleted)
+
+                    written[week_id] = (data, {
+                        uuid: (position, discord_id, entry_data)
+                        for uuid, position, discord_id, entry_data in entries
+                    })
+
+            self.known.update(written)
+
+    def slot_week_id(self, slot: str) -> int:
+        """
+        Looks up a week's row ID, adding an empty row if the slot has none
+        yet. The caller must hold `lock`.
+        """
+        week_id = self.week_id(slot)
+        if week_id is None:
+            week_id = self.connection.execute(
+                "INSERT INTO weeks (slot, data) VALUES (?, '{}')",
+                (slot, )).lastrowid
+            self.bump_version("weeks")
+        return week_id
+
+    def upsert_ballot(self, slot: str, vote: dict) -> int:
+        """
+        Adds or replaces a single user's ballot for a week.
+
+        Returns
+        -------
+        int
+            The "ballots" version this made (see `versions`)
+        """
+        user_id = int(vote["userID"])
+
+        with self.lock, self.connection:
+            self.write_ballot(self.slot_week_id(slot), user_id, vote)
+            return self.bump_version("ballots")
+
+    def write_ballot(self, week_id: int, user_id: int, vote: dict) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO ballots "
+            "(week_id, user_id, user_name, seq) VALUES (?, ?, ?, "
+            "(SELECT COALESCE(MAX(seq), 0) + 1 FROM ballots "
+            "WHERE week_id = ?))",
+            (week_id, user_id, vote.get("userName"), week_id))
+        self.connection.execute(
+            "DELETE FROM ratings WHERE week_id = ? AND user_id = ?",
+            (week_id, user_id))
+        self.connection.executemany(
+            "INSERT INTO ratings (week_id, user_id, position, entry_uuid, "
+            "vote_param, rating, vote_for_name) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(week_id, user_id, position, r["entryUUID"], r["voteParam"],
+              r["rating"], r.get("voteForName"))
+             for position, r in enumerate(vote["ratings"])])
+
+    def delete_ballot(self, slot: str, user_id: int) -> int:
+        """Like `upsert_ballot`, but removes the user's ballot."""
+        with self.lock, self.connection:
+            week_id = self.week_id(slot)
+            self.connection.execute(
+                "DELETE FROM ballots WHERE week_id = ? AND user_id = ?",
+                (week_id, user_id))
+            self.connection.execute(
+                "DELETE FROM ratings WHERE week_id = ? AND user_id = ?",
+                (week_id, user_id))
+            return self.bump_version("ballots")
+
+    def revoke_key(self, nonce: str, expires: float) -> None:
+        """Records a revoked key, and forgets any that have expired since."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM revoked_keys WHERE expires <= ?", (time.time(), ))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO revoked_keys (nonce, expires) "
+                "VALUES (?, ?)", (nonce, expires))
+
+    def archive_week(self, name: str) -> str:
+        """
+        Moves the current week into an archive slot and next week into the
+        current slot. No rows besides the two weeks' own are touched.
+
+        Returns
+        -------
+        str
+            The slot the week was archived into
+        """
+        with self.lock, self.connection:
+            slot = "archive/" + name
+            suffix = 1
+            while self.week_id(slot) is not None:
+                suffix += 1
+                slot = "archive/%s-%d" % (name, suffix)
+
+            self.connection.execute(
+                "UPDATE weeks SET slot = ? WHERE slot = 'current'", (slot, ))
+            self.connection.execute(
+                "UPDATE weeks SET slot = 'current' WHERE slot = 'next'")
+            self.bump_version("weeks")
+
+        logging.info("SQLITE: Archived current week as %s" % slot)
+
+        return slot
+
+    def import_week(self, slot: str, week: dict) -> None:
+        """Writes a whole week, ballots included, replacing that slot."""
+        snapshot = self.snapshot({slot: week})
+
+        with self.lock, self.connection:
+            week_id = self.week_id(slot)
+            for table in ["entries", "ballots", "ratings"]:
+                self.connection.execute(
+                    "DELETE FROM %s WHERE week_id = ?" % table, (week_id, ))
+            self.known.pop(week_id, None)
+            self.bump_version("weeks")
+
+        self.write_snapshot(snapshot)
+
+        with self.lock, self.connection:
+            for vote in week["votes"].values():
+                self.write_ballot(week_id, int(vote["userID"]), vote)
+            self.bump_version("ballots")
+
+
+def week_settings(week: dict) -> dict:
+    return {
+        key: value
+        for key, value in week.items() if key not in ["entries", "votes"]
+    }
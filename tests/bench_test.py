@@ -0,0 +1,39 @@
+import os
+
+import blobs
+import compo
+from bench.synthetic import synthetic_week
+
+
+class TestSyntheticWeek:
+    def test_has_the_requested_shape(self):
+        week = synthetic_week(entries=5, voters=7, ratings_per_voter=4)
+
+        assert len(week["entries"]) == 5
+        assert compo.count_valid_entries(week) == 5
+        assert len(week["votes"]) == 7
+        assert all(len(v["ratings"]) == 4 for v in week["votes"].values())
+
+    def test_ballots_pass_validation(self):
+        week = synthetic_week(entries=4, voters=10, ratings_per_voter=100)
+        uuids = compo.entry_index(week)["uuid"]
+
+        for v in week["votes"].values():
+            # Capped at one rating per entry and parameter
+            assert len(v["ratings"]) == 4 * len(week["voteParams"])
+            assert compo.validate_ratings(v["ratings"], week["voteParams"],
+                                          uuids) == v["ratings"]
+
+    def test_is_deterministic(self):
+        assert synthetic_week(seed=3, voters=5) == \
+            synthetic_week(seed=3, voters=5)
+
+    def test_stores_files_of_the_given_size(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(blobs, "blob_dir", str(tmp_path))
+
+        week = synthetic_week(entries=2, voters=0, mp3_size=1000, pdf_size=10)
+
+        for entry in week["entries"]:
+            path = compo.get_entry_file_path(entry, "mp3")
+            assert os.path.getsize(path) == 1000
+            assert entry["pdfSize"] == 10
@@ -0,0 +1,110 @@
+import hashlib
+import os
+import stat
+
+import pytest
+import blobs
+
+
+@pytest.fixture(autouse=True)
+def blob_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(blobs, "blob_dir", str(tmp_path / "blobs"))
+    return tmp_path / "blobs"
+
+
+def stored(digest):
+    with open(blobs.blob_path(digest), "rb") as blob_file:
+        return blob_file.read()
+
+
+@pytest.fixture()
+def disk_calls(monkeypatch):
+    """Records what gets synced and renamed, in order"""
+    calls = []
+    fsync, replace = os.fsync, os.replace
+
+    def record_fsync(fd):
+        calls.append(("fsync", stat.S_ISDIR(os.fstat(fd).st_mode)))
+        fsync(fd)
+
+    def record_replace(source, destination):
+        calls.append(("replace", None))
+        replace(source, destination)
+
+    monkeypatch.setattr(os, "fsync", record_fsync)
+    monkeypatch.setattr(os, "replace", record_replace)
+    return calls
+
+
+class TestPut:
+    def test_returns_sha256(self):
+        digest = blobs.put(b"eight bit music theory")
+        assert digest == hashlib.sha256(b"eight bit music theory").hexdigest()
+
+    def test_same_data_same_blob(self, blob_dir):
+        assert blobs.put(b"beep") == blobs.put(b"beep")
+        assert len(list(blob_dir.rglob("*"))) == 2  # one fan-out dir, one blob
+
+    def test_no_temp_files_left_behind(self, blob_dir):
+        blobs.put(b"boop")
+        assert not list(blob_dir.rglob("*.tmp"))
+
+    def test_synced_around_the_rename(self, disk_calls):
+        blobs.put(b"durable")
+        # The file itself, then its directory entry
+        assert disk_calls == [("fsync", False), ("replace", None),
+                              ("fsync", True)]
+
+
+class TestBlobPath:
+    def test_roundtrip(self):
+        digest = blobs.put(b"\x00\xff" * 1000)
+        assert stored(digest) == b"\x00\xff" * 1000
+
+    def test_blob_path_rejects_garbage(self):
+        with pytest.raises(ValueError):
+            blobs.blob_path("../" + "a" * 61)
+
+
+class TestBlobWriter:
+    def test_streams_into_the_store(self, blob_dir):
+        with blobs.BlobWriter() as writer:
+            for chunk in [b"eight ", b"bit ", b"music"]:
+                writer.write(chunk)
+            digest = writer.commit()
+
+        assert digest == hashlib.sha256(b"eight bit music").hexdigest()
+        assert writer.size == 15
+        assert stored(digest) == b"eight bit music"
+        assert not list(blob_dir.rglob("*.tmp"))
+
+    def test_same_data_as_put(self):
+        digest = blobs.put(b"beep")
+
+        with blobs.BlobWriter() as writer:
+            writer.write(b"beep")
+            assert writer.commit() == digest
+
+        assert stored(digest) == b"beep"
+
+    def test_uncommitted_data_is_thrown_away(self, blob_dir):
+        with blobs.BlobWriter() as writer:
+            writer.write(b"half an upl")
+
+        assert list(blob_dir.rglob("*")) == []
+
+    def test_synced_around_the_rename(self, disk_calls):
+        with blobs.BlobWriter() as writer:
+            writer.write(b"durable")
+            writer.commit()
+
+        assert disk_calls == [("fsync", False), ("replace", None),
+                              ("fsync", True)]
+
+    def test_thrown_away_on_error(self, blob_dir):
+        with pytest.raises(ConnectionResetError):
+            with blobs.BlobWriter() as writer:
+                writer.write(b"half an upl")
+                raise ConnectionResetError()
+
+        assert list(blob_dir.rglob("*")) == []
@@ -0,0 +1,273 @@
+import asyncio
+import os
+import tracemalloc
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+import blobs
+import bot
+import compo
+import profiling
+
+
+def valid_entry(n):
+    entry = compo.create_blank_entry("Entrant %d" % n, 1000 + n)
+    entry.update({
+        "entryName": "Entry %d" % n,
+        "mp3Format": "mp3",
+        "mp3Filename": "song%d.mp3" % n,
+        "pdfFilename": "score%d.pdf" % n,
+    })
+    compo.set_entry_file(entry, "mp3", b"mp3 %d" % n)
+    compo.set_entry_file(entry, "pdf", b"pdf %d" % n)
+    return entry
+
+
+class TestPublishEntries:
+    @pytest.fixture(autouse=True)
+    def week(self, tmp_path, monkeypatch, mocker):
+        monkeypatch.setattr(blobs, "blob_dir", str(tmp_path))
+        mocker.patch.object(bot.client, "get_user", return_value=None)
+
+        self.fetch_user = mocker.patch.object(bot.client, "fetch_user",
+                                              new=AsyncMock())
+
+        async def fetch_user(user_id):
+            await asyncio.sleep(0.01)
+            user = MagicMock()
+            user.mention = "<@%d>" % user_id
+            return user
+
+        self.fetch_user.side_effect = fetch_user
+
+        self.week = compo.blank_week()
+        for n in range(7):
+            self.week["entries"].append(valid_entry(n))
+        # Invalid entries are skipped, and don't count towards numbering
+        self.week["entries"].insert(3, compo.create_blank_entry("Nope", 9))
+
+        self.context = MagicMock()
+        self.context.send = AsyncMock()
+        self.context.author.send = AsyncMock()
+        self.context.prefix = "8!"
+        self.context.invoked_with = "postentries"
+
+    def posted(self):
+        return [
+            call.args[0] for call in self.context.send.call_args_list
+        ]
+
+    def test_posts_in_order(self):
+        asyncio.run(bot.publish_entries(self.context, self.week))
+
+        assert self.posted() == [
+            "<@%d> - Entry %d" % (1000 + n, n) for n in range(7)
+        ]
+        files = self.context.send.call_args_list[0].kwargs["files"]
+        assert [f.filename for f in files] == ["song0.mp3", "score0.pdf"]
+
+    def test_users_are_fetched_concurrently(self, monkeypatch):
+        monkeypatch.setattr(bot, "publish_fetch_limit", 7)
+        running = []
+        peak = []
+
+        async def fetch_user(user_id):
+            running.append(user_id)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(user_id)
+            return None
+
+        self.fetch_user.side_effect = fetch_user
+
+        asyncio.run(bot.publish_entries(self.context, self.week))
+
+        assert max(peak) == 7
+        assert self.posted()[0] == "@Entrant 0 - Entry 0"
+
+    def test_files_are_attached_from_disk(self):
+        asyncio.run(bot.publish_entries(self.context, self.week))
+
+        files = self.context.send.call_args_list[0].kwargs["files"]
+        assert files[0].fp.name == \
+            blobs.blob_path(self.week["entries"][0]["mp3"])
+
+    def test_big_files_are_split_by_stored_size(self):
+        self.week["entries"][0]["mp3Size"] = 8 * 1000 * 1000
+
+        asyncio.run(bot.publish_entries(self.context, self.week))
+
+        assert self.posted()[:3] == \
+            ["<@1000> - Entry 0", "", "<@1001> - Entry 1"]
+
+    def test_continues_from_entry(self):
+        asyncio.run(bot.publish_entries(self.context, self.week, 5))
+
+        assert self.posted() == [
+            "<@%d> - Entry %d" % (1000 + n, n) for n in range(4, 7)
+        ]
+
+    def test_out_of_range_start(self):
+        asyncio.run(bot.publish_entries(self.context, self.week, 8))
+
+        assert "between 1 and 7" in self.posted()[0]
+
+    def test_failures_are_reported_with_where_to_resume(self):
+        os.remove(blobs.blob_path(self.week["entries"][2]["pdf"]))
+
+        asyncio.run(bot.publish_entries(self.context, self.week))
+
+        assert self.posted()[2] == "(Failed to upload this entry!)"
+        assert len(self.posted()) == 7
+        last_report = self.context.author.send.call_args_list[-1].args[0]
+        assert "`8!postentries 3`" in last_report
+
+
+class TestOutbox:
+    @pytest.fixture(autouse=True)
+    def fast_outbox(self, monkeypatch, mocker):
+        monkeypatch.setattr(bot, "outbox", {})
+        monkeypatch.setattr(bot, "outbox_task", None)
+        monkeypatch.setattr(bot, "outbox_changed", None)
+        monkeypatch.setattr(bot, "outbox_coalesce_delay", 0.05)
+        monkeypatch.setattr(bot, "outbox_retry_delay", 0.01)
+        self.notify = mocker.patch("bot.notify_admins", new=AsyncMock())
+
+    def entry(self, name):
+        entry = compo.create_blank_entry(name, 0)
+        entry["entryName"] = name
+        return entry
+
+    def run(self, edits):
+        async def submit():
+            await edits()
+            await asyncio.wait_for(bot.outbox_task, 1)
+
+        asyncio.run(submit())
+
+    def sent(self):
+        return [call.args[0] for call in self.notify.call_args_list]
+
+    def test_returns_before_sending(self):
+        async def edits():
+            bot.submission_message(self.entry("Quick"), False)
+            assert not self.notify.called
+
+        self.run(edits)
+
+        assert len(self.sent()) == 1
+
+    def test_edits_to_one_entry_are_coalesced(self):
+        first = self.entry("First")
+        second = self.entry("Second")
+
+        async def edits():
+            bot.submission_message(first, False)
+            first["entryName"] = "First, edited"
+            await asyncio.sleep(0.01)
+            bot.submission_message(second, False)
+            bot.submission_message(first, True)
+
+        self.run(edits)
+
+        sent = self.sent()
+        assert len(sent) == 2
+        assert 'submitted "First, edited"' in sent[0]
+        assert "performed by an admin" in sent[0]
+        assert 'submitted "Second"' in sent[1]
+
+    def test_failed_sends_are_retried(self):
+        self.notify.side_effect = [ConnectionError("discord is down"), None]
+
+        async def edits():
+            bot.submission_message(self.entry("Retry"), False)
+
+        self.run(edits)
+
+        assert len(self.sent()) == 2
+        assert bot.outbox == {}
+
+    def test_gives_up_eventually(self, monkeypatch):
+        monkeypatch.setattr(bot, "outbox_max_attempts", 3)
+        self.notify.side_effect = ConnectionError("discord is down")
+
+        async def edits():
+            bot.submission_message(self.entry("Doomed"), False)
+
+        self.run(edits)
+
+        assert len(self.sent()) == 3
+        assert bot.outbox == {}
+
+
+class TestProfile:
+    @pytest.fixture(autouse=True)
+    def context(self):
+        self.context = MagicMock()
+        self.context.send = AsyncMock()
+        yield
+        profiling.stop_heap_tracing()
+
+    def test_sends_pstats_and_text(self):
+        asyncio.run(bot.profile.callback(self.context, 0.01))
+
+        files = self.context.send.call_args.kwargs["files"]
+        assert [f.filename.rsplit(".", 1)[1] for f in files] == \
+            ["pstats", "txt"]
+
+    def test_heap(self):
+        asyncio.run(bot.heap.callback(self.context))
+
+        assert self.context.send.call_args.kwargs["file"].filename \
+            .startswith("wvote-heap-")
+        assert tracemalloc.is_tracing()
+
+        asyncio.run(bot.heap.callback(self.context, "stop"))
+
+        assert not tracemalloc.is_tracing()
+
+
+class TestVotingToggles:
+    @pytest.fixture(autouse=True)
+    def weeks(self, mocker):
+        compo.current_week = compo.blank_week()
+        compo.next_week = compo.blank_week()
+
+        # Whether voting was open each time the weeks were saved, or None if
+        # they'd been reloaded by then
+        self.saved = []
+
+        def schedule_save():
+            week = compo.current_week
+            self.saved.append(None if week is None else week["votingOpen"])
+
+        mocker.patch("compo.schedule_save", side_effect=schedule_save)
+
+        async def reload_weeks(message):
+            # As if another process changed the weeks while this was sent
+            compo.current_week = None
+
+        self.context = MagicMock()
+        self.context.send = AsyncMock(side_effect=reload_weeks)
+
+    def test_closing_is_saved_before_replying(self):
+        asyncio.run(bot.closevoting.callback(self.context))
+
+        assert self.saved == [False]
+
+    def test_opening_is_saved_before_replying(self):
+        compo.current_week["votingOpen"] = False
+
+        asyncio.run(bot.openvoting.callback(self.context))
+
+        assert self.saved == [True]
+
+
+class TestHelpMessage:
+    def test_lists_admin_commands_for_admins(self, monkeypatch):
+        monkeypatch.setattr(bot.client, "command_prefix", ["%"])
+        monkeypatch.setattr(compo, "next_week", compo.blank_week())
+
+        assert "`%revoke`" in bot.help_message(True, is_admin=True)
+        assert "`%revoke`" not in bot.help_message(True, is_admin=False)
@@ -1,6 +1,11 @@
-import compo
+import os
+import pytest
+import asyncio
+import pickle
 import uuid
 
+import compo
+
 class TestCreateBlankEntry:
     def test_create_blank_entry_returns_string(self):
         result = compo.create_blank_entry("wiglaf", discord_id="is a wiener")
@@ -79,68 +84,177 @@ class TestLoadWeeks:
         assert result == "CURRENT WEEK"
 
 
+@pytest.fixture()
+def weeks_dir(tmp_path, monkeypatch):
+    """Runs the test from a scratch directory with its own weeks/ folder"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "weeks" / "archive").mkdir(parents=True)
+    monkeypatch.setattr(compo, "journal_filename",
+                        "weeks/current-week.journal")
+    return tmp_path / "weeks"
+
+
+def stored_file(entry, field):
+    with open(compo.get_entry_file_path(entry, field), "rb") as stored:
+        return stored.read()
+
+
+def themed_week(theme):
+    week = compo.blank_week()
+    week["theme"] = theme
+    return week
+
+
 class TestSaveWeeks:
-    def mock_pickle(self, mocker):
-        mocker.patch("compo.pickle.dump", return_value=None)
-        mocker.patch("compo.open")
+    def test_valid_write(self, weeks_dir):
+        compo.current_week = themed_week("Solid")
+        compo.next_week = themed_week("Snake")
 
-    def test_valid_write(self, mocker):
-        self.mock_pickle(mocker)
+        compo.save_weeks()
+
+        current = pickle.loads((weeks_dir / "current-week.pickle").read_bytes())
+        upcoming = pickle.loads((weeks_dir / "next-week.pickle").read_bytes())
+        assert current["theme"] == "Solid"
+        assert upcoming["theme"] == "Snake"
 
-        compo.current_week = "Solid"
-        compo.next_week = "Snake"
+    def test_votes_are_saved_as_a_list(self, weeks_dir):
+        vote = {"userID": 1, "userName": "Otacon", "ratings": []}
+        compo.current_week = themed_week("Liquid")
+        compo.current_week["votes"][1] = vote
+        compo.next_week = themed_week("Ocelot")
 
         compo.save_weeks()
 
-        compo.pickle.dump.assert_called()
-        assert compo.pickle.dump.call_count == 2
+        current = pickle.loads((weeks_dir / "current-week.pickle").read_bytes())
+        assert current["votes"] == [vote]
+        assert compo.current_week["votes"] == {1: vote}
 
-    def test_current_week_none(self, mocker):
-        self.mock_pickle(mocker)
+    def test_no_temp_files_left_behind(self, weeks_dir):
+        compo.current_week = themed_week("Psycho")
+        compo.next_week = themed_week("Mantis")
+
+        compo.save_weeks()
 
+        assert not list(weeks_dir.glob("*.tmp"))
+
+    def test_current_week_none(self, weeks_dir, caplog):
         compo.current_week = None
-        compo.next_week = "Raiden"
+        compo.next_week = themed_week("Raiden")
 
         compo.save_weeks()
 
-        compo.pickle.dump.assert_not_called()
-
-    def test_next_week_none(self, mocker):
-        self.mock_pickle(mocker)
+        assert not list(weeks_dir.glob("*.pickle"))
+        assert "reloaded before they could be saved" in caplog.text
 
-        compo.current_week = "Big Boss"
+    def test_next_week_none(self, weeks_dir):
+        compo.current_week = themed_week("Big Boss")
         compo.next_week = None
 
         compo.save_weeks()
 
-        compo.pickle.dump.assert_not_called()
+        assert not list(weeks_dir.glob("*.pickle"))
+
+
+class TestScheduleSave:
+    @pytest.fixture(autouse=True)
+    def fast_saves(self, weeks_dir, monkeypatch):
+        monkeypatch.setattr(compo, "save_delay", 0.01)
+        compo.current_week = compo.blank_week()
+        compo.next_week = compo.blank_week()
+
+    def saved_theme(self, weeks_dir):
+        week = pickle.loads((weeks_dir / "current-week.pickle").read_bytes())
+        return week["theme"]
+
+    def test_saves_right_away_without_a_loop(self, weeks_dir):
+        compo.schedule_save()
+
+        assert (weeks_dir / "current-week.pickle").exists()
+
+    def test_bumps_the_week_version(self, weeks_dir):
+        version = compo.week_version
+
+        compo.schedule_save()
+
+        assert compo.week_version == version + 1
+
+    def test_flush_writes_pending_changes(self, weeks_dir):
+        async def edit():
+            compo.current_week["theme"] = "Flushed"
+            compo.schedule_save()
+            await compo.flush()
+
+        asyncio.run(edit())
+
+        assert self.saved_theme(weeks_dir) == "Flushed"
+
+    def test_bursts_are_coalesced(self, weeks_dir, mocker):
+        write = mocker.spy(compo, "write_snapshot")
+
+        async def edit():
+            for n in range(10):
+                compo.current_week["theme"] = "Edit %d" % n
+                compo.schedule_save()
+            await compo.flush()
+
+        asyncio.run(edit())
+
+        assert write.call_count == 1
+        assert self.saved_theme(weeks_dir) == "Edit 9"
+
+    def test_journal_kept_for_ballots_after_snapshot(self, weeks_dir):
+        vote = {"userID": 1, "userName": "late", "ratings": []}
+
+        async def edit():
+            compo.upsert_vote(vote)
+            compo.schedule_save()
+            await compo.flush()
+            compo.upsert_vote(dict(vote, userID=2))
+
+        asyncio.run(edit())
+
+        week = compo.blank_week()
+        compo.replay_journal(week)
+        assert list(week["votes"]) == [2]
+
 
 class TestMoveWeeks:
-    def mock_pickle(self, mocker):
-        mocker.patch("compo.pickle.dump", return_value=None)
-        mocker.patch("compo.open")
+    def test_move_weeks_dumps(self, weeks_dir):
+        compo.current_week = compo.blank_week()
+        compo.next_week = compo.blank_week()
 
+        compo.move_to_next_week()
+
+        assert len(list((weeks_dir / "archive").glob("*.pickle"))) == 1
+
+    def test_archive_keeps_ballots_as_a_list(self, weeks_dir):
+        compo.current_week = compo.blank_week()
+        compo.next_week = compo.blank_week()
+        vote = {"userID": 12, "userName": "voter", "ratings": []}
+        compo.upsert_vote(vote)
 
-    def test_move_weeks_dumps(self, mocker):
-        self.mock_pickle(mocker)
         compo.move_to_next_week()
 
-        compo.pickle.dump.assert_called()
+        archive, = (weeks_dir / "archive").glob("*.pickle")
+        with open(archive, "rb") as f:
+            week = pickle.load(f)
+        assert week["votes"] == [vote]
 
+        compo.index_votes(week)
+        assert week["votes"] == {12: vote}
 
-    def test_move_weeks(self, mocker):
-        self.mock_pickle(mocker)
-        compo.current_week = "Gandalf the Gray"
-        compo.next_week = "Gandalf the White"
+    def test_move_weeks(self, weeks_dir):
+        compo.current_week = themed_week("Gandalf the Gray")
+        compo.next_week = themed_week("Gandalf the White")
 
         compo.move_to_next_week()
 
-        assert compo.current_week == "Gandalf the White"
+        assert compo.current_week == themed_week("Gandalf the White")
         assert compo.next_week == compo.blank_week()
 
 
 class TestFindEntries:
-    def setup(self):
+    def setup_method(self):
         compo.current_week = compo.blank_week()
         compo.next_week = compo.blank_week()
 
@@ -209,7 +323,7 @@ class TestVerifyVotes:
 
         compo.verify_votes(week)
 
-        assert week["votes"] == []
+        assert week["votes"] == {}
 
     def test_a_single_vote_is_ok(self):
         week = compo.blank_week()
@@ -221,11 +335,11 @@ class TestVerifyVotes:
                 "rating": 3
             }]
         }]
-        week["votes"] = votes.copy()
+        week["votes"] = {1234: votes[0]}
 
         compo.verify_votes(week)
 
-        assert week["votes"] == votes
+        assert week["votes"] == {1234: votes[0]}
 
     def test_cant_vote_too_high(self):
         week = compo.blank_week()
@@ -237,11 +351,11 @@ class TestVerifyVotes:
                 "rating": 10
             }]
         }]
-        week["votes"] = votes.copy()
+        week["votes"] = {1234: votes[0]}
 
         compo.verify_votes(week)
 
-        assert week["votes"][0]["ratings"] == []
+        assert week["votes"][1234]["ratings"] == []
 
     def test_cant_vote_too_low(self):
         week = compo.blank_week()
@@ -253,11 +367,11 @@ class TestVerifyVotes:
                 "rating": -5
             }]
         }]
-        week["votes"] = votes.copy()
+        week["votes"] = {1234: votes[0]}
 
         compo.verify_votes(week)
 
-        assert week["votes"][0]["ratings"] == []
+        assert week["votes"][1234]["ratings"] == []
 
     def test_duped_votes_are_discarded(self):
         week = compo.blank_week()
@@ -275,11 +389,57 @@ class TestVerifyVotes:
             "userID": 1234,
             "ratings": [rating1, rating2]
         }]
-        week["votes"] = votes.copy()
+        week["votes"] = {1234: votes[0]}
 
         compo.verify_votes(week)
 
-        assert week["votes"][0]["ratings"] == [rating1]
+        assert week["votes"][1234]["ratings"] == [rating1]
+
+class TestValidateRatings:
+    params = ["prompt", "score", "overall"]
+
+    def rating(self, uuid="123", param="overall", rating=3):
+        return {"voteParam": param, "entryUUID": uuid, "rating": rating}
+
+    def test_good_ratings_are_kept(self):
+        ratings = [self.rating(), self.rating(param="score", rating=0)]
+
+        assert compo.validate_ratings(ratings, self.params,
+                                      {"123"}) == ratings
+
+    def test_bad_ratings_are_dropped(self):
+        good = self.rating(rating=5)
+        ratings = [
+            self.rating(rating=6),
+            self.rating(rating=-1),
+            self.rating(rating="3"),
+            self.rating(rating=True),
+            self.rating(param="vibes"),
+            self.rating(uuid="456"),
+            {"voteParam": "overall", "entryUUID": "123"},
+            "not a rating",
+            good,
+        ]
+
+        assert compo.validate_ratings(ratings, self.params,
+                                      {"123"}) == [good]
+
+    def test_repeats_are_dropped_without_skipping(self):
+        ratings = [
+            self.rating(rating=1),
+            self.rating(rating=2),
+            self.rating(rating=3),
+            self.rating(param="score", rating=4),
+        ]
+
+        assert compo.validate_ratings(ratings, self.params) == \
+            [ratings[0], ratings[3]]
+
+    def test_any_entry_allowed_without_uuids(self):
+        ratings = [self.rating(uuid="whatever")]
+
+        assert compo.validate_ratings(ratings, self.params) == ratings
+
 
 class TestNormalizeVotes:
     def test_no_votes_means_no_scores(self):
@@ -330,3 +490,304 @@ class TestNormalizeVotes:
         scores = compo.normalize_votes(votes)
 
         assert scores == {"123": [(1, "overall")], "777": [(5, "overall")]}
+
+class TestEntryFiles:
+    @pytest.fixture(autouse=True)
+    def blob_dir(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(compo.blobs, "blob_dir", str(tmp_path))
+
+    def test_set_entry_file_stores_digest(self):
+        entry = compo.create_blank_entry("Blobby", 0)
+
+        compo.set_entry_file(entry, "pdf", b"%PDF-1.4")
+
+        assert compo.blobs.is_digest(entry["pdf"])
+        assert entry["pdfSize"] == 8
+        assert stored_file(entry, "pdf") == b"%PDF-1.4"
+
+    def test_external_mp3_has_no_file(self):
+        entry = compo.create_blank_entry("Linky", 0)
+        entry["mp3"] = "https://clyp.it/abcd"
+        entry["mp3Format"] = "external"
+
+        assert compo.get_entry_file_path(entry, "mp3") is None
+
+    def test_file_path_and_size(self):
+        entry = compo.create_blank_entry("Blobby", 0)
+        compo.set_entry_file(entry, "pdf", b"%PDF-1.4")
+
+        path = compo.get_entry_file_path(entry, "pdf")
+
+        assert open(path, "rb").read() == b"%PDF-1.4"
+        assert compo.get_entry_file_size(entry, "pdf") == 8
+
+        # Sizes that weren't noted down come from the file itself
+        del entry["pdfSize"]
+        assert compo.get_entry_file_size(entry, "pdf") == 8
+
+    def test_missing_file_has_no_path(self):
+        entry = compo.create_blank_entry("Blobby", 0)
+        compo.set_entry_file(entry, "pdf", b"%PDF-1.4")
+        os.remove(compo.get_entry_file_path(entry, "pdf"))
+
+        assert compo.get_entry_file_path(entry, "pdf") is None
+        assert compo.get_entry_file_path(entry, "mp3") is None
+
+    def test_externalize_inline_files(self):
+        week = compo.blank_week()
+        entry = compo.create_blank_entry("Old Timer", 0)
+        entry["mp3"] = b"ID3 old mp3 bytes"
+        entry["mp3Format"] = "mp3"
+        week["entries"].append(entry)
+
+        assert compo.externalize_files(week)
+        assert compo.blobs.is_digest(entry["mp3"])
+        assert entry["mp3Size"] == len(b"ID3 old mp3 bytes")
+        assert stored_file(entry, "mp3") == b"ID3 old mp3 bytes"
+
+        # A second pass has nothing left to move
+        assert not compo.externalize_files(week)
+
+
+class TestVoteJournal:
+    @pytest.fixture(autouse=True)
+    def journal(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(compo, "journal_filename",
+                            str(tmp_path / "current-week.journal"))
+        monkeypatch.setattr(compo, "journal_records", 0)
+        compo.current_week = compo.blank_week()
+        compo.next_week = compo.blank_week()
+        return tmp_path / "current-week.journal"
+
+    def vote(self, user_id, rating):
+        return {
+            "userID": user_id,
+            "userName": "voter",
+            "ratings": [{
+                "voteParam": "overall",
+                "entryUUID": "123",
+                "rating": rating
+            }]
+        }
+
+    def test_upsert_appends_one_record(self, journal):
+        compo.upsert_vote(self.vote(1, 3))
+
+        assert compo.current_week["votes"] == {1: self.vote(1, 3)}
+        assert len(journal.read_text().splitlines()) == 1
+
+    def test_upsert_replaces_earlier_ballot(self):
+        compo.upsert_vote(self.vote(1, 3))
+        compo.upsert_vote(self.vote(2, 4))
+        compo.upsert_vote(self.vote(1, 5))
+
+        assert list(compo.current_week["votes"].values()) == \
+            [self.vote(2, 4), self.vote(1, 5)]
+
+    def test_delete_accepts_string_ids(self):
+        compo.upsert_vote(self.vote(1, 3))
+        compo.delete_vote("1")
+
+        assert compo.current_week["votes"] == {}
+
+    def test_replay_rebuilds_votes(self):
+        compo.upsert_vote(self.vote(1, 3))
+        compo.upsert_vote(self.vote(2, 4))
+        compo.delete_vote(1)
+
+        week = compo.blank_week()
+        compo.replay_journal(week)
+
+        assert week["votes"] == {2: self.vote(2, 4)}
+        assert compo.journal_records == 3
+
+    def test_replay_ignores_torn_record(self, journal):
+        compo.upsert_vote(self.vote(1, 3))
+        with open(journal, "a") as f:
+            f.write('{"op": "upsert", "vo')
+
+        week = compo.blank_week()
+        compo.replay_journal(week)
+
+        assert week["votes"] == {1: self.vote(1, 3)}
+
+    def test_votes_after_torn_record_survive(self, journal):
+        compo.upsert_vote(self.vote(1, 3))
+        with open(journal, "a") as f:
+            f.write('{"op": "upsert", "vo')
+
+        compo.replay_journal(compo.blank_week())
+        compo.upsert_vote(self.vote(2, 4))
+
+        week = compo.blank_week()
+        compo.replay_journal(week)
+
+        assert week["votes"] == {1: self.vote(1, 3), 2: self.vote(2, 4)}
+
+    def test_unterminated_record_is_dropped(self, journal):
+        compo.upsert_vote(self.vote(1, 3))
+        with open(journal, "a") as f:
+            f.write('{"op": "delete", "userID": 1}')
+
+        week = compo.blank_week()
+        compo.replay_journal(week)
+
+        assert week["votes"] == {1: self.vote(1, 3)}
+        assert journal.read_text().count("\n") == 1
+        assert journal.read_text().endswith("\n")
+
+    def test_compacts_past_threshold(self, mocker, monkeypatch):
+        monkeypatch.setattr(compo, "journal_compact_threshold", 2)
+        save = mocker.patch("compo.save_weeks")
+
+        compo.upsert_vote(self.vote(1, 3))
+        save.assert_not_called()
+
+        compo.upsert_vote(self.vote(2, 3))
+        save.assert_called_once()
+
+    def test_ballots_leave_the_week_version_alone(self, mocker, monkeypatch):
+        monkeypatch.setattr(compo, "journal_compact_threshold", 1)
+        mocker.patch("compo.save_weeks")
+        version = compo.week_version
+
+        compo.upsert_vote(self.vote(1, 3))
+        compo.delete_vote(1)
+
+        assert compo.week_version == version
+
+    def test_save_truncates_journal(self, journal, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / "weeks").mkdir()
+        compo.upsert_vote(self.vote(1, 3))
+
+        compo.save_weeks()
+
+        assert journal.read_text() == ""
+        assert compo.journal_records == 0
+
+
+class TestEntryIndex:
+    def setup_method(self):
+        compo.current_week = compo.blank_week()
+        compo.next_week = compo.blank_week()
+
+    def test_find_by_discord_id(self):
+        entry = compo.create_blank_entry("Indexed Guy", 1234)
+        compo.add_entry(compo.next_week, entry)
+
+        assert compo.find_entry_by_discord_id(compo.next_week, 1234) is entry
+        assert compo.find_entry_by_discord_id(compo.current_week, 1234) is None
+
+    def test_find_and_week(self):
+        entry = compo.create_blank_entry("Indexed Guy", 1234)
+        compo.add_entry(compo.current_week, entry)
+
+        assert compo.find_entry_and_week(entry["uuid"]) == \
+            (compo.current_week, entry)
+        assert compo.find_entry_and_week("???") == (None, None)
+
+    def test_removed_entries_are_gone(self):
+        entry = compo.create_blank_entry("Deleted Guy", 99)
+        compo.add_entry(compo.next_week, entry)
+
+        compo.remove_entry(compo.next_week, entry)
+
+        assert compo.next_week["entries"] == []
+        assert compo.find_entry_by_uuid(entry["uuid"]) is None
+        assert compo.find_entry_by_discord_id(compo.next_week, 99) is None
+
+    def test_discord_id_falls_back_to_remaining_entry(self):
+        first = compo.create_blank_entry("Spoofed", None)
+        second = compo.create_blank_entry("Also spoofed", None)
+        compo.add_entry(compo.next_week, first)
+        compo.add_entry(compo.next_week, second)
+
+        compo.remove_entry(compo.next_week, first)
+
+        assert compo.find_entry_by_discord_id(compo.next_week, None) is second
+
+    def test_picks_up_entries_added_directly_once_forgotten(self):
+        compo.find_entry_by_uuid("warm up the index")
+        entry = compo.create_blank_entry("Sneaky Guy", 5)
+
+        compo.next_week["entries"].append(entry)
+        compo.forget_entry_index(compo.next_week)
+
+        assert compo.find_entry_by_uuid(entry["uuid"]) is entry
+
+    def test_duplicate_uuids_are_indexed_once(self):
+        first = compo.create_blank_entry("Original", 1)
+        copy = dict(first, entrantName="Copy")
+        compo.next_week["entries"] += [first, copy]
+
+        index = compo.entry_index(compo.next_week)
+
+        assert compo.find_entry_by_uuid(first["uuid"]) is first
+        assert compo.entry_index(compo.next_week) is index
+
+        compo.remove_entry(compo.next_week, first)
+        assert compo.find_entry_by_uuid(first["uuid"]) is copy
+
+    def test_indexes_are_matched_by_identity(self):
+        old_week = compo.blank_week()
+        old_index = compo.entry_index(old_week)
+
+        assert compo.entry_index(compo.blank_week()) is not old_index
+        assert compo.entry_index(old_week) is old_index
+
+    def test_old_indexes_are_dropped(self, monkeypatch):
+        monkeypatch.setattr(compo, "entry_indexes", [])
+        weeks = [
+            compo.blank_week() for _ in range(compo.max_entry_indexes + 1)
+        ]
+
+        for week in weeks:
+            compo.entry_index(week)
+
+        assert [index["week"] for index in compo.entry_indexes] == weeks[1:]
+
+    def test_archive_drops_old_index(self, mocker):
+        mocker.patch("compo.schedule_save")
+        mocker.patch("compo.pickle.dump")
+        mocker.patch("compo.open")
+        old_week = compo.current_week
+        compo.find_entry_by_uuid("warm up the index")
+
+        compo.move_to_next_week()
+
+        assert all(index["week"] is not old_week
+                   for index in compo.entry_indexes)
+
+
+class TestIndexVotes:
+    def test_list_becomes_mapping_by_voter(self):
+        week = compo.blank_week()
+        first = {"userID": "12", "userName": "a", "ratings": []}
+        second = {"userID": 34, "userName": "b", "ratings": []}
+        week["votes"] = [first, second]
+
+        compo.index_votes(week)
+
+        assert week["votes"] == {12: first, 34: second}
+
+    def test_last_duplicate_wins_and_moves_to_end(self):
+        week = compo.blank_week()
+        old = {"userID": 12, "userName": "a", "ratings": []}
+        other = {"userID": 34, "userName": "b", "ratings": []}
+        new = {"userID": 12, "userName": "a", "ratings": [{}]}
+        week["votes"] = [old, other, new]
+
+        compo.index_votes(week)
+
+        assert list(week["votes"].values()) == [other, new]
+
+    def test_week_for_disk_roundtrip(self):
+        week = compo.blank_week()
+        vote = {"userID": 56, "userName": "c", "ratings": []}
+        week["votes"][56] = vote
+
+        on_disk = compo.week_for_disk(week)
+        compo.index_votes(on_disk)
+
+        assert on_disk == week
@@ -0,0 +1,91 @@
+import gzip
+
+import pytest
+from aiohttp.test_utils import make_mocked_request
+
+import http_cache
+
+body = b'{"entries": [%s]}' % b", ".join([b'"an entry"'] * 200)
+
+
+def request(**headers):
+    return make_mocked_request("GET", "/entry_data", headers=headers)
+
+
+class TestCachedBody:
+    def test_plain_by_default(self):
+        cached = http_cache.CachedBody(body, "application/json")
+
+        response = cached.respond(request())
+
+        assert response.status == 200
+        assert response.body == body
+        assert "Content-Encoding" not in response.headers
+        assert response.headers["Vary"] == "Accept-Encoding"
+        assert response.content_type == "application/json"
+
+    def test_gzip_when_accepted(self, monkeypatch):
+        monkeypatch.setattr(http_cache, "brotli", None)
+        cached = http_cache.CachedBody(body, "application/json")
+
+        response = cached.respond(request(**{"Accept-Encoding": "gzip"}))
+
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(response.body) == body
+
+    def test_brotli_preferred_when_available(self):
+        brotli = pytest.importorskip("brotli")
+        cached = http_cache.CachedBody(body, "application/json")
+
+        response = cached.respond(
+            request(**{"Accept-Encoding": "gzip, deflate, br"}))
+
+        assert response.headers["Content-Encoding"] == "br"
+        assert brotli.decompress(response.body) == body
+
+    def test_brotli_quality_is_kept_down(self, mocker):
+        brotli = mocker.patch.object(http_cache, "brotli")
+        brotli.compress.return_value = b"tiny"
+
+        http_cache.CachedBody(body, "application/json")
+
+        brotli.compress.assert_called_once_with(
+            body, quality=http_cache.brotli_quality)
+
+    def test_refused_encodings_are_skipped(self):
+        cached = http_cache.CachedBody(body, "application/json")
+
+        response = cached.respond(
+            request(**{"Accept-Encoding": "gzip;q=0, br;q=0"}))
+
+        assert "Content-Encoding" not in response.headers
+
+    def test_small_bodies_are_not_compressed(self):
+        cached = http_cache.CachedBody(b"{}", "application/json")
+
+        assert list(cached.variants) == ["identity"]
+
+    def test_each_variant_has_its_own_etag(self):
+        cached = http_cache.CachedBody(body, "application/json")
+
+        assert len(set(cached.etags())) == len(cached.variants)
+
+    def test_not_modified_when_etag_matches(self):
+        cached = http_cache.CachedBody(body, "application/json")
+        etag = cached.respond(request(**{"Accept-Encoding": "gzip"})) \
+            .headers["ETag"]
+
+        response = cached.respond(
+            request(**{"If-None-Match": '"stale", ' + etag}))
+
+        assert response.status == 304
+        assert response.headers["ETag"] == etag
+
+    def test_changed_body_is_sent_again(self):
+        old = http_cache.CachedBody(body, "application/json")
+        new = http_cache.CachedBody(body + b" ", "application/json")
+        etag = old.respond(request()).headers["ETag"]
+
+        response = new.respond(request(**{"If-None-Match": etag}))
+
+        assert response.status == 200
@@ -0,0 +1,441 @@
+import asyncio
+import copy
+import marshal
+import os
+import threading
+import tracemalloc
+
+import aiohttp
+import pytest
+from aiohttp.test_utils import TestClient, TestServer, make_mocked_request
+
+import blobs
+import compo
+import http_server
+import keys
+import profiling
+from config import config
+
+
+@pytest.fixture
+def templates(tmp_path, monkeypatch):
+    monkeypatch.setattr(http_server, "template_dir", str(tmp_path))
+    monkeypatch.setattr(http_server, "template_cache", {})
+    template = tmp_path / "vote.html"
+    template.write_text('<script src="[VUE-URL]"></script>')
+    return template
+
+
+class TestRenderTemplate:
+    def test_fills_in_urls(self, templates):
+        body = http_server.render_template("vote.html")
+
+        html = body.variants["identity"][0].decode()
+        assert html == '<script src="%s"></script>' % \
+            http_server.get_urls()["vue"]
+
+    def test_renders_once(self, templates):
+        first = http_server.render_template("vote.html")
+
+        assert http_server.render_template("vote.html") is first
+
+    def test_rerenders_when_template_changes(self, templates):
+        first = http_server.render_template("vote.html")
+
+        templates.write_text("changed [VUE-URL]")
+        stat = templates.stat()
+        os.utime(templates, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        second = http_server.render_template("vote.html")
+        assert second is not first
+        assert second.variants["identity"][0].startswith(b"changed")
+
+    def test_rerenders_when_urls_change(self, templates, monkeypatch):
+        first = http_server.render_template("vote.html")
+
+        monkeypatch.setattr(config, "test_mode", not config.test_mode)
+
+        assert http_server.render_template("vote.html") is not first
+
+    def test_served_as_utf8_html(self, templates):
+        response = http_server.render_template("vote.html").respond(
+            make_mocked_request("GET", "/"))
+
+        assert response.content_type == "text/html"
+        assert response.charset == "utf-8"
+
+
+class TestFilePost:
+    @pytest.fixture(autouse=True)
+    def week(self, tmp_path, monkeypatch, mocker):
+        monkeypatch.setattr(blobs, "blob_dir", str(tmp_path / "blobs"))
+        mocker.patch("compo.schedule_save")
+        mocker.patch("bot.submission_message")
+
+        compo.current_week = compo.blank_week()
+        compo.next_week = compo.blank_week()
+        self.entry = compo.create_blank_entry("Entrant", 1234)
+        compo.add_entry(compo.next_week, self.entry)
+        self.key = keys.create_edit_key(self.entry["uuid"])
+
+    def upload(self, data: bytes, **fields) -> int:
+        async def post():
+            form = aiohttp.FormData()
+            for name, value in fields.items():
+                form.add_field(name, value)
+            form.add_field("mp3", data, filename="song.mp3")
+
+            app = aiohttp.web.Application()
+            app.router.add_post("/edit/post/{uuid}/{authKey}",
+                                http_server.file_post_handler)
+
+            async with TestClient(TestServer(app)) as client:
+                response = await client.post(
+                    "/edit/post/%s/%s" % (self.entry["uuid"], self.key),
+                    data=form)
+                return response.status
+
+        return asyncio.run(post())
+
+    def test_upload_is_stored(self, tmp_path):
+        data = b"\xff\xfb" * 100000
+
+        assert self.upload(data) == 204
+
+        with open(compo.get_entry_file_path(self.entry, "mp3"), "rb") as f:
+            assert f.read() == data
+        assert self.entry["mp3Size"] == len(data)
+        assert self.entry["mp3Filename"] == "song.mp3"
+        assert not list((tmp_path / "blobs").rglob("*.tmp"))
+
+    def test_edits_land_on_reloaded_entry(self, monkeypatch):
+        commit = blobs.BlobWriter.commit
+
+        def reload_then_commit(writer):
+            # As if another process changed the weeks mid-upload
+            compo.next_week = copy.deepcopy(compo.next_week)
+            return commit(writer)
+
+        monkeypatch.setattr(blobs.BlobWriter, "commit", reload_then_commit)
+
+        assert self.upload(b"\xff\xfb" * 1000) == 204
+
+        entry = compo.find_entry_by_uuid(self.entry["uuid"])
+        assert entry is not self.entry
+        assert entry["mp3Size"] == 2000
+        assert entry["mp3Filename"] == "song.mp3"
+
+    def test_committed_off_the_event_loop(self, monkeypatch):
+        commit = blobs.BlobWriter.commit
+        threads = []
+
+        def record_thread(writer):
+            threads.append(threading.current_thread())
+            return commit(writer)
+
+        monkeypatch.setattr(blobs.BlobWriter, "commit", record_thread)
+
+        assert self.upload(b"\xff\xfb" * 1000) == 204
+
+        assert threads and threads[0] is not threading.main_thread()
+
+    def test_oversized_upload_leaves_entry_alone(self, tmp_path):
+        before = dict(self.entry)
+
+        assert self.upload(b"\0" * (1000 * 1000 * 10 + 1)) == 413
+
+        assert self.entry == before
+        assert list((tmp_path / "blobs").rglob("*")) == []
+
+    def test_rejected_upload_keeps_other_fields_too(self):
+        before = dict(self.entry)
+
+        assert self.upload(b"\0" * (1000 * 1000 * 10 + 1),
+                           entryName="Renamed") == 413
+
+        assert self.entry == before
+
+
+class TestAdminDeleteVote:
+    @pytest.fixture(autouse=True)
+    def weeks(self, mocker):
+        mocker.patch("compo.append_to_journal")
+        compo.current_week = compo.blank_week()
+        compo.next_week = compo.blank_week()
+        compo.current_week["votes"][42] = {
+            "userID": 42,
+            "userName": "voter",
+            "ratings": []
+        }
+        self.key = keys.create_admin_key()
+
+    def delete(self, user_id):
+        async def post():
+            app = aiohttp.web.Application()
+            app.router.add_post("/admin/delete_vote/{authKey}/{userID}",
+                                http_server.admin_deletevote_handler)
+
+            async with TestClient(TestServer(app)) as client:
+                response = await client.post("/admin/delete_vote/%s/%s" %
+                                             (self.key, user_id))
+                return response.status
+
+        return asyncio.run(post())
+
+    def test_deletes_the_ballot(self):
+        assert self.delete("42") == 204
+        assert compo.current_week["votes"] == {}
+
+    def test_non_numeric_user_id_is_not_found(self):
+        assert self.delete("everyone") == 404
+        assert 42 in compo.current_week["votes"]
+
+
+class TestAdminControl:
+    @pytest.fixture(autouse=True)
+    def weeks(self, mocker):
+        self.save = mocker.patch("compo.schedule_save")
+        compo.current_week = compo.blank_week()
+        compo.next_week = compo.blank_week()
+        self.key = keys.create_admin_key()
+
+    def test_changes_land_on_reloaded_weeks(self, monkeypatch):
+        read_json = aiohttp.web_request.BaseRequest.json
+
+        async def reload_while_reading(request):
+            data = await read_json(request)
+            # As if another process changed the weeks meanwhile
+            compo.current_week = copy.deepcopy(compo.current_week)
+            compo.next_week = copy.deepcopy(compo.next_week)
+            return data
+
+        monkeypatch.setattr(aiohttp.web_request.BaseRequest, "json",
+                            reload_while_reading)
+
+        async def post():
+            app = aiohttp.web.Application()
+            app.router.add_post("/admin/edit/{authKey}",
+                                http_server.admin_control_handler)
+
+            async with TestClient(TestServer(app)) as client:
+                response = await client.post(
+                    "/admin/edit/%s" % self.key,
+                    json={
+                        "weeks": [{
+                            "theme": "Now",
+                            "date": "Today",
+                            "votingOpen": False
+                        }, {
+                            "theme": "Later",
+                            "date": "Tomorrow",
+                            "submissionsOpen": False
+                        }]
+                    })
+                return response.status
+
+        assert asyncio.run(post()) == 204
+
+        assert compo.current_week["theme"] == "Now"
+        assert compo.current_week["votingOpen"] is False
+        assert compo.next_week["theme"] == "Later"
+        self.save.assert_called_once()
+
+
+class TestWeekFiles:
+    data = bytes(range(256)) * 100
+
+    @pytest.fixture(autouse=True)
+    def week(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(blobs, "blob_dir", str(tmp_path / "blobs"))
+
+        compo.current_week = compo.blank_week()
+        compo.next_week = compo.blank_week()
+        self.entry = compo.create_blank_entry("Entrant", 1234)
+        self.entry["mp3Format"] = "mp3"
+        self.entry["mp3Filename"] = "my song.mp3"
+        compo.set_entry_file(self.entry, "mp3", self.data)
+        compo.add_entry(compo.current_week, self.entry)
+
+    def get(self, url, method="GET", **headers):
+        async def fetch():
+            app = aiohttp.web.Application()
+            app.router.add_get("/files/{uuid}/{filename}",
+                               http_server.week_files_handler)
+
+            async with TestClient(TestServer(app)) as client:
+                response = await client.request(method, url, headers=headers)
+                return response, await response.read()
+
+        return asyncio.run(fetch())
+
+    def url(self):
+        return http_server.file_url(self.entry, "mp3")
+
+    def test_whole_file(self):
+        response, body = self.get(self.url())
+
+        assert response.status == 200
+        assert body == self.data
+        assert response.headers["Content-Type"] == "audio/mpeg"
+        assert "ETag" in response.headers
+        assert "Last-Modified" in response.headers
+
+    def test_versioned_url_is_immutable(self):
+        assert self.url() == "/files/%s/my%%20song.mp3?v=%s" % \
+            (self.entry["uuid"], self.entry["mp3"][:16])
+
+        response, _ = self.get(self.url())
+
+        assert "immutable" in response.headers["Cache-Control"]
+
+    def test_unversioned_url_is_revalidated(self):
+        response, _ = self.get(self.url().split("?")[0])
+
+        assert response.headers["Cache-Control"] == "no-cache"
+
+    def test_range(self):
+        response, body = self.get(self.url(), Range="bytes=100-199")
+
+        assert response.status == 206
+        assert body == self.data[100:200]
+        assert response.headers["Content-Range"] == \
+            "bytes 100-199/%d" % len(self.data)
+
+    def test_not_modified(self):
+        response, _ = self.get(self.url())
+
+        response, body = self.get(
+            self.url(), **{"If-None-Match": response.headers["ETag"]})
+
+        assert response.status == 304
+        assert body == b""
+
+    def test_head(self):
+        response, body = self.get(self.url(), method="HEAD")
+
+        assert response.status == 200
+        assert body == b""
+        assert response.headers["Content-Length"] == str(len(self.data))
+
+    def test_missing_file(self):
+        response, _ = self.get("/files/%s/other.mp3" % self.entry["uuid"])
+
+        assert response.status == 404
+
+    def test_accel_redirect(self, monkeypatch):
+        monkeypatch.setattr(config, "accel_redirect_prefix", "/internal-blobs/")
+
+        response, body = self.get(self.url())
+
+        digest = self.entry["mp3"]
+        assert response.status == 200
+        assert body == b""
+        assert response.headers["X-Accel-Redirect"] == \
+            "/internal-blobs/%s/%s" % (digest[:2], digest)
+        assert response.headers["Content-Type"] == "audio/mpeg"
+        assert "immutable" in response.headers["Cache-Control"]
+
+
+class TestMetrics:
+    def get(self, url, **headers):
+        async def fetch():
+            app = aiohttp.web.Application(
+                middlewares=[http_server.metrics_middleware])
+            app.router.add_get("/metrics", http_server.metrics_handler)
+            app.router.add_get("/allowed_hosts",
+                               http_server.allowed_hosts_handler)
+
+            async with TestClient(TestServer(app, host="127.0.0.1")) \
+                    as client:
+                response = await client.get(url, headers=headers)
+                return response, await response.text()
+
+        return asyncio.run(fetch())
+
+    def test_requests_are_counted_by_route(self):
+        self.get("/allowed_hosts")
+        self.get("/nowhere")
+
+        response, text = self.get("/metrics")
+
+        assert response.status == 200
+        assert response.headers["Content-Type"].startswith("text/plain")
+        assert ('wvote_http_requests_total{method="GET",'
+                'route="/allowed_hosts",status="200"}') in text
+        assert ('wvote_http_requests_total{method="GET",'
+                'route="unmatched",status="404"}') in text
+        assert 'wvote_http_request_seconds_count{method="GET",' \
+            'route="/allowed_hosts"}' in text
+        assert 'wvote_live_keys{store="vote"}' in text
+
+    def test_proxied_requests_are_refused(self):
+        response, _ = self.get("/metrics", **{"X-Forwarded-For": "1.2.3.4"})
+
+        assert response.status == 403
+
+    def test_can_be_made_public(self, monkeypatch):
+        monkeypatch.setattr(config, "metrics_public", True)
+
+        response, _ = self.get("/metrics", **{"X-Forwarded-For": "1.2.3.4"})
+
+        assert response.status == 200
+
+
+class TestProfiling:
+    @pytest.fixture(autouse=True)
+    def admin_key(self):
+        self.key = keys.create_admin_key()
+        yield
+        profiling.stop_heap_tracing()
+
+    def get(self, url):
+        async def fetch():
+            app = aiohttp.web.Application()
+            app.router.add_get("/admin/profile/{authKey}",
+                               http_server.admin_profile_handler)
+            app.router.add_get("/admin/heap/{authKey}",
+                               http_server.admin_heap_handler)
+
+            async with TestClient(TestServer(app)) as client:
+                response = await client.get(url)
+                return response, await response.read()
+
+        return asyncio.run(fetch())
+
+    def test_needs_admin_key(self):
+        response, _ = self.get("/admin/profile/nope?seconds=0")
+        assert response.status == 401
+
+        response, _ = self.get("/admin/heap/nope")
+        assert response.status == 401
+        assert not tracemalloc.is_tracing()
+
+    def test_profile_downloads_pstats(self):
+        response, body = self.get("/admin/profile/%s?seconds=0.01" %
+                                  self.key)
+
+        assert response.status == 200
+        assert "attachment" in response.headers["Content-Disposition"]
+        assert isinstance(marshal.loads(body), dict)
+
+    def test_profile_as_text(self):
+        response, body = self.get(
+            "/admin/profile/%s?seconds=0.01&format=text" % self.key)
+
+        assert response.status == 200
+        assert b"function calls" in body
+
+    def test_invalid_seconds(self):
+        response, _ = self.get("/admin/profile/%s?seconds=soon" % self.key)
+
+        assert response.status == 400
+
+    def test_heap(self):
+        response, body = self.get("/admin/heap/%s" % self.key)
+        assert response.status == 200
+        assert b"Top 25 allocations" in body
+        assert tracemalloc.is_tracing()
+
+        response, _ = self.get("/admin/heap/%s?stop=1" % self.key)
+        assert response.status == 200
+        assert not tracemalloc.is_tracing()
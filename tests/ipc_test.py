@@ -0,0 +1,104 @@
+import asyncio
+import collections
+
+import pytest
+
+import ipc
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(ipc, "role", None)
+    monkeypatch.setattr(ipc, "handlers", {})
+    monkeypatch.setattr(ipc, "peers", set())
+    monkeypatch.setattr(ipc, "pending", collections.deque(maxlen=100))
+    monkeypatch.setattr(ipc, "reconnect_delay", 0.01)
+
+
+async def wait_for(condition):
+    for _ in range(200):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("Timed out")
+
+
+class TestIPC:
+    def test_does_nothing_in_one_process(self):
+        ipc.send({"type": "weeks_changed"})
+
+        assert not ipc.pending
+
+    def test_messages_go_both_ways(self, tmp_path):
+        received = []
+
+        async def run():
+            ipc.handlers["connected"] = lambda message: received.append(
+                message)
+            ipc.handlers["submission"] = received.append
+            ipc.handlers["revoke"] = received.append
+
+            # Sent before anyone connects, so it waits
+            ipc.role = "http"
+            ipc.send({"type": "submission", "entry": {"uuid": "a"}})
+
+            path = str(tmp_path / "wvote.sock")
+            server = await ipc.listen(path)
+            client = asyncio.ensure_future(ipc.connect(path))
+
+            # Both ends share this module here, so count the connections
+            await wait_for(lambda: len(ipc.peers) == 2)
+            await wait_for(lambda: len(received) == 3)
+
+            ipc.send({"type": "revoke", "key": "abc"})
+            await wait_for(lambda: len(received) == 5)
+
+            client.cancel()
+            server.close()
+            await server.wait_closed()
+
+        asyncio.run(run())
+
+        assert [m["type"] for m in received[:3]].count("connected") == 2
+        assert {"type": "submission", "entry": {"uuid": "a"}} in received
+        assert received[3:] == [{"type": "revoke", "key": "abc"}] * 2
+
+    def test_bot_retries_until_the_server_is_up(self, tmp_path):
+        path = str(tmp_path / "wvote.sock")
+
+        async def run():
+            client = asyncio.ensure_future(ipc.connect(path))
+            await asyncio.sleep(0.05)
+            assert not ipc.peers
+
+            server = await ipc.listen(path)
+            await wait_for(lambda: len(ipc.peers) == 2)
+
+            client.cancel()
+            server.close()
+            await server.wait_closed()
+
+        asyncio.run(run())
+
+    def test_bad_messages_are_survived(self, tmp_path, caplog):
+        path = str(tmp_path / "wvote.sock")
+        received = []
+
+        async def run():
+            ipc.handlers["connected"] = lambda message: None
+            ipc.handlers["weeks_changed"] = received.append
+            server = await ipc.listen(path)
+
+            reader, writer = await asyncio.open_unix_connection(path)
+            writer.write(b'not json\n{"type": "nope"}\n'
+                         b'{"type": "weeks_changed"}\n')
+            await wait_for(lambda: received)
+
+            writer.close()
+            server.close()
+            await server.wait_closed()
+
+        asyncio.run(run())
+
+        assert received == [{"type": "weeks_changed"}]
+        assert "No handler" in caplog.text
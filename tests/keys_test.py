@@ -1,3 +1,5 @@
+import asyncio
+import time
 from datetime import datetime, timedelta
 from random import randint
 from string import ascii_letters, digits
@@ -5,6 +7,7 @@ from uuid import uuid4
 
 import pytest
 import keys
+import sqlite_store
 from config import DefaultConfig as config
 
 
@@ -31,6 +34,7 @@ class TestKeyValid():
         full_key = store[key]
         past_ttl = timedelta(minutes=full_key["timeToLive"] + 1)
         full_key["creationTime"] -= past_ttl
+        full_key["expires"] -= past_ttl.total_seconds()
         yield key, store, args
         multi_run.param[1].clear()
 
@@ -55,6 +59,239 @@ class TestKeyValid():
         assert isinstance(keys.key_valid(expired_key[0], expired_key[1]), bool)
 
 
+class TestExpiry():
+    @pytest.fixture(autouse=True)
+    def empty_stores(self, monkeypatch):
+        monkeypatch.setattr(keys, "expiry_heap", [])
+        yield
+        for store in [keys.edit_keys, keys.admin_keys, keys.vote_keys]:
+            store.clear()
+
+    def expire(self, store, key):
+        store[key]["expires"] = time.monotonic() - 1
+        for n, (_, tiebreak, heap_key, heap_store) in \
+                enumerate(keys.expiry_heap):
+            if heap_key == key:
+                keys.expiry_heap[n] = (store[key]["expires"], tiebreak,
+                                       heap_key, heap_store)
+        keys.heapq.heapify(keys.expiry_heap)
+
+    def test_expired_keys_are_removed(self):
+        old = keys.create_vote_key(1, "old")
+        new = keys.create_vote_key(2, "new")
+        self.expire(keys.vote_keys, old)
+
+        assert keys.remove_expired_keys() == 1
+
+        assert list(keys.vote_keys) == [new]
+        assert len(keys.expiry_heap) == 1
+
+    def test_keys_already_gone_are_skipped(self):
+        key = keys.create_edit_key("spam")
+        self.expire(keys.edit_keys, key)
+        keys.key_valid(key, keys.edit_keys)
+
+        assert keys.remove_expired_keys() == 0
+        assert keys.expiry_heap == []
+
+    def test_stats(self):
+        keys.create_edit_key("spam")
+        keys.create_vote_key(1, "a")
+        keys.create_vote_key(2, "b")
+
+        assert keys.key_stats() == {"edit": 1, "admin": 0, "vote": 2}
+
+    def test_sweeper_removes_keys_as_they_expire(self, monkeypatch):
+        monkeypatch.setattr(keys.config, "default_ttl", 0.01 / 60)
+        key = keys.create_admin_key()
+
+        async def sweep():
+            sweeper = asyncio.ensure_future(keys.sweep_expired_keys())
+            await asyncio.sleep(0.1)
+            sweeper.cancel()
+
+        asyncio.run(sweep())
+
+        assert key not in keys.admin_keys
+        assert keys.expiry_heap == []
+
+
+class TestSignedKeys():
+    @pytest.fixture(autouse=True)
+    def signed_mode(self, monkeypatch):
+        monkeypatch.setattr(keys.config, "key_mode", "signed")
+        monkeypatch.setattr(keys.config, "key_secret", "hunter2")
+        monkeypatch.setattr(keys, "revoked_admin_keys", {})
+
+    def test_keys_carry_their_data(self):
+        edit_key = keys.create_edit_key("spam")
+        vote_key = keys.create_vote_key(156896959783895040, "wiggle")
+
+        assert keys.key_data(edit_key, keys.edit_keys)["entryUUID"] == "spam"
+        vote = keys.key_data(vote_key, keys.vote_keys)
+        assert vote["userID"] == 156896959783895040
+        assert vote["userName"] == "wiggle"
+
+    def test_nothing_is_stored(self):
+        keys.create_edit_key("spam")
+        keys.create_admin_key()
+        keys.create_vote_key(42, "a")
+
+        assert keys.key_stats() == {"edit": 0, "admin": 0, "vote": 0}
+
+    def test_valid_with_another_process_secret(self, monkeypatch):
+        key = keys.create_admin_key()
+        monkeypatch.setattr(keys, "fallback_secret", b"something else")
+
+        assert keys.key_valid(key, keys.admin_keys)
+
+    def test_wrong_secret_is_invalid(self, monkeypatch):
+        key = keys.create_admin_key()
+        monkeypatch.setattr(keys.config, "key_secret", "hunter3")
+
+        assert not keys.key_valid(key, keys.admin_keys)
+
+    def test_tampered_key_is_invalid(self):
+        key = keys.create_vote_key(42, "a")
+        body, signature = key.split(".")
+        forged = keys.base64.urlsafe_b64encode(
+            keys.base64.urlsafe_b64decode(body + "==").replace(
+                b"42", b"43")).rstrip(b"=").decode()
+
+        assert not keys.key_valid(forged + "." + signature, keys.vote_keys)
+        assert not keys.key_valid("garbage", keys.vote_keys)
+
+    @pytest.mark.parametrize("key", [12345, None, ["a.b"]])
+    def test_non_string_key_is_invalid(self, key):
+        assert keys.key_data(key, keys.vote_keys) is None
+
+    def test_role_must_match_store(self):
+        key = keys.create_vote_key(42, "a")
+
+        assert keys.key_valid(key, keys.vote_keys)
+        assert not keys.key_valid(key, keys.admin_keys)
+        assert not keys.key_valid(key, {})
+
+    def test_expired_key_is_invalid(self, monkeypatch):
+        key = keys.create_edit_key("spam")
+        later = time.time() + keys.config.default_ttl * 60 + 1
+        monkeypatch.setattr(keys.time, "time", lambda: later)
+
+        assert not keys.key_valid(key, keys.edit_keys)
+
+    def test_admin_keys_can_be_revoked(self):
+        key = keys.create_admin_key()
+        other = keys.create_admin_key()
+
+        assert keys.revoke_key(key)
+
+        assert not keys.key_valid(key, keys.admin_keys)
+        assert keys.key_valid(other, keys.admin_keys)
+        assert not keys.revoke_key(keys.create_vote_key(42, "a"))
+
+    def test_revocations_are_shared_through_the_store(self, tmp_path,
+                                                      monkeypatch):
+        store = sqlite_store.SQLiteStore(str(tmp_path / "wvote.sqlite3"))
+        monkeypatch.setattr(keys, "get_revocation_store", lambda: store)
+        key = keys.create_admin_key()
+
+        keys.revoke_key(key)
+        # As seen by a process that started before, or after, the revoke
+        keys.revoked_admin_keys.clear()
+
+        assert not keys.key_valid(key, keys.admin_keys)
+        store.close()
+
+
+class TestRevokeKey():
+    def test_memory_keys_are_dropped(self):
+        key = keys.create_vote_key(42, "a")
+
+        assert keys.revoke_key(key)
+
+        assert not keys.key_valid(key, keys.vote_keys)
+        assert not keys.revoke_key(key)
+
+
+class TestKeyJournal():
+    @pytest.fixture(autouse=True)
+    def journal(self, tmp_path, monkeypatch):
+        journal = tmp_path / "keys.journal"
+        monkeypatch.setattr(keys.config, "key_journal", str(journal))
+        monkeypatch.setattr(keys, "expiry_heap", [])
+        monkeypatch.setattr(keys, "revoked_admin_keys", {})
+        yield journal
+        for store in [keys.edit_keys, keys.admin_keys, keys.vote_keys]:
+            store.clear()
+
+    def restart(self):
+        for store in [keys.edit_keys, keys.admin_keys, keys.vote_keys]:
+            store.clear()
+        keys.expiry_heap.clear()
+        keys.revoked_admin_keys.clear()
+        keys.load_keys()
+
+    def test_keys_survive_a_restart(self):
+        edit_key = keys.create_edit_key("spam")
+        vote_key = keys.create_vote_key(156896959783895040, "wiggle")
+        creation_time = keys.vote_keys[vote_key]["creationTime"]
+
+        self.restart()
+
+        assert keys.key_data(edit_key, keys.edit_keys)["entryUUID"] == "spam"
+        vote = keys.key_data(vote_key, keys.vote_keys)
+        assert vote["userID"] == 156896959783895040
+        assert vote["creationTime"] == creation_time
+        assert len(keys.expiry_heap) == 2
+
+    def test_expired_keys_are_compacted_away(self, journal):
+        old = keys.create_admin_key()
+        new = keys.create_admin_key()
+        keys.admin_keys[old]["expires"] = time.monotonic() - 1
+        journal.write_text("")
+        keys.compact_key_journal()
+
+        self.restart()
+
+        assert list(keys.admin_keys) == [new]
+        assert len(journal.read_text().splitlines()) == 1
+
+    def test_revoked_keys_stay_revoked(self):
+        key = keys.create_vote_key(42, "a")
+        keys.revoke_key(key)
+
+        self.restart()
+
+        assert not keys.key_valid(key, keys.vote_keys)
+
+    def test_signed_revocations_survive(self, monkeypatch):
+        monkeypatch.setattr(keys.config, "key_mode", "signed")
+        monkeypatch.setattr(keys.config, "key_secret", "hunter2")
+        key = keys.create_admin_key()
+        keys.revoke_key(key)
+
+        self.restart()
+
+        assert not keys.key_valid(key, keys.admin_keys)
+
+    def test_torn_record_is_ignored(self, journal):
+        key = keys.create_edit_key("spam")
+        with open(journal, "a") as journal_file:
+            journal_file.write('{"op": "add", "sto')
+
+        self.restart()
+
+        assert keys.key_valid(key, keys.edit_keys)
+
+    def test_nothing_written_when_off(self, journal, monkeypatch):
+        monkeypatch.setattr(keys.config, "key_journal", "")
+
+        keys.create_edit_key("spam")
+        keys.load_keys()
+
+        assert not journal.exists()
+
+
 class TestCreateKey():
 
     @pytest.mark.parametrize("len", [randint(0, 999) for _ in range(12)])
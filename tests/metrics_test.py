@@ -0,0 +1,66 @@
+import pytest
+
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(metrics, "registry", [])
+
+
+class TestCounter:
+    def test_counts_by_label(self):
+        counter = metrics.Counter("beeps_total", "Beeps")
+
+        counter.inc(route="/a")
+        counter.inc(2, route="/a")
+        counter.inc(route='/"b"')
+
+        assert metrics.render().splitlines() == [
+            "# HELP beeps_total Beeps",
+            "# TYPE beeps_total counter",
+            'beeps_total{route="/\\"b\\""} 1',
+            'beeps_total{route="/a"} 3',
+        ]
+
+
+class TestHistogram:
+    def test_buckets_are_cumulative(self):
+        histogram = metrics.Histogram("boops_seconds", "Boops", (0.1, 1))
+
+        for value in [0.05, 0.5, 0.5, 5]:
+            histogram.observe(value)
+
+        assert metrics.render().splitlines()[2:] == [
+            'boops_seconds_bucket{le="0.1"} 1',
+            'boops_seconds_bucket{le="1"} 3',
+            'boops_seconds_bucket{le="+Inf"} 4',
+            "boops_seconds_sum 6.05",
+            "boops_seconds_count 4",
+        ]
+
+    def test_times_blocks(self):
+        histogram = metrics.Histogram("blocks_seconds", "Blocks")
+
+        with histogram.time(kind="fast"):
+            pass
+
+        assert 'blocks_seconds_count{kind="fast"} 1' in metrics.render()
+
+
+class TestGauge:
+    def test_reads_when_rendered(self):
+        value = {"edit": 1}
+        metrics.Gauge("keys", "Keys", lambda: value, "store")
+
+        value["vote"] = 2.5
+
+        assert metrics.render().splitlines()[2:] == [
+            'keys{store="edit"} 1',
+            'keys{store="vote"} 2.5',
+        ]
+
+    def test_unlabelled(self):
+        metrics.Gauge("answer", "The answer", lambda: 42)
+
+        assert metrics.render().splitlines()[2:] == ["answer 42"]
@@ -0,0 +1,76 @@
+import asyncio
+import marshal
+import tracemalloc
+
+import pytest
+
+import profiling
+
+
+def busy():
+    return sum(n * n for n in range(10000))
+
+
+class TestProfile:
+    def profile(self, seconds):
+        async def run():
+            task = asyncio.ensure_future(profiling.profile_for(seconds))
+            await asyncio.sleep(0)
+            busy()
+            return await task
+
+        return asyncio.run(run())
+
+    def test_sees_the_event_loop(self):
+        profiler = self.profile(0.01)
+
+        assert "busy" in profiling.pstats_text(profiler)
+
+        stats = marshal.loads(profiling.pstats_bytes(profiler))
+        assert any(name == "busy" for _, _, name in stats)
+
+    def test_one_at_a_time(self):
+        async def run():
+            first = asyncio.ensure_future(profiling.profile_for(0.01))
+            await asyncio.sleep(0)
+            with pytest.raises(profiling.ProfilerBusyError):
+                await profiling.profile_for(0.01)
+            await first
+
+        asyncio.run(run())
+        assert profiling.active_profile is None
+
+    def test_duration_is_capped(self, monkeypatch):
+        monkeypatch.setattr(profiling, "max_profile_seconds", 0.01)
+
+        asyncio.run(asyncio.wait_for(profiling.profile_for(3600), 1))
+
+
+class TestHeapSnapshot:
+    @pytest.fixture(autouse=True)
+    def stop_tracing(self):
+        yield
+        profiling.stop_heap_tracing()
+
+    def test_starts_tracing(self):
+        assert not tracemalloc.is_tracing()
+
+        assert "Started tracing" in profiling.heap_snapshot()
+        assert tracemalloc.is_tracing()
+
+    def test_compares_to_last_snapshot(self):
+        profiling.heap_snapshot()
+        hoard = [bytearray(1000) for _ in range(100)]
+
+        text = profiling.heap_snapshot()
+
+        assert "Started tracing" not in text
+        assert "since the last snapshot" in text
+        assert "profiling_test.py" in text
+        del hoard
+
+    def test_stop(self):
+        assert not profiling.stop_heap_tracing()
+        profiling.heap_snapshot()
+        assert profiling.stop_heap_tracing()
+        assert not tracemalloc.is_tracing()
@@ -0,0 +1,411 @@
+import asyncio
+import collections
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import compo
+import ipc
+import sqlite_store
+from config import config
+
+
+def make_week(theme):
+    week = compo.blank_week()
+    week["theme"] = theme
+
+    for n in range(3):
+        entry = compo.create_blank_entry("Entrant %d" % n, 1000 + n)
+        entry["entryName"] = "Song %d" % n
+        week["entries"].append(entry)
+
+    week["votes"][42] = {
+        "userID": 42,
+        "userName": "voter",
+        "ratings": [{
+            "entryUUID": week["entries"][0]["uuid"],
+            "voteParam": "overall",
+            "rating": 4
+        }, {
+            "entryUUID": week["entries"][1]["uuid"],
+            "voteForName": "Entrant 1",
+            "voteParam": "score",
+            "rating": 5
+        }]
+    }
+
+    return week
+
+
+@pytest.fixture()
+def db(tmp_path):
+    store = sqlite_store.SQLiteStore(str(tmp_path / "wvote.sqlite3"))
+    yield store
+    store.close()
+
+
+class TestSQLiteStore:
+    def test_missing_week_is_none(self, db):
+        assert db.load_week("current") is None
+
+    def test_import_roundtrip(self, db):
+        week = make_week("Week 1: Roundtrip")
+
+        db.import_week("current", week)
+
+        assert db.load_week("current") == week
+
+    def test_snapshot_keeps_ballots(self, db):
+        week = make_week("Week 2: Snapshot")
+        db.import_week("current", week)
+
+        week["theme"] = "Week 2: Renamed"
+        del week["entries"][1]
+        db.write_snapshot(db.snapshot({"current": week}))
+
+        loaded = db.load_week("current")
+        assert loaded["theme"] == "Week 2: Renamed"
+        assert loaded["entries"] == week["entries"]
+        assert loaded["votes"] == week["votes"]
+
+    def test_saves_leave_other_writers_changes_alone(self, db, tmp_path):
+        db.import_week("next", make_week("Week 9: Shared"))
+        other = sqlite_store.SQLiteStore(str(tmp_path / "wvote.sqlite3"))
+        mine = db.load_week("next")
+        theirs = other.load_week("next")
+
+        # Another worker renames one entry and adds another...
+        theirs["entries"][0]["entryName"] = "Their rename"
+        added = compo.create_blank_entry("Newcomer", 2000)
+        theirs["entries"].append(added)
+        other.write_snapshot(other.snapshot({"next": theirs}))
+
+        # ...while this one, not having seen that yet, edits a different one
+        mine["entries"][1]["entryName"] = "My rename"
+        db.write_snapshot(db.snapshot({"next": mine}))
+        other.close()
+
+        names = [
+            entry["entryName"] for entry in db.load_week("next")["entries"]
+        ]
+        assert names == ["Their rename", "My rename", "Song 2", ""]
+
+    def test_only_known_entries_are_deleted(self, db, tmp_path):
+        db.import_week("next", make_week("Week 10: Deletions"))
+        other = sqlite_store.SQLiteStore(str(tmp_path / "wvote.sqlite3"))
+        mine = db.load_week("next")
+        theirs = other.load_week("next")
+
+        added = compo.create_blank_entry("Newcomer", 2000)
+        theirs["entries"].append(added)
+        other.write_snapshot(other.snapshot({"next": theirs}))
+        other.close()
+
+        removed = mine["entries"].pop(0)
+        db.write_snapshot(db.snapshot({"next": mine}))
+
+        uuids = [entry["uuid"] for entry in db.load_week("next")["entries"]]
+        assert removed["uuid"] not in uuids
+        assert added["uuid"] in uuids
+
+    def test_upsert_ballot_replaces_and_moves_to_end(self, db):
+        week = make_week("Week 3: Ballots")
+        db.import_week("current", week)
+
+        db.upsert_ballot("current", {
+            "userID": 7, "userName": "early", "ratings": []})
+        db.upsert_ballot("current", {
+            "userID": 42, "userName": "voter", "ratings": []})
+
+        votes = db.load_week("current")["votes"]
+        assert [(v["userID"], v["ratings"]) for v in votes.values()] == \
+            [(7, []), (42, [])]
+
+    def test_delete_ballot(self, db):
+        db.import_week("current", make_week("Week 4: Deletion"))
+
+        db.delete_ballot("current", 42)
+
+        assert db.load_week("current")["votes"] == {}
+
+    def test_archive_rotates_slots(self, db):
+        current = make_week("Week 5: Current")
+        upcoming = make_week("Week 6: Next")
+        db.import_week("current", current)
+        db.import_week("next", upcoming)
+
+        assert db.archive_week("01-02-03") == "archive/01-02-03"
+        assert db.load_week("archive/01-02-03") == current
+        assert db.load_week("current") == upcoming
+        assert db.load_week("next") is None
+
+    def test_archive_names_dont_collide(self, db):
+        db.import_week("current", make_week("Once"))
+        db.archive_week("01-02-03")
+        db.import_week("current", make_week("Twice"))
+
+        assert db.archive_week("01-02-03") == "archive/01-02-03-2"
+
+    def test_stale_snapshot_lands_on_its_own_week(self, db):
+        current = make_week("Week 7: Archived")
+        db.import_week("current", current)
+        db.import_week("next", make_week("Week 8: Promoted"))
+
+        snapshot = db.snapshot({"current": current})
+        db.archive_week("stale")
+        db.write_snapshot(snapshot)
+
+        assert db.load_week("current")["theme"] == "Week 8: Promoted"
+
+    def test_versions_count_commits(self, db):
+        week = make_week("Week 11: Versions")
+        db.import_week("current", week)
+        versions = db.versions()
+
+        db.upsert_ballot("current", {"userID": 9, "ratings": []})
+        assert db.versions() == dict(versions,
+                                     ballots=versions["ballots"] + 1)
+
+        db.write_snapshot(db.snapshot({"current": week}))
+        assert db.versions()["weeks"] == versions["weeks"]
+
+        week["theme"] = "Week 11: Renamed"
+        db.write_snapshot(db.snapshot({"current": week}))
+        assert db.versions()["weeks"] == versions["weeks"] + 1
+
+    def test_revoked_keys(self, db):
+        db.revoke_key("abc", time.time() + 60)
+        db.revoke_key("old", time.time() - 60)
+
+        assert db.key_revoked("abc")
+        assert not db.key_revoked("old")
+        assert not db.key_revoked("xyz")
+
+    def test_unused_indexes_are_dropped(self, tmp_path):
+        path = str(tmp_path / "old.sqlite3")
+        old = sqlite3.connect(path)
+        old.executescript(sqlite_store.schema + """
+            CREATE INDEX entries_by_uuid ON entries(uuid);
+            CREATE INDEX ratings_by_entry ON ratings(entry_uuid);
+        """)
+        old.close()
+
+        store = sqlite_store.SQLiteStore(path)
+        indexes = [
+            name for (name, ) in store.connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' "
+                "AND name NOT LIKE 'sqlite_%' ORDER BY name")
+        ]
+        store.close()
+
+        assert indexes == ["ballots_by_seq", "entries_by_position"]
+
+
+class TestCompoWithSQLite:
+    @pytest.fixture(autouse=True)
+    def sqlite_backend(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(config, "storage_backend", "sqlite")
+        monkeypatch.setattr(config, "sqlite_path",
+                            str(tmp_path / "wvote.sqlite3"))
+        compo.database = None
+        compo.current_week = None
+        compo.next_week = None
+        yield
+        compo.database.close()
+        compo.database = None
+        compo.current_week = None
+        compo.next_week = None
+
+    def reload(self):
+        compo.database.close()
+        compo.database = None
+        compo.current_week = None
+        compo.next_week = None
+
+    def test_starts_with_blank_weeks(self):
+        assert compo.get_week(True)["entries"] == []
+        assert compo.get_week(False)["votes"] == {}
+
+    def test_votes_survive_reload(self):
+        compo.get_week(False)
+        compo.upsert_vote({"userID": 1, "userName": "a", "ratings": []})
+        compo.upsert_vote({"userID": 2, "userName": "b", "ratings": []})
+        compo.delete_vote("1")
+
+        self.reload()
+
+        assert list(compo.get_week(False)["votes"]) == [2]
+
+    def test_saves_survive_reload(self):
+        compo.get_week(True)["theme"] = "Week 9: Saved"
+        compo.save_weeks()
+
+        self.reload()
+
+        assert compo.get_week(True)["theme"] == "Week 9: Saved"
+
+    def test_move_to_next_week(self):
+        compo.get_week(False)["theme"] = "Week 10: Done"
+        compo.get_week(True)["theme"] = "Week 11: Up next"
+
+        compo.move_to_next_week()
+        self.reload()
+
+        assert compo.get_week(False)["theme"] == "Week 11: Up next"
+        assert compo.get_week(True) == compo.blank_week()
+        assert compo.database.load_week(
+            compo.database.slots()[0])["theme"] == "Week 10: Done"
+
+
+class TestSharedDatabase:
+    """Another process using the same database, as in `main.py http`"""
+
+    @pytest.fixture(autouse=True)
+    def sqlite_backend(self, tmp_path, monkeypatch):
+        self.path = str(tmp_path / "wvote.sqlite3")
+        monkeypatch.setattr(config, "storage_backend", "sqlite")
+        monkeypatch.setattr(config, "sqlite_path", self.path)
+        monkeypatch.setattr(compo, "write_through", True)
+        monkeypatch.setattr(compo, "write_through_snapshot", None)
+        monkeypatch.setattr(ipc, "role", "http")
+        monkeypatch.setattr(ipc, "pending", collections.deque())
+        compo.database = None
+        compo.current_week = None
+        compo.next_week = None
+
+        self.other = sqlite_store.SQLiteStore(self.path)
+        yield
+        self.other.close()
+        compo.database.close()
+        compo.database = None
+        compo.current_week = None
+        compo.next_week = None
+
+    def test_changes_are_saved_right_away(self):
+        async def edit():
+            compo.get_week(True)["theme"] = "Week 12: Right away"
+            compo.schedule_save()
+            await compo.wait_for_save()
+
+        asyncio.run(edit())
+
+        assert self.other.load_week("next")["theme"] == "Week 12: Right away"
+        assert list(ipc.pending) == [{"type": "weeks_changed"}]
+
+    def test_changes_are_written_off_the_event_loop(self, monkeypatch):
+        write = compo.write_snapshot
+        threads = []
+
+        def record_thread(snapshot):
+            threads.append(threading.current_thread())
+            write(snapshot)
+
+        monkeypatch.setattr(compo, "write_snapshot", record_thread)
+
+        async def edit():
+            compo.get_week(True)
+            threads.clear()
+            compo.get_week(True)["theme"] = "Week 16: Elsewhere"
+            compo.schedule_save()
+            await compo.wait_for_save()
+
+        asyncio.run(edit())
+
+        assert len(threads) == 1
+        assert threads[0] is not threading.main_thread()
+
+    def test_changes_survive_a_reload_before_the_write(self):
+        async def edit():
+            compo.get_week(True)["theme"] = "Week 17: Kept"
+            compo.schedule_save()
+            # Another process's change arrives before the write gets going
+            compo.reload_weeks()
+            await compo.wait_for_save()
+
+        asyncio.run(edit())
+
+        assert self.other.load_week("next")["theme"] == "Week 17: Kept"
+
+    def test_ballots_are_announced(self):
+        compo.get_week(False)
+        ipc.pending.clear()
+        vote = {"userID": 1, "userName": "a", "ratings": []}
+
+        compo.upsert_vote(vote)
+        compo.delete_vote(1)
+
+        assert list(ipc.pending) == [{
+            "type": "ballot",
+            "record": {"op": "upsert", "vote": vote},
+            "version": 1
+        }, {
+            "type": "ballot",
+            "record": {"op": "delete", "userID": 1},
+            "version": 2
+        }]
+        assert compo.loaded_versions["ballots"] == 2
+
+    def test_peer_ballots_are_applied_in_place(self):
+        week = compo.get_week(False)
+        version = compo.week_version
+        vote = {"userID": 3, "userName": "c", "ratings": []}
+        self.other.upsert_ballot("current", vote)
+
+        compo.apply_peer_ballot({"op": "upsert", "vote": vote}, 1)
+
+        assert compo.get_week(False) is week
+        assert week["votes"] == {3: vote}
+        assert compo.week_version == version
+
+    def test_peer_ballots_already_loaded_are_skipped(self):
+        compo.get_week(False)
+        vote = {"userID": 3, "userName": "c", "ratings": []}
+        self.other.upsert_ballot("current", vote)
+        week = compo.get_week(False)
+
+        compo.apply_peer_ballot({"op": "delete", "userID": 3}, 1)
+
+        assert week["votes"] == {3: vote}
+
+    def test_other_processes_ballots_reload_just_ballots(self):
+        week = compo.get_week(False)
+        version = compo.week_version
+        vote = {"userID": 4, "userName": "d", "ratings": []}
+
+        self.other.upsert_ballot("current", vote)
+
+        assert compo.get_week(False) is week
+        assert week["votes"] == {4: vote}
+        assert compo.week_version == version
+
+    def test_other_writers_are_noticed(self):
+        week = compo.get_week(True)
+        assert compo.get_week(True) is week
+
+        changed = make_week("Week 14: Another worker")
+        self.other.write_snapshot(self.other.snapshot({"next": changed}))
+
+        assert compo.get_week(True)["theme"] == "Week 14: Another worker"
+
+    def test_own_writes_dont_cause_reloads(self):
+        week = compo.get_week(True)
+        week["theme"] = "Week 15: Mine"
+        compo.schedule_save()
+
+        assert compo.get_week(True) is week
+
+    def test_reload_picks_up_other_changes(self):
+        week = compo.get_week(True)
+        version = compo.week_version
+
+        changed = make_week("Week 13: From elsewhere")
+        self.other.write_snapshot(self.other.snapshot({"next": changed}))
+        compo.reload_weeks()
+
+        assert compo.week_version > version
+        assert compo.get_week(True) is not week
+        assert compo.get_week(True)["theme"] == "Week 13: From elsewhere"
+        assert compo.find_entry_by_uuid(
+            changed["entries"][0]["uuid"]) is not None
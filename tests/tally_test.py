@@ -0,0 +1,252 @@
+import random
+import statistics
+
+import numpy as np
+import pytest
+
+import compo
+import tally
+
+
+def reference_ranking(week):
+    """The original one-round-at-a-time Bloc STAR loop, kept to check
+       the array version against."""
+    param_weights = {"prompt": 0.33, "score": 0.33, "overall": 0.33}
+
+    scores = compo.normalize_votes(week["votes"].values())
+
+    entry_pool = []
+    ranked_entries = []
+
+    for e in week["entries"]:
+        if compo.entry_valid(e):
+            e["voteScore"] = statistics.mean(
+                score[0] for score in scores.get(e["uuid"], [(0, None)]))
+            entry_pool.append(e)
+
+    while len(entry_pool) > 1:
+        entry_pool = sorted(entry_pool,
+                            key=lambda e: e["voteScore"],
+                            reverse=True)
+
+        entryA = entry_pool[0]
+        entryB = entry_pool[1]
+
+        preferEntryA = 0
+        preferEntryB = 0
+
+        for v in week["votes"].values():
+            scoreA = sum(r["rating"] * param_weights[r["voteParam"]]
+                         for r in v["ratings"]
+                         if r["entryUUID"] == entryA["uuid"])
+            scoreB = sum(r["rating"] * param_weights[r["voteParam"]]
+                         for r in v["ratings"]
+                         if r["entryUUID"] == entryB["uuid"])
+
+            if scoreA > scoreB:
+                preferEntryA += 1
+            elif scoreB > scoreA:
+                preferEntryB += 1
+
+        if preferEntryA >= preferEntryB:
+            ranked_entries.append(entry_pool.pop(0))
+        else:
+            ranked_entries.append(entry_pool.pop(1))
+
+    ranked_entries.append(entry_pool.pop(0))
+
+    for place, e in enumerate(ranked_entries):
+        e["votePlacement"] = place + 1
+
+    return list(reversed(ranked_entries))
+
+
+def valid_entry(name):
+    entry = compo.create_blank_entry(name, hash(name))
+    entry.update({
+        # Stable across calls, so two copies of a week line up
+        "uuid": "uuid of " + name,
+        "entryName": name,
+        "pdf": "pdf",
+        "pdfFilename": "score.pdf",
+        "mp3": "mp3",
+        "mp3Format": "mp3",
+        "mp3Filename": "song.mp3",
+    })
+    return entry
+
+
+def random_week(seed, entries=12, voters=40):
+    rng = random.Random(seed)
+    week = compo.blank_week()
+
+    for n in range(entries):
+        week["entries"].append(valid_entry("Entry %d" % n))
+
+    # An invalid entry still gets rated, and counts towards normalization
+    incomplete = compo.create_blank_entry("Incomplete", 0)
+    incomplete["uuid"] = "uuid of Incomplete"
+    week["entries"].append(incomplete)
+
+    for voter in range(voters):
+        ratings = []
+        for e in rng.sample(week["entries"], rng.randint(0, entries)):
+            params = week["voteParams"][:]
+            rng.shuffle(params)
+            for param in params[:rng.randint(1, 3)]:
+                ratings.append({
+                    "entryUUID": e["uuid"],
+                    "voteParam": param,
+                    # Few distinct values, so ties and float rounding come up
+                    "rating": rng.choice([0, 1, 2, 3, 3, 4, 5, 5]),
+                })
+        rng.shuffle(ratings)
+        week["votes"][voter] = {
+            "userID": voter,
+            "userName": "voter %d" % voter,
+            "ratings": ratings,
+        }
+
+    return week
+
+
+def placements(ranked):
+    return [(e["uuid"], e["votePlacement"], e["voteScore"]) for e in ranked]
+
+
+class TestRankEntries:
+    @pytest.mark.parametrize("seed", range(25))
+    def test_matches_reference(self, seed):
+        expected = placements(reference_ranking(random_week(seed)))
+
+        week = random_week(seed)
+        pool = [e for e in week["entries"] if compo.entry_valid(e)]
+        actual = placements(tally.rank_entries(pool, week["votes"].values()))
+
+        assert actual == expected
+        # Bit-for-bit, not approximately
+        assert [repr(score) for _, _, score in actual] == \
+            [repr(score) for _, _, score in expected]
+
+    def test_unrated_entries_score_zero(self):
+        entry = valid_entry("Lonely")
+
+        ranked = tally.rank_entries([entry], [])
+
+        assert ranked == [entry]
+        assert entry["voteScore"] == 0
+        assert entry["votePlacement"] == 1
+
+    def test_empty_pool(self):
+        assert tally.rank_entries([], []) == []
+
+    def test_compo_uses_tally(self):
+        week = random_week(1234)
+        expected = placements(reference_ranking(random_week(1234)))
+
+        assert placements(compo.get_ranked_entrant_list(week)) == expected
+
+
+class TestPreferenceMatrix:
+    def test_counts_head_to_head_wins(self):
+        entries = [valid_entry("A"), valid_entry("B")]
+        votes = [{
+            "userID": n,
+            "ratings": [{
+                "entryUUID": entries[0]["uuid"],
+                "voteParam": "overall",
+                "rating": a
+            }, {
+                "entryUUID": entries[1]["uuid"],
+                "voteParam": "overall",
+                "rating": b
+            }]
+        } for n, (a, b) in enumerate([(5, 1), (4, 2), (1, 3), (3, 3)])]
+
+        arrays = tally.load_ratings(votes, [e["uuid"] for e in entries])
+        preferences = tally.preference_matrix(arrays["ratings"],
+                                              arrays["weights"], 2)
+
+        assert preferences.tolist() == [[0, 2], [1, 0]]
+
+
+class TestLiveTally:
+    def full_recompute(self, week):
+        pool = [e for e in week["entries"] if compo.entry_valid(e)]
+        return placements(tally.rank_entries(pool, week["votes"].values()))
+
+    @pytest.mark.parametrize("seed", range(10))
+    def test_matches_full_recompute_through_changes(self, seed):
+        rng = random.Random(seed)
+        week = random_week(seed)
+        donor = random_week(seed + 1000)
+        pool = [e for e in week["entries"] if compo.entry_valid(e)]
+
+        live = tally.LiveTally(pool)
+        for user_id, vote in week["votes"].items():
+            live.add(user_id, vote)
+
+        for step in range(30):
+            user_id = rng.randrange(len(week["votes"]) + 5)
+            if rng.random() < 0.3:
+                week["votes"].pop(user_id, None)
+                live.remove(user_id)
+            else:
+                vote = dict(donor["votes"][rng.randrange(len(donor["votes"]))],
+                            userID=user_id)
+                week["votes"].pop(user_id, None)
+                week["votes"][user_id] = vote
+                live.add(user_id, vote)
+
+            assert placements(live.ranking()) == self.full_recompute(week)
+
+    def test_removing_everyone_leaves_nothing(self):
+        week = random_week(7)
+        pool = [e for e in week["entries"] if compo.entry_valid(e)]
+        live = tally.LiveTally(pool)
+        for user_id, vote in week["votes"].items():
+            live.add(user_id, vote)
+
+        for user_id in list(week["votes"]):
+            live.remove(user_id)
+
+        assert live.scores() == [0] * len(pool)
+        assert not live.preferences.any()
+
+
+class TestCompoLiveResults:
+    @pytest.fixture(autouse=True)
+    def current_week(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(compo, "journal_filename",
+                            str(tmp_path / "current-week.journal"))
+        compo.current_week = random_week(99)
+        compo.next_week = compo.blank_week()
+        compo.invalidate_live_results()
+
+    def expected(self):
+        copy = random_week(99)
+        copy["votes"] = compo.current_week["votes"]
+        return placements(reference_ranking(copy))
+
+    def test_ballots_update_cached_results(self):
+        week = compo.current_week
+        compo.get_ranked_entrant_list(week)
+        live = compo.live_results["tally"]
+
+        compo.upsert_vote(dict(week["votes"][3], userID=1234))
+        compo.upsert_vote(dict(week["votes"][5], userID=3))
+        compo.delete_vote("7")
+
+        assert placements(compo.get_ranked_entrant_list(week)) == \
+            self.expected()
+        # Updated in place, not rebuilt
+        assert compo.live_results["tally"] is live
+
+    def test_entry_changes_rebuild_results(self):
+        week = compo.current_week
+        compo.get_ranked_entrant_list(week)
+
+        del week["entries"][0]["pdf"]
+
+        ranked = compo.get_ranked_entrant_list(week)
+        assert len(ranked) == len(week["entries"]) - 2